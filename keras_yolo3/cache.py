@@ -0,0 +1,306 @@
+"""
+Content-addressed cache of detection results
+
+The cache key is a hash of the raw image bytes together with a fingerprint
+of the model and its thresholds, so repeated images skip decoding and inference.
+There is an in-memory LRU tier bounded by size and an optional on-disk tier.
+"""
+
+import os
+import io
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from .visual import draw_predictions
+
+#: default size of the in-memory tier, in bytes
+DEFAULT_CACHE_SIZE = 64 * 1024 ** 2
+
+
+def _file_signature(path_file):
+    """path of a model file together with its size and modification time
+
+    :param str|None path_file: path to the file
+    :return list|None:
+    """
+    if not path_file:
+        return None
+    if not os.path.isfile(path_file):
+        return [path_file, None]
+    stat = os.stat(path_file)
+    return [os.path.abspath(path_file), stat.st_size, stat.st_mtime]
+
+
+def model_fingerprint(yolo):
+    """fingerprint of the model, anchors, classes and thresholds of a detector
+
+    Both Keras (`weights_path`) and TFLite (`path_model`) detectors are covered,
+    the model file enters the fingerprint with its size and modification time.
+
+    :param yolo: detector, e.g. :class:`keras_yolo3.yolo.YOLO`
+    :return str:
+
+    >>> class Detector:
+    ...     weights_path = None
+    ...     anchors = np.ones((6, 2))
+    ...     class_names = ['cat', 'dog']
+    ...     score, iou = 0.3, 0.45
+    >>> det = Detector()
+    >>> fp = model_fingerprint(det)
+    >>> len(fp)
+    40
+    >>> det.score = 0.5
+    >>> model_fingerprint(det) == fp
+    False
+
+    Two TFLite models sharing anchors, classes and thresholds
+
+    >>> import tempfile, shutil
+    >>> path_dir = tempfile.mkdtemp()
+    >>> class DetectorLite:
+    ...     class_names = ['cat', 'dog']
+    ...     score, iou = 0.3, 0.45
+    ...     model_image_size = (224, 224)
+    ...     def __init__(self, path_model):
+    ...         self.path_model = path_model
+    >>> paths = [os.path.join(path_dir, 'model-%i.tflite' % i) for i in range(2)]
+    >>> for i, path_model in enumerate(paths):
+    ...     with open(path_model, 'wb') as fp:
+    ...         _ = fp.write(b'flatbuffer' * (i + 1))
+    >>> fp_a, fp_b = [model_fingerprint(DetectorLite(p)) for p in paths]
+    >>> fp_a == fp_b
+    False
+    >>> with open(paths[0], 'wb') as fp:
+    ...     _ = fp.write(b'retrained-flatbuffer')
+    >>> model_fingerprint(DetectorLite(paths[0])) == fp_a
+    False
+    >>> shutil.rmtree(path_dir)
+    """
+    model = getattr(yolo, 'yolo_model', None)
+    if model is not None:
+        input_shape = model._input_layers[0].input_shape[1:3]
+    else:
+        input_shape = getattr(yolo, 'model_image_size', None)
+    anchors = getattr(yolo, 'anchors', None)
+    params = {
+        'weights': _file_signature(getattr(yolo, 'weights_path', None)),
+        'model': _file_signature(getattr(yolo, 'path_model', None)),
+        'anchors': np.asarray(anchors).tolist() if anchors is not None else None,
+        'classes': list(getattr(yolo, 'class_names', [])),
+        'score': getattr(yolo, 'score', None),
+        'iou': getattr(yolo, 'iou', None),
+        'input_shape': [int(s) if s else None for s in input_shape] if input_shape else None,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DetectionCache(object):
+    """Two-tier cache of detections, in-memory LRU with optional on-disk storage
+
+    The cache is thread-safe, so it can be queried from prefetching threads.
+
+    >>> cache = DetectionCache(max_size=150)
+    >>> key = cache.make_key(b'image-bytes', 'model-fingerprint')
+    >>> cache.get(key) is None
+    True
+    >>> preds = [{'class': 1, 'label': 'dog', 'confidence': 0.8,
+    ...           'ymin': 10, 'xmin': 20, 'ymax': 30, 'xmax': 40}]
+    >>> cache.put(key, preds)
+    >>> cache.get(key) == preds
+    True
+    >>> cache.put(cache.make_key(b'other-image', 'model-fingerprint'), preds)
+    >>> cache.get(key) is None  # the oldest one was evicted
+    True
+    >>> cache.stats()
+    {'hits': 1, 'misses': 2, 'disk_hits': 0, 'entries': 1, 'size': 97}
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, path_dir=None):
+        """
+
+        :param int max_size: maximal size of the in-memory tier in bytes, 0 to disable it
+        :param str|None path_dir: folder for the on-disk tier, None to disable it
+        """
+        self.max_size = max_size
+        self.path_dir = path_dir
+        if self.path_dir and not os.path.isdir(self.path_dir):
+            os.makedirs(self.path_dir)
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    @staticmethod
+    def make_key(image_bytes, fingerprint):
+        """create cache key from raw image content and model fingerprint
+
+        :param bytes image_bytes: encoded image
+        :param str fingerprint: model fingerprint, see :func:`model_fingerprint`
+        :return str:
+        """
+        hasher = hashlib.sha1(fingerprint.encode('utf-8'))
+        hasher.update(image_bytes)
+        return hasher.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.path_dir, key[:2], key + '.json')
+
+    def _remember(self, key, payload):
+        if len(payload) > self.max_size:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = payload
+        self._memory_size += len(payload)
+        while self._memory_size > self.max_size:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    def get(self, key):
+        """get cached predictions
+
+        :param str key: cache key
+        :return list(dict)|None: predictions or None if missing
+        """
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+        if payload is None and self.path_dir and os.path.isfile(self._disk_path(key)):
+            with open(self._disk_path(key), 'rb') as fp:
+                payload = fp.read()
+            with self._lock:
+                self._remember(key, payload)
+                self.disk_hits += 1
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(payload.decode('utf-8'))
+
+    def put(self, key, predicts):
+        """store predictions in all tiers
+
+        :param str key: cache key
+        :param list(dict) predicts: predictions
+        """
+        payload = json.dumps(predicts).encode('utf-8')
+        with self._lock:
+            self._remember(key, payload)
+        if not self.path_dir:
+            return
+        path_json = self._disk_path(key)
+        if not os.path.isdir(os.path.dirname(path_json)):
+            os.makedirs(os.path.dirname(path_json), exist_ok=True)
+        # write to temporary file first, so parallel readers never see partial content
+        path_tmp = '%s.%i.tmp' % (path_json, os.getpid())
+        with open(path_tmp, 'wb') as fp:
+            fp.write(payload)
+        os.replace(path_tmp, path_json)
+
+    def stats(self):
+        """hit/miss counters and size of the in-memory tier
+
+        :return dict:
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'entries': len(self._memory),
+            'size': self._memory_size,
+        }
+
+    def clear(self):
+        """drop the in-memory tier, the on-disk tier is kept"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+
+
+def image_from_bytes(image_bytes):
+    """decode image from raw file content
+
+    :param bytes image_bytes: encoded image
+    :return Image:
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return image
+
+
+class CachedYOLO(object):
+    """Detector wrapper which caches detections of image files
+
+    >>> class Detector:
+    ...     weights_path, anchors, class_names, score, iou = None, None, ['a'], .3, .45
+    ...     colors = [(255, 0, 0)]
+    ...     calls = 0
+    ...     def detect_image(self, image, render=True):
+    ...         self.calls += 1
+    ...         return image, [{'class': 0, 'label': 'a', 'confidence': 0.5,
+    ...                         'ymin': 10, 'xmin': 10, 'ymax': 50, 'xmax': 50}]
+    >>> from keras_yolo3.utils import update_path
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> yolo = CachedYOLO(Detector(), DetectionCache())
+    >>> _, preds = yolo.detect_file(path_img, render=False)
+    >>> _, preds2 = yolo.detect_file(path_img, render=False)
+    >>> preds == preds2, yolo.calls
+    (True, 1)
+    >>> yolo.cache.stats()['hits']
+    1
+    """
+
+    def __init__(self, yolo, cache):
+        """
+
+        :param yolo: detector, e.g. :class:`keras_yolo3.yolo.YOLO`
+        :param DetectionCache cache: cache instance
+        """
+        self.yolo = yolo
+        self.cache = cache
+        self.fingerprint = model_fingerprint(yolo)
+
+    def __getattr__(self, name):
+        # delegate everything else to the wrapped detector
+        return getattr(self.__dict__['yolo'], name)
+
+    def lookup_file(self, path_image):
+        """read the image file and look for its cached detections
+
+        :param str path_image: path to the image
+        :return tuple(str,list(dict)|None,bytes): cache key, predictions or None and raw image
+        """
+        with open(path_image, 'rb') as fp:
+            image_bytes = fp.read()
+        key = self.cache.make_key(image_bytes, self.fingerprint)
+        return key, self.cache.get(key), image_bytes
+
+    def detect_file(self, path_image, render=True):
+        """detect objects in image file, the decoding and inference is skipped on cache hit
+
+        :param str path_image: path to the image
+        :param bool render: draw the detections, otherwise the image is not returned on cache hit
+        :return tuple(Image|None,list(dict)): image with drawn detections and predictions
+        """
+        key, predicts, image_bytes = self.lookup_file(path_image)
+        if predicts is not None:
+            logging.debug('cache hit for "%s"', path_image)
+            if not render:
+                return None, predicts
+            image = image_from_bytes(image_bytes)
+            return draw_predictions(image, predicts, self.yolo.colors), predicts
+
+        image = image_from_bytes(image_bytes)
+        image_pred, predicts = self.yolo.detect_image(image, render=render)
+        self.cache.put(key, predicts)
+        return image_pred, predicts
@@ -0,0 +1,240 @@
+"""
+Synchronous data-parallel training in local processes
+
+Each of the worker processes trains the same model on its own shard
+of the dataset. After every batch the workers average their gradients
+through a buffer in shared memory, so all of them apply the same update
+and their weights stay equal, as one training with the batch times larger.
+Averaged are also the epoch logs, so callbacks as `ReduceLROnPlateau` or
+`EarlyStopping` decide the same in all workers, and the BatchNorm statistics.
+
+    def train(data_parallel, path_dataset):
+        ...
+        model.compile(optimizer=data_parallel.wrap_optimizer(Adam()), loss=...)
+        data_parallel.broadcast_weights(model)
+        model.fit_generator(..., callbacks=[data_parallel.callback()])
+
+    run_workers(train, 4, path_dataset='dataset.txt')
+
+The workers are spawned as new processes, so the function has to be importable.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import traceback
+import multiprocessing as mproc
+from functools import partial
+from queue import Empty
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from keras.callbacks import Callback
+
+from .utils import CPU_COUNT
+
+#: shared memory folder, if the system has one
+PATH_SHM = '/dev/shm'
+#: seconds a worker waits for the others, e.g. while they build the model
+TIMEOUT_BARRIER = 3600
+
+
+class DataParallel(object):
+    """Worker of the data-parallel training averaging its arrays with the others
+
+    >>> import threading
+    >>> path_dir = tempfile.mkdtemp()
+    >>> parallel = DataParallel(0, 1, threading.Barrier(1), path_dir)
+    >>> parallel.is_chief
+    True
+    >>> parallel.shard(list(range(5)))
+    [0, 1, 2, 3, 4]
+    >>> [a.tolist() for a in parallel.mean([np.ones(2), np.zeros((1, 2))])]
+    [[1.0, 1.0], [[0.0, 0.0]]]
+    >>> [a.tolist() for a in parallel.broadcast([np.arange(3)])]
+    [[0.0, 1.0, 2.0]]
+    >>> shutil.rmtree(path_dir)
+    """
+
+    def __init__(self, rank, nb_workers, barrier, path_dir, timeout=TIMEOUT_BARRIER):
+        """
+
+        :param int rank: index of this worker
+        :param int nb_workers: number of workers
+        :param barrier: barrier of all workers, see :func:`run_workers`
+        :param str path_dir: folder of the shared buffers
+        :param float timeout: seconds to wait for other workers
+        """
+        assert 0 <= rank < nb_workers, 'rank %i out of %i workers' % (rank, nb_workers)
+        self.rank = rank
+        self.nb_workers = nb_workers
+        self.barrier = barrier
+        self.path_dir = path_dir
+        self.timeout = timeout
+        self._buffer = None
+
+    @property
+    def is_chief(self):
+        """the first worker exports the model and logs"""
+        return self.rank == 0
+
+    def shard(self, items):
+        """samples of this worker, all shards have the same size
+
+        :param list items: all samples
+        :return list: every `nb_workers`-th sample
+        """
+        size = len(items) // self.nb_workers
+        return items[self.rank::self.nb_workers][:size]
+
+    def _wait(self):
+        self.barrier.wait(self.timeout)
+
+    def _get_buffer(self, size):
+        """buffer with a row for each worker and the last row for the mean"""
+        if self._buffer is None or self._buffer.shape[1] < size:
+            # all workers ask for the same sizes in the same order
+            path_buffer = os.path.join(self.path_dir, 'buffer-%i.bin' % size)
+            if self.is_chief:
+                np.memmap(path_buffer, dtype=np.float32, mode='w+', shape=(self.nb_workers + 1, size)).flush()
+            self._wait()
+            self._buffer = np.memmap(path_buffer, dtype=np.float32, mode='r+', shape=(self.nb_workers + 1, size))
+        return self._buffer
+
+    @staticmethod
+    def _split(flat, arrays):
+        parts = np.split(flat, np.cumsum([np.size(arr) for arr in arrays])[:-1])
+        return [part.reshape(np.shape(arr)) for part, arr in zip(parts, arrays)]
+
+    def mean(self, arrays):
+        """average the arrays over all workers, all of them have to call it
+
+        :param list(ndarray) arrays: arrays of this worker
+        :return list(ndarray): float32 means in the same shapes
+        """
+        flat = np.concatenate([np.ravel(arr) for arr in arrays]).astype(np.float32)
+        buffer = self._get_buffer(flat.size)
+        buffer[self.rank, :flat.size] = flat
+        self._wait()
+        # each worker averages its chunk of the buffer
+        chunk = slice(*[int(flat.size * i / self.nb_workers) for i in (self.rank, self.rank + 1)])
+        buffer[-1, chunk] = buffer[:-1, chunk].mean(axis=0, dtype=np.float64)
+        self._wait()
+        return self._split(np.array(buffer[-1, :flat.size]), arrays)
+
+    def broadcast(self, arrays):
+        """arrays of the chief to all workers, all of them have to call it
+
+        :param list(ndarray) arrays: arrays of this worker, just their shapes are used by the others
+        :return list(ndarray): float32 arrays of the chief
+        """
+        flat = np.concatenate([np.ravel(arr) for arr in arrays]).astype(np.float32)
+        buffer = self._get_buffer(flat.size)
+        if self.is_chief:
+            buffer[-1, :flat.size] = flat
+        self._wait()
+        flat = np.array(buffer[-1, :flat.size])
+        # the chief does not overwrite the buffer until all read it
+        self._wait()
+        return self._split(flat, arrays)
+
+    def broadcast_weights(self, model):
+        """set weights of all workers to the weights of the chief
+
+        :param model: Keras model
+        """
+        model.set_weights(self.broadcast(model.get_weights()))
+
+    def wrap_optimizer(self, optimizer):
+        """the optimizer updates the weights by gradients averaged over all workers
+
+        :param optimizer: Keras optimizer computing gradients by `get_gradients`
+        :return: the same optimizer
+        """
+        get_gradients = optimizer.get_gradients
+
+        def get_gradients_mean(loss, params):
+            grads = get_gradients(loss, params)
+            means = tf.py_func(lambda *arrays: self.mean(arrays), grads, [g.dtype for g in grads],
+                               stateful=True, name='gradients_mean')
+            for grad_mean, grad in zip(means, grads):
+                grad_mean.set_shape(grad.shape)
+            return means
+
+        optimizer.get_gradients = get_gradients_mean
+        return optimizer
+
+    def callback(self):
+        """callback averaging epoch logs and BatchNorm statistics, it goes before the others"""
+        return AverageLogs(self)
+
+
+class AverageLogs(Callback):
+    """Average the epoch logs and non-trainable weights over the workers"""
+
+    def __init__(self, data_parallel):
+        super(AverageLogs, self).__init__()
+        self.data_parallel = data_parallel
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        names = sorted(name for name, val in logs.items() if np.isscalar(val))
+        weights = self.model.non_trainable_weights
+        means = self.data_parallel.mean([np.array(logs[name]) for name in names] + K.batch_get_value(weights))
+        logs.update({name: float(val) for name, val in zip(names, means[:len(names)])})
+        # the moving statistics of BatchNorm are computed on the local batches
+        K.batch_set_value(list(zip(weights, means[len(names):])))
+
+
+def _run_worker(func, rank, nb_workers, barrier, path_dir, queue, kwargs):
+    logging.basicConfig(level=logging.INFO, format='[worker %i] %%(levelname)s:%%(message)s' % rank)
+    # the cores are split among the workers
+    nb_threads = max(1, CPU_COUNT // nb_workers)
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=nb_threads,
+                                                   inter_op_parallelism_threads=2)))
+    try:
+        result = func(data_parallel=DataParallel(rank, nb_workers, barrier, path_dir), **kwargs)
+    except Exception:
+        logging.error(traceback.format_exc())
+        # the other workers waiting for this one fail too
+        barrier.abort()
+        raise
+    queue.put((rank, result))
+
+
+def run_workers(func, nb_workers, **kwargs):
+    """run the training function in local worker processes
+
+    :param func: function taking `data_parallel` and the `kwargs`,
+        it has to be importable from a new process
+    :param int nb_workers: number of processes
+    :param kwargs: parameters of the function
+    :return list: results of the function by the workers
+    """
+    ctx = mproc.get_context('spawn')
+    barrier = ctx.Barrier(nb_workers)
+    queue = ctx.Queue()
+    path_dir = tempfile.mkdtemp(prefix='data-parallel-', dir=PATH_SHM if os.path.isdir(PATH_SHM) else None)
+    logging.info('Run %i data-parallel workers sharing "%s".', nb_workers, path_dir)
+    workers = [ctx.Process(target=partial(_run_worker, func, rank, nb_workers, barrier, path_dir, queue, kwargs))
+               for rank in range(nb_workers)]
+    results = {}
+    try:
+        for worker in workers:
+            worker.start()
+        while len(results) < nb_workers:
+            try:
+                rank, result = queue.get(timeout=1)
+                results[rank] = result
+            except Empty:
+                failed = [rank for rank, worker in enumerate(workers) if worker.exitcode]
+                if failed:
+                    barrier.abort()
+                    raise RuntimeError('data-parallel workers %r failed' % failed)
+    finally:
+        for worker in workers:
+            worker.join()
+        shutil.rmtree(path_dir, ignore_errors=True)
+    return [results[rank] for rank in range(nb_workers)]
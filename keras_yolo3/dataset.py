@@ -0,0 +1,145 @@
+"""
+Index of annotated dataset
+
+The annotation file, with a line `image_path x_min,y_min,x_max,y_max,class_id ...`
+per image, is parsed just once into resolved image paths, all boxes in single
+int32 array and offsets of boxes of each image. The parsed index is cached
+next to the annotation file and refreshed when the annotation file changes.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from .utils import update_path
+
+#: suffix of the cached index next to the annotation file
+INDEX_SUFFIX = '.index.npz'
+# already loaded indexes, keyed by annotation path and its signature
+_LOADED_INDEXES = {}
+
+
+class DatasetIndex(object):
+    """Parsed dataset, items are tuples of image path and its boxes
+
+    >>> index = DatasetIndex.from_lines(['img1.jpg 10,20,30,40,1 50,60,70,80,0',
+    ...                                  'img2.jpg', 'img3.jpg 5,5,15,25,2'], resolve_paths=False)
+    >>> len(index), index.class_ids()
+    (3, [0, 1, 2])
+    >>> index[0]
+    ('img1.jpg', array([[10, 20, 30, 40,  1],
+           [50, 60, 70, 80,  0]], dtype=int32))
+    >>> index[1][1].shape
+    (0, 5)
+    >>> index.boxes_wh().tolist()
+    [[20, 20], [20, 20], [10, 20]]
+    """
+
+    def __init__(self, paths, boxes, offsets):
+        """
+
+        :param list(str) paths: image paths
+        :param ndarray boxes: boxes of all images in shape (N, 5)
+        :param ndarray offsets: boxes of image `i` are `boxes[offsets[i]:offsets[i + 1]]`
+        """
+        self.paths = list(paths)
+        self.boxes = np.asarray(boxes, dtype='int32').reshape(-1, 5)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        assert len(self.offsets) == len(self.paths) + 1, 'offsets do not match the paths'
+
+    @classmethod
+    def from_lines(cls, lines, resolve_paths=True):
+        """parse annotation lines
+
+        :param list(str) lines: annotation lines
+        :param bool resolve_paths: resolve image paths, see :func:`update_path`
+        :return DatasetIndex:
+        """
+        paths, boxes, counts = [], [], []
+        for line in lines:
+            line_split = line.split()
+            if not line_split:
+                continue
+            path = line_split[0]
+            paths.append(update_path(path) if resolve_paths else path)
+            bbs = [list(map(float, bbox.split(','))) for bbox in line_split[1:]]
+            boxes += bbs
+            counts.append(len(bbs))
+        offsets = np.concatenate([[0], np.cumsum(counts, dtype='int64')])
+        return cls(paths, np.array(boxes).astype(int), offsets)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return self.paths[idx], self.boxes[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def class_ids(self):
+        """sorted unique class IDs
+
+        :return list(int):
+        """
+        return sorted(np.unique(self.boxes[:, 4]).tolist())
+
+    def boxes_wh(self):
+        """width and height of all boxes
+
+        :return ndarray: shape (N, 2)
+        """
+        return np.abs(self.boxes[:, 2:4] - self.boxes[:, 0:2])
+
+
+def _file_signature(path_file):
+    # relative image paths are resolved with respect to the working directory
+    stat = os.stat(path_file)
+    return str(stat.st_size), str(stat.st_mtime_ns), os.getcwd()
+
+
+def load_dataset_index(path_annot, use_cache=True):
+    """load the dataset index, parse the annotation file only if needed
+
+    :param str path_annot: path to the annotation file
+    :param bool use_cache: use/write the cached index next to the annotation file
+    :return DatasetIndex:
+
+    >>> import tempfile
+    >>> path_annot = os.path.join(tempfile.mkdtemp(), 'dataset.txt')
+    >>> with open(path_annot, 'w') as fp:
+    ...     _ = fp.write('img1.jpg 10,20,30,40,1\\nimg2.jpg 5,5,15,25,2\\n')
+    >>> len(load_dataset_index(path_annot))
+    2
+    >>> os.path.isfile(path_annot + INDEX_SUFFIX)
+    True
+    >>> load_dataset_index(path_annot) is load_dataset_index(path_annot)
+    True
+    >>> import shutil
+    >>> shutil.rmtree(os.path.dirname(path_annot))
+    """
+    signature = _file_signature(path_annot)
+    key = (os.path.abspath(path_annot), signature)
+    if key in _LOADED_INDEXES:
+        return _LOADED_INDEXES[key]
+
+    path_index = path_annot + INDEX_SUFFIX
+    index = None
+    if use_cache and os.path.isfile(path_index):
+        with np.load(path_index) as data:
+            if tuple(data['signature'].tolist()) == signature:
+                index = DatasetIndex(data['paths'].tolist(), data['boxes'], data['offsets'])
+    if index is None:
+        logging.debug('parsing annotations from "%s"', path_annot)
+        with open(path_annot, 'r') as fp:
+            index = DatasetIndex.from_lines(fp.readlines())
+        if use_cache:
+            try:
+                with open(path_index, 'wb') as fp:
+                    np.savez(fp, paths=np.array(index.paths, dtype=str), boxes=index.boxes,
+                             offsets=index.offsets, signature=np.array(signature, dtype=str))
+            except IOError:
+                logging.warning('cannot write dataset index: %s', path_index)
+    _LOADED_INDEXES[key] = index
+    return index
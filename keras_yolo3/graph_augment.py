@@ -0,0 +1,361 @@
+"""
+Data augmentation and target encoding as TensorFlow operations
+
+Images are fed as uint8 together with boxes padded by zeros, either already fitted
+to the CNN input or placed on a canvas with their sizes, e.g. straight from the image
+cache, see :func:`keras_yolo3.utils.get_image_canvas`. Fitting to the CNN input,
+the random scale, shift, flips and colour jitter as well as encoding the training
+targets run inside the training graph, the image is resampled just once.
+The CNN input size is either fixed or an int32 variable, so the same graph
+serves several resolutions, e.g. stages of the resolution schedule.
+"""
+
+import tensorflow as tf
+import keras.backend as K
+from keras.layers import Input, Lambda
+from keras.models import Model
+
+from .utils import get_anchor_mask
+
+#: grey filling the image outside of the original, as in :func:`keras_yolo3.utils._scale_image_to_cnn`
+FILL_VALUE = 128 / 255.
+#: parameters of :func:`keras_yolo3.utils.get_augmented_data` performed in the graph
+GRAPH_AUGMENT_PARAMS = ('img_scaling', 'allow_rnd_shift', 'hue', 'sat', 'val',
+                        'flip_horizontal', 'flip_vertical', 'bbox_overlap')
+
+
+def _size_wh(input_shape):
+    """CNN input size as float (width, height), from a tuple or an int32 tensor (height, width)"""
+    return tf.cast(input_shape, tf.float32)[::-1]
+
+
+def _static_size(input_shape):
+    """CNN input size known when the graph is built, None for a tensor
+
+    >>> _static_size((416, 320)), _static_size(tf.constant([416, 320]))
+    ((416, 320), (None, None))
+    """
+    if isinstance(input_shape, (tuple, list)):
+        return tuple(input_shape)
+    return None, None
+
+
+def _random_uniform(shape, low, high):
+    """the same range as :func:`keras_yolo3.utils._rand`"""
+    return tf.random_uniform(shape, min(low, high), max(low, high))
+
+
+def random_geometry(batch_size, input_shape, img_scaling=1.2, allow_rnd_shift=True,
+                    flip_horizontal=True, flip_vertical=False):
+    """draw random scale, shift and flips of each image in the batch
+
+    :param tensor batch_size: number of images
+    :param tuple(int,int)|tensor input_shape: CNN input size
+    :param float img_scaling: upper image scaling
+    :param bool allow_rnd_shift: allow shifting image not only centered crop
+    :param bool flip_horizontal: allow random flip image/boxes horizontal
+    :param bool flip_vertical: allow random flip image/boxes vertical
+    :return tuple(tensor,tensor,tensor): scales (B, ), shifts in pixels (B, 2)
+        and flips (B, 2) for axes x and y
+    """
+    canvas = _size_wh(input_shape)[None, :]
+    scales = _random_uniform([batch_size], 1 - abs(1 - img_scaling), img_scaling)
+    diff = canvas - scales[:, None] * canvas
+    if allow_rnd_shift:
+        # larger image is shifted at most by half of the difference, see `_image_shift`
+        diff = tf.where(diff < 0, diff / 2., diff)
+        shifts = tf.random_uniform(tf.shape(diff)) * diff
+    else:
+        shifts = diff / 2.
+    flips = tf.logical_and(tf.random_uniform([batch_size, 2]) < 0.5,
+                           tf.constant([[flip_horizontal, flip_vertical]]))
+    return scales, shifts, flips
+
+
+def _fit_geometry(image_sizes, input_shape):
+    """scale and centered offset fitting images to the CNN input,
+    as :func:`keras_yolo3.utils._scale_image_to_cnn` without shifting
+
+    :param tensor image_sizes: image sizes as (height, width), shape (B, 2)
+    :param tuple(int,int)|tensor input_shape: CNN input size
+    :return tuple(tensor,tensor): scales (B, ) and offsets in pixels (B, 2) for axes x and y
+    """
+    canvas = _size_wh(input_shape)[None, :]
+    sizes_wh = tf.cast(image_sizes, tf.float32)[:, ::-1]
+    fits = tf.reduce_min(canvas / sizes_wh, axis=1)
+    offsets = tf.floor((canvas - tf.floor(sizes_wh * fits[:, None])) / 2.)
+    return fits, offsets
+
+
+def _crop_windows(scales, shifts, flips, input_shape, fits=None, offsets=None, source_shape=None):
+    """windows of :func:`tf.image.crop_and_resize` for the given geometry
+
+    An output pixel `p` is taken from the fitted image pixel `q = (p - shift) / scale`,
+    which is the source pixel `(q - offset) / fit`, flipping just swaps the window borders.
+    Without fitting the source is the fitted image itself.
+    """
+    size = _size_wh(input_shape)[None, :] - 1
+    mins = -shifts / scales[:, None]
+    maxs = (size - shifts) / scales[:, None]
+    if fits is not None:
+        mins = (mins - offsets) / fits[:, None]
+        maxs = (maxs - offsets) / fits[:, None]
+        size = tf.cast(source_shape[::-1], tf.float32)[None, :] - 1
+    mins, maxs = mins / size, maxs / size
+    starts = tf.where(flips, maxs, mins)
+    ends = tf.where(flips, mins, maxs)
+    return tf.stack([starts[:, 1], starts[:, 0], ends[:, 1], ends[:, 0]], axis=1)
+
+
+def _transform_boxes(boxes, scales, shifts, flips, input_shape, bbox_overlap=0.95):
+    """move the boxes with the images, boxes mostly cut off are replaced by zeros
+
+    the same as :func:`keras_yolo3.utils.adjust_bboxes` but keeping the padded shape
+    """
+    canvas = _size_wh(input_shape)
+    scales = scales[:, None, None]
+    flips = tf.cast(flips, tf.float32)[:, None, :]
+    xy_min = boxes[..., 0:2] * scales + shifts[:, None, :]
+    xy_max = boxes[..., 2:4] * scales + shifts[:, None, :]
+    xy_min, xy_max = (1 - flips) * xy_min + flips * (canvas - xy_max), \
+        (1 - flips) * xy_max + flips * (canvas - xy_min)
+    xy_min = tf.clip_by_value(xy_min, 0., canvas)
+    xy_max = tf.clip_by_value(xy_max, 0., canvas)
+
+    sizes = tf.reduce_prod(boxes[..., 2:4] - boxes[..., 0:2], axis=-1) * scales[..., 0] ** 2
+    new_sizes = tf.reduce_prod(xy_max - xy_min, axis=-1)
+    keep = tf.cast(new_sizes > sizes * bbox_overlap, tf.float32)
+    return tf.concat([xy_min, xy_max, boxes[..., 4:5]], axis=-1) * keep[..., None]
+
+
+def augment_color(images, hue=.1, sat=1.5, val=1.5):
+    """random colour of each image in HSV spectrum, see :func:`keras_yolo3.utils.augment_image_color`
+
+    :param tensor images: images in range (0, 1), shape (B, H, W, 3)
+    :param float hue: range in +/-
+    :param float sat: greater then 1
+    :param float val: greater then 1
+    :return tensor:
+    """
+    batch_size = tf.shape(images)[0]
+    img_hsv = tf.image.rgb_to_hsv(images)
+    hue = _random_uniform([batch_size, 1, 1], -hue, hue)
+    sat = _random_uniform([batch_size, 1, 1], 1 - abs(1 - sat), sat)
+    val = _random_uniform([batch_size, 1, 1], 1 - abs(1 - val), val)
+    img_hsv = tf.stack([tf.floormod(img_hsv[..., 0] + hue, 1.),
+                        tf.clip_by_value(img_hsv[..., 1] * sat, 0., 1.),
+                        tf.clip_by_value(img_hsv[..., 2] * val, 0., 1.)], axis=-1)
+    return tf.image.hsv_to_rgb(img_hsv)
+
+
+def _fit_boxes(boxes, fits, offsets):
+    """move the boxes from the source image to the fitted one, the padding stays zero"""
+    valid = tf.cast(boxes[..., 2] > boxes[..., 0], tf.float32)[..., None]
+    offsets = tf.tile(offsets, [1, 2])[:, None, :]
+    xy = boxes[..., :4] * fits[:, None, None] + offsets
+    return tf.concat([xy, boxes[..., 4:]], axis=-1) * valid
+
+
+def _warp_batch(images, boxes, input_shape, scales, shifts, flips, image_sizes=None,
+                bbox_overlap=0.95):
+    """resample the images and move the boxes with a single crop and resize"""
+    batch_size = tf.shape(images)[0]
+    images = tf.cast(images, tf.float32) / 255.
+    boxes = tf.cast(boxes, tf.float32)
+    fits = offsets = source_shape = None
+    if image_sizes is not None:
+        fits, offsets = _fit_geometry(image_sizes, input_shape)
+        source_shape = tf.shape(images)[1:3]
+        boxes = _fit_boxes(boxes, fits, offsets)
+    windows = _crop_windows(scales, shifts, flips, input_shape, fits, offsets, source_shape)
+    images = tf.image.crop_and_resize(images, windows, tf.range(batch_size), input_shape,
+                                      extrapolation_value=FILL_VALUE)
+    boxes = _transform_boxes(boxes, scales, shifts, flips, input_shape, bbox_overlap)
+    return images, boxes
+
+
+def augment_batch(images, boxes, input_shape, img_scaling=1.2, allow_rnd_shift=True,
+                  hue=.1, sat=1.5, val=1.5, flip_horizontal=True, flip_vertical=False,
+                  bbox_overlap=0.95, image_sizes=None):
+    """random augmentation of a batch, the counterpart of :func:`keras_yolo3.utils.get_augmented_data`
+
+    :param tensor images: uint8 images fitted to the CNN input, shape (B, H, W, 3),
+        or canvases with images in the top-left corner if `image_sizes` are given
+    :param tensor boxes: boxes in pixels padded by zeros, shape (B, T, 5)
+    :param tuple(int,int)|tensor input_shape: CNN input size
+    :param tensor|None image_sizes: sizes of images on the canvases as (height, width), shape (B, 2)
+    :return tuple(tensor,tensor): images in range (0, 1) and boxes
+    """
+    scales, shifts, flips = random_geometry(tf.shape(images)[0], input_shape, img_scaling,
+                                            allow_rnd_shift, flip_horizontal, flip_vertical)
+    images, boxes = _warp_batch(images, boxes, input_shape, scales, shifts, flips,
+                                image_sizes, bbox_overlap)
+    images = augment_color(images, hue, sat, val)
+    return images, boxes
+
+
+def fit_batch(images, boxes, input_shape, image_sizes):
+    """fit images on canvases to the CNN input centered without augmentation,
+    the same as :func:`keras_yolo3.utils.get_augmented_data` with `augment=False`
+
+    :param tensor images: uint8 canvases with images in the top-left corner, shape (B, H, W, 3)
+    :param tensor boxes: boxes in pixels padded by zeros, shape (B, T, 5)
+    :param tuple(int,int)|tensor input_shape: CNN input size
+    :param tensor image_sizes: sizes of images on the canvases as (height, width), shape (B, 2)
+    :return tuple(tensor,tensor): images in range (0, 1) and boxes
+
+    >>> import os
+    >>> import numpy as np
+    >>> from keras_yolo3.utils import update_path, get_image_canvas, get_augmented_data
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> line = path_img + ' 100,150,200,250,0 300,50,400,200,1'
+    >>> canvas, size, boxes = get_image_canvas(line, 520)
+    >>> images, boxes = fit_batch(canvas[None], boxes[None].astype('float32'), (416, 416), size[None])
+    >>> with tf.Session() as sess:
+    ...     images, boxes = sess.run([images, boxes])
+    >>> image_ref, boxes_ref = get_augmented_data(line, (416, 416), augment=False,
+    ...                                           allow_rnd_shift=False)
+    >>> sort_class = lambda b: b[np.argsort(b[:2, 4])]
+    >>> np.allclose(sort_class(boxes[0]), sort_class(boxes_ref), atol=1)
+    True
+    >>> bool(np.abs(images[0] - image_ref / 255.).mean() < 0.05)
+    True
+    """
+    batch_size = tf.shape(images)[0]
+    scales = tf.ones([batch_size])
+    shifts = tf.zeros([batch_size, 2])
+    flips = tf.zeros([batch_size, 2], dtype=tf.bool)
+    return _warp_batch(images, boxes, input_shape, scales, shifts, flips, image_sizes, bbox_overlap=0.)
+
+
+def preprocess_true_boxes_graph(true_boxes, input_shape, anchors, num_classes):
+    """encode the boxes to training targets, the same as :func:`keras_yolo3.utils.preprocess_true_boxes`
+
+    :param tensor true_boxes: boxes in pixels padded by zeros, shape (B, T, 5)
+    :param tuple(int,int)|tensor input_shape: CNN input size, multiples of 32
+    :param ndarray anchors: shape (N, 2), wh
+    :param int num_classes:
+    :return list(tensor): targets for each output layer
+
+    >>> import os
+    >>> import numpy as np
+    >>> from keras_yolo3.utils import update_path, get_anchors, preprocess_true_boxes
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> bboxes = np.array([[[100, 150, 200, 250, 0], [300, 50, 400, 200, 1], [0, 0, 0, 0, 0]],
+    ...                    [[0, 0, 0, 0, 0], [10, 20, 60, 80, 4], [12, 22, 60, 80, 3]]])
+    >>> y_true = preprocess_true_boxes_graph(tf.constant(bboxes, tf.float32), (416, 416), anchors, 5)
+    >>> size = tf.constant([416, 416])
+    >>> y_dynamic = preprocess_true_boxes_graph(tf.constant(bboxes, tf.float32), size, anchors, 5)
+    >>> with tf.Session() as sess:
+    ...     y_true, y_dynamic = sess.run([y_true, y_dynamic])
+    >>> all(np.allclose(y1, y2) for y1, y2 in zip(
+    ...     y_true, preprocess_true_boxes(bboxes, (416, 416), anchors, 5)))
+    True
+    >>> all(np.array_equal(y1, y2) for y1, y2 in zip(y_true, y_dynamic))
+    True
+    """
+    num_layers = len(anchors) // 3  # default setting
+    anchor_mask = get_anchor_mask(num_layers)
+    cnn_h, cnn_w = input_shape[0], input_shape[1]
+    static_h, static_w = _static_size(input_shape)
+    canvas = _size_wh(input_shape)
+    anchors = tf.constant(anchors, dtype=tf.float32)
+
+    true_boxes = tf.cast(true_boxes, tf.float32)
+    batch_size = tf.shape(true_boxes)[0]
+    boxes_xy = tf.floor((true_boxes[..., 0:2] + true_boxes[..., 2:4]) / 2.) / canvas
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    boxes = tf.concat([boxes_xy, boxes_wh / canvas], axis=-1)
+    classes = tf.cast(true_boxes[..., 4], tf.int32)
+    valid = boxes_wh[..., 0] > 0
+
+    # Boxes and anchors share the center, so the intersection is given by sizes.
+    intersect_wh = tf.maximum(tf.minimum(boxes_wh[..., None, :], anchors), 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = boxes_wh[..., 0:1] * boxes_wh[..., 1:2]
+    anchor_area = anchors[:, 0] * anchors[:, 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
+    best_anchor = tf.cast(tf.argmax(iou, axis=-1), tf.int32)
+
+    # box `t` is dropped if any later box lands in the same cell, as when looping over them
+    positions = tf.range(tf.shape(true_boxes)[1])
+    later = positions[None, :] > positions[:, None]
+
+    y_true = []
+    for l in range(num_layers):
+        stride = {0: 32, 1: 16, 2: 8}[l]
+        grid_h, grid_w = cnn_h // stride, cnn_w // stride
+        match = tf.equal(best_anchor[..., None], tf.constant(anchor_mask[l]))
+        in_layer = tf.logical_and(tf.reduce_any(match, axis=-1), valid)
+        k = tf.cast(tf.argmax(tf.cast(match, tf.int32), axis=-1), tf.int32)
+        # float64 as in numpy, so boxes on cell borders fall to the same cell
+        grid_wh = tf.cast(tf.stack([grid_w, grid_h]), tf.float64)
+        i = tf.cast(tf.floor(tf.cast(boxes[..., 0], tf.float64) * grid_wh[0]), tf.int32)
+        j = tf.cast(tf.floor(tf.cast(boxes[..., 1], tf.float64) * grid_wh[1]), tf.int32)
+
+        cells = (j * grid_w + i) * len(anchor_mask[l]) + k
+        overwritten = tf.logical_and(tf.equal(cells[:, :, None], cells[:, None, :]),
+                                     tf.logical_and(in_layer[:, None, :], later))
+        keep = tf.logical_and(in_layer, tf.logical_not(tf.reduce_any(overwritten, axis=-1)))
+        shape = tf.stack([batch_size, grid_h, grid_w, len(anchor_mask[l]), 5 + num_classes])
+
+        def _scatter(mask, values):
+            sel = tf.where(mask)
+            indices = tf.stack([tf.cast(sel[:, 0], tf.int32), tf.gather_nd(j, sel),
+                                tf.gather_nd(i, sel), tf.gather_nd(k, sel)], axis=1)
+            return tf.scatter_nd(indices, tf.gather_nd(values, sel), shape)
+
+        # the last box in a cell sets the box, classes of all boxes in the cell are kept
+        classes_hot = tf.one_hot(classes, num_classes)
+        boxes_obj = tf.concat([boxes, tf.ones_like(boxes[..., :1]), tf.zeros_like(classes_hot)], axis=-1)
+        classes_hot = tf.concat([tf.zeros_like(boxes), tf.zeros_like(boxes[..., :1]), classes_hot], axis=-1)
+        y = _scatter(keep, boxes_obj) + tf.minimum(_scatter(in_layer, classes_hot), 1.)
+        y.set_shape([None, static_h and static_h // stride, static_w and static_w // stride,
+                     len(anchor_mask[l]), 5 + num_classes])
+        y_true.append(y)
+    return y_true
+
+
+def create_model_graph_augment(model, input_shape, anchors, num_classes, max_boxes=20, **kwargs):
+    """wrap the training model with augmentation and target encoding in the graph
+
+    The new model takes uint8 canvases with images, their sizes and boxes padded
+    to `max_boxes`, see :func:`keras_yolo3.utils.get_image_canvas`. The images are
+    fitted to the CNN input and augmented only in the training phase.
+
+    :param Model model: training model, see :func:`keras_yolo3.model.create_model`
+    :param tuple(int,int)|Variable input_shape: CNN input size, or int32 variable
+        with the size, which may change between fits if the model takes any size
+    :param ndarray anchors:
+    :param int num_classes:
+    :param int max_boxes: maximal number of boxes per image
+    :param kwargs: parameters of :func:`augment_batch`
+    :return Model:
+    """
+    cnn_h, cnn_w = _static_size(input_shape)
+    image_input = Input(shape=(None, None, 3), dtype='uint8')
+    sizes_input = Input(shape=(2, ))
+    boxes_input = Input(shape=(max_boxes, 5))
+
+    def _prepare_batch(inputs):
+        images, image_sizes, boxes = inputs
+
+        def _augment():
+            return augment_batch(images, boxes, input_shape, image_sizes=image_sizes, **kwargs)
+
+        def _plain():
+            return fit_batch(images, boxes, input_shape, image_sizes)
+
+        training = K.learning_phase()
+        if isinstance(training, int):
+            images, boxes = _augment() if training else _plain()
+        else:
+            images, boxes = tf.cond(tf.cast(training, tf.bool), _augment, _plain)
+        images.set_shape([None, cnn_h, cnn_w, 3])
+        return [images] + preprocess_true_boxes_graph(boxes, input_shape, anchors, num_classes)
+
+    prepared = Lambda(_prepare_batch, name='graph_augment')([image_input, sizes_input, boxes_input])
+    model_loss = model(prepared)
+    # keep the loss name, so the model is compiled the same way as the wrapped one
+    model_loss = Lambda(lambda x: x, name='yolo_loss')(model_loss)
+    return Model([image_input, sizes_input, boxes_input], model_loss)
@@ -0,0 +1,224 @@
+"""
+Persistent cache of decoded training images
+
+Each image is decoded once, downscaled to a bounded maximal side and stored
+as raw uint8 pixels in a single binary file, which is memory-mapped while
+training, so reading a sample is just a view into the page cache.
+The index keeps offset, shape and scale of each image together with size
+and modification time of the source file, so changed images are detected.
+"""
+
+import os
+import logging
+
+import numpy as np
+import tqdm
+from PIL import Image
+from pathos.multiprocessing import ProcessPool
+
+from .utils import image_open, update_path, nb_workers
+
+#: file with raw pixels inside the cache folder
+NAME_DATA = 'images.bin'
+#: file with the image index inside the cache folder
+NAME_INDEX = 'index.npz'
+
+
+def _file_signature(path_img):
+    stat = os.stat(path_img)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _decode_image(path_img, max_side=None):
+    """decode image to RGB and downscale it to fit the maximal side
+
+    :return tuple(ndarray,float): image as (H, W, 3) uint8 and applied scale
+    """
+    image = image_open(path_img).convert('RGB')
+    scale = 1.
+    if max_side and max(image.size) > max_side:
+        scale = float(max_side) / max(image.size)
+        size = tuple(max(1, int(round(s * scale))) for s in image.size)
+        # the true scale after rounding, boxes are scaled by width
+        scale = float(size[0]) / image.size[0]
+        image = image.resize(size, Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8), scale
+
+
+class ImageCache(object):
+    """Read-only memory-mapped store of decoded images
+
+    The source files are checked once when the cache is opened, entries of
+    changed or missing images are dropped, so a lookup is just a dictionary
+    and offset access without touching the file system.
+
+    >>> import tempfile
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> path_cache = tempfile.mkdtemp()
+    >>> build_image_cache([path_img], path_cache, max_side=260)
+    1
+    >>> cache = ImageCache(path_cache)
+    >>> img, scale = cache.get(path_img)
+    >>> img.shape, img.dtype, round(scale, 3)
+    ((259, 260, 3), dtype('uint8'), 0.5)
+    >>> len(cache), cache.get('missing.jpg')
+    (1, None)
+    >>> from keras_yolo3.utils import get_augmented_data
+    >>> line = path_img + ' 100,150,200,250,0 300,50,400,200,1'
+    >>> _, box_data = get_augmented_data(line, (416, 416), augment=False,
+    ...                                  allow_rnd_shift=False, image_cache=cache)
+    >>> box_data[np.argsort(box_data[:2, 4])]
+    array([[ 80., 121., 160., 201.,   0.],
+           [240.,  41., 320., 161.,   1.]])
+    >>> import shutil
+    >>> shutil.rmtree(path_cache)
+    """
+
+    def __init__(self, path_cache, check_source=True):
+        """
+
+        :param str path_cache: folder with the cache, see :func:`build_image_cache`
+        :param bool check_source: drop entries whose source file has changed since caching
+        """
+        self.path_cache = path_cache
+        with np.load(os.path.join(path_cache, NAME_INDEX)) as index:
+            self._paths = index['paths'].tolist()
+            self._offsets = index['offsets']
+            self._shapes = index['shapes']
+            self._scales = index['scales']
+            self._signatures = index['signatures']
+            self.max_side = int(index['max_side']) or None
+        self._index = {p: i for i, p in enumerate(self._paths)}
+        if check_source:
+            self._drop_outdated()
+        # resolved paths as they come from annotations, filled lazily
+        self._aliases = {}
+        self._data = None
+
+    def __len__(self):
+        # outdated entries are dropped from the index only
+        return len(self._index)
+
+    def __contains__(self, path_img):
+        return self._lookup(path_img) is not None
+
+    def _drop_outdated(self):
+        outdated = [p for p, i in self._index.items()
+                    if not os.path.isfile(p) or _file_signature(p) != tuple(self._signatures[i])]
+        for path_img in outdated:
+            logging.debug('outdated cache entry for "%s"', path_img)
+            del self._index[path_img]
+        if outdated:
+            logging.warning('%i of %i cached images are outdated and they are skipped',
+                            len(outdated), len(self._paths))
+
+    def _lookup(self, path_img):
+        idx = self._index.get(path_img)
+        if idx is None:
+            if path_img not in self._aliases:
+                self._aliases[path_img] = self._index.get(update_path(path_img))
+            idx = self._aliases[path_img]
+        return idx
+
+    def __getstate__(self):
+        # workers reopen the mapping, so the pixels are never pickled
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def _mapping(self):
+        if self._data is None:
+            path_data = os.path.join(self.path_cache, NAME_DATA)
+            self._data = np.memmap(path_data, dtype=np.uint8, mode='r') \
+                if os.path.getsize(path_data) else np.zeros(0, dtype=np.uint8)
+        return self._data
+
+    def get(self, path_img):
+        """get cached image
+
+        :param str path_img: path to the original image
+        :return tuple(ndarray,float)|None: read-only image (H, W, 3) and its scale
+            with respect to the original image, None if missing or outdated
+        """
+        idx = self._lookup(path_img)
+        if idx is None:
+            return None
+        begin, end = self._offsets[idx], self._offsets[idx + 1]
+        img = self._mapping()[begin:end].reshape(self._shapes[idx])
+        return img, float(self._scales[idx])
+
+
+def _cache_entry(path_img, max_side):
+    signature = _file_signature(path_img)
+    img, scale = _decode_image(path_img, max_side)
+    return img, scale, signature
+
+
+def build_image_cache(paths_images, path_cache, max_side=1024, nb_threads=1):
+    """decode images and write them to the cache, valid entries of already
+    existing cache are reused and only new or changed images are decoded
+
+    :param list(str) paths_images: paths to images
+    :param str path_cache: output folder
+    :param int|None max_side: maximal image side in pixels, None to keep original size
+    :param float|int nb_threads: nb processes decoding images in parallel
+    :return int: number of cached images
+    """
+    if not os.path.isdir(path_cache):
+        os.makedirs(path_cache)
+    paths_images = sorted(set(update_path(p) for p in paths_images))
+    paths_images = [p for p in paths_images if os.path.isfile(p)]
+    old_cache = None
+    if os.path.isfile(os.path.join(path_cache, NAME_INDEX)):
+        old_cache = ImageCache(path_cache, check_source=False)
+        if old_cache.max_side != max_side:
+            logging.info('maximal side has changed, rebuilding whole cache')
+            old_cache = None
+
+    def _is_valid(path_img):
+        if old_cache is None or path_img not in old_cache._index:
+            return False
+        idx = old_cache._index[path_img]
+        return tuple(old_cache._signatures[idx]) == _file_signature(path_img)
+
+    valid = [_is_valid(p) for p in paths_images]
+    paths_decode = [p for p, v in zip(paths_images, valid) if not v]
+    logging.info('caching %i images, %i reused from existing cache',
+                 len(paths_decode), len(paths_images) - len(paths_decode))
+    nb_threads = nb_workers(nb_threads)
+    pool = ProcessPool(nb_threads) if nb_threads > 1 else None
+    map_process = pool.imap if pool else map
+    decoded = map_process(lambda p: _cache_entry(p, max_side), paths_decode)
+
+    offsets, shapes, scales, signatures = [0], [], [], []
+    path_tmp = os.path.join(path_cache, NAME_DATA + '.tmp')
+    with open(path_tmp, 'wb') as fp:
+        for path_img, is_valid in tqdm.tqdm(zip(paths_images, valid), desc='caching images',
+                                            total=len(paths_images)):
+            if is_valid:
+                img, scale = old_cache.get(path_img)
+                signature = _file_signature(path_img)
+            else:
+                img, scale, signature = next(decoded)
+            fp.write(np.ascontiguousarray(img).tobytes())
+            offsets.append(offsets[-1] + img.size)
+            shapes.append(img.shape)
+            scales.append(scale)
+            signatures.append(signature)
+    if pool:
+        pool.close()
+        pool.join()
+        pool.clear()
+    path_index_tmp = os.path.join(path_cache, NAME_INDEX + '.tmp')
+    with open(path_index_tmp, 'wb') as fp:
+        np.savez(fp, paths=np.array(paths_images, dtype=str),
+                 offsets=np.array(offsets, dtype='int64'),
+                 shapes=np.array(shapes, dtype='int32').reshape(-1, 3),
+                 scales=np.array(scales, dtype='float64'),
+                 signatures=np.array(signatures, dtype='int64').reshape(-1, 2),
+                 max_side=max_side or 0)
+    # release the old mapping before it is replaced
+    old_cache = None
+    os.replace(path_tmp, os.path.join(path_cache, NAME_DATA))
+    os.replace(path_index_tmp, os.path.join(path_cache, NAME_INDEX))
+    return len(paths_images)
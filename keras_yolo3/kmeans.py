@@ -7,7 +7,8 @@ import logging
 
 import numpy as np
 import pandas as pd
-import tqdm
+
+from .dataset import load_dataset_index
 
 
 class YOLO_Kmeans:
@@ -85,17 +86,7 @@ class YOLO_Kmeans:
         pd.DataFrame(data, dtype=int).to_csv(path_csv, header=None, index=None)
 
     def txt2boxes(self):
-        with open(self.filename, 'r') as fp:
-            lines = fp.readlines()
-        dataset = []
-        for line in tqdm.tqdm(lines, desc='Extract bboxes'):
-            infos = line.strip().split(' ')
-            for bbox in infos[1:]:
-                box = list(map(float, bbox.split(',')))
-                width = abs(box[2] - box[0])
-                height = abs(box[3] - box[1])
-                dataset.append([width, height])
-        bboxes_wh = np.array(dataset)
+        bboxes_wh = load_dataset_index(self.filename).boxes_wh().astype(float)
         return bboxes_wh
 
     def txt2clusters(self, path_out):
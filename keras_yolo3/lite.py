@@ -0,0 +1,232 @@
+"""
+Export of YOLO model to TensorFlow Lite and light-weight detector using just TFLite interpreter
+
+The exported flatbuffer contains the CNN body together with the box decoding
+(`yolo_head` and `yolo_correct_boxes`), so it returns boxes in image coordinates
+with per-class scores. The remaining score filtering and non-maximum suppression
+is cheap and it is done in numpy by :class:`YOLOLite`.
+
+The runner does not need the full TensorFlow, the `tflite_runtime` package is sufficient.
+"""
+
+import time
+import logging
+
+import numpy as np
+
+from .utils import (
+    letterbox_image, update_path, get_class_names, get_anchors, image_open,
+    non_max_suppression, format_predictions, get_anchor_mask)
+from .visual import draw_predictions, generate_class_colors
+
+#: supported weights quantization
+QUANTIZATIONS = (None, 'float16', 'int8')
+#: name of the graph input with original image size
+INPUT_IMAGE_SHAPE = 'image_shape'
+
+
+def _interpreter_class():
+    """get TFLite interpreter, prefer the light runtime over full TensorFlow"""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def _representative_dataset(paths_images, model_image_size):
+    """generate calibration samples for full integer quantization
+
+    :param list(str) paths_images: images used for calibration
+    :param tuple(int,int) model_image_size: CNN input size as (height, width)
+    """
+    for path_img in paths_images:
+        image = image_open(path_img).convert('RGB')
+        boxed_image = letterbox_image(image, tuple(reversed(model_image_size)))
+        image_data = np.expand_dims(np.array(boxed_image, dtype='float32') / 255., 0)
+        yield [image_data, np.array([image.size[1], image.size[0]], dtype='float32')]
+
+
+def export_tflite(path_weights, path_anchors, path_classes, path_output,
+                  model_image_size=(416, 416), quantization=None, paths_calibration=None):
+    """convert Keras YOLO model with embedded box decoding to TFLite flatbuffer
+
+    :param str path_weights: path to Keras model or weights, e.g. 'model_data/tiny-yolo.h5'
+    :param str path_anchors: path to model anchors, e.g. 'model_data/tiny-yolo_anchors.csv'
+    :param str path_classes: path to trained classes, e.g. 'model_data/coco_classes.txt'
+    :param str path_output: path to the exported `.tflite` model
+    :param tuple(int,int) model_image_size: fixed CNN input size as (height, width)
+    :param str|None quantization: weights quantization, one of `QUANTIZATIONS`
+    :param list(str) paths_calibration: images for calibration of full int8 quantization,
+        without them only the weights are quantized
+    :return str: path to exported model
+
+    >>> import os
+    >>> import keras.backend as K
+    >>> from keras.layers import Input
+    >>> from keras_yolo3.model import yolo_body_tiny
+    >>> path_anchors = os.path.join(update_path('model_data'), 'tiny-yolo_anchors.csv')
+    >>> path_classes = os.path.join(update_path('model_data'), 'coco_classes.txt')
+    >>> yolo_empty = yolo_body_tiny(Input(shape=(None, None, 3)), 3, 80)
+    >>> path_model = os.path.join(update_path('model_data'), 'yolo_empty.h5')
+    >>> yolo_empty.save(path_model)
+    >>> path_lite = export_tflite(path_model, path_anchors, path_classes,
+    ...                           os.path.join(update_path('model_data'), 'yolo_empty.tflite'),
+    ...                           model_image_size=(224, 224), quantization='float16')
+    >>> yolo = YOLOLite(path_lite, path_classes)
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> yolo.detect_image(image_open(path_img))  # doctest: +ELLIPSIS
+    (<PIL.JpegImagePlugin.JpegImageFile image mode=RGB size=520x518 at ...>, [...])
+    >>> from keras_yolo3.cache import CachedYOLO, DetectionCache
+    >>> CachedYOLO(yolo, DetectionCache()).detect_file(path_img, render=False)  # doctest: +ELLIPSIS
+    (<PIL.JpegImagePlugin.JpegImageFile image mode=RGB size=520x518 at ...>, [...])
+    >>> os.remove(path_lite)
+    >>> K.clear_session()
+    """
+    import tensorflow as tf
+    import keras.backend as K
+    from keras.layers import Input
+    from .model import yolo_body_full, yolo_body_tiny, yolo_boxes_scores
+
+    assert quantization in QUANTIZATIONS, 'unsupported quantization: %s' % quantization
+    assert all(model_image_size), 'TFLite requires static input size, got %r' % (model_image_size, )
+    for size in model_image_size:
+        assert size % 32 == 0, 'Multiples of 32 required'
+
+    anchors = get_anchors(update_path(path_anchors))
+    num_classes = len(get_class_names(update_path(path_classes)))
+    num_anchors = len(anchors)
+    num_layers = num_anchors // 3  # default setting
+    anchor_mask = get_anchor_mask(num_layers)
+
+    K.clear_session()
+    K.set_learning_phase(0)
+    image_input = Input(shape=(model_image_size[0], model_image_size[1], 3))
+    if num_layers == 2:
+        yolo_model = yolo_body_tiny(image_input, num_anchors // 2, num_classes)
+    else:
+        yolo_model = yolo_body_full(image_input, num_anchors // 3, num_classes)
+    yolo_model.load_weights(update_path(path_weights), by_name=True, skip_mismatch=True)
+    logging.info('loaded model, anchors (%i), and classes (%i) from %s',
+                 num_anchors, num_classes, path_weights)
+
+    # embed the box decoding, so the interpreter returns boxes in image coordinates
+    image_shape = K.placeholder(shape=(2, ), name=INPUT_IMAGE_SHAPE)
+    input_shape = K.constant(model_image_size, dtype='float32')
+    boxes, box_scores = [], []
+    for l in range(num_layers):
+        _boxes, _box_scores = yolo_boxes_scores(yolo_model.output[l], anchors[anchor_mask[l]],
+                                                num_classes, input_shape, image_shape)
+        boxes.append(_boxes)
+        box_scores.append(_box_scores)
+    boxes = K.concatenate(boxes, axis=0)
+    box_scores = K.concatenate(box_scores, axis=0)
+
+    converter = tf.lite.TFLiteConverter.from_session(
+        K.get_session(), [yolo_model.input, image_shape], [boxes, box_scores])
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.lite.constants.FLOAT16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if paths_calibration:
+            converter.representative_dataset = \
+                lambda: _representative_dataset(paths_calibration, model_image_size)
+    tflite_model = converter.convert()
+
+    with open(path_output, 'wb') as fp:
+        fp.write(tflite_model)
+    logging.info('exported TFLite model (%i kB) to "%s"', len(tflite_model) // 1024, path_output)
+    return path_output
+
+
+class YOLOLite(object):
+    """YOLO detector running the exported TFLite model
+
+    It returns the same output as :meth:`keras_yolo3.yolo.YOLO.detect_image`,
+    see :func:`export_tflite` for an example.
+    """
+
+    def __init__(self, path_model, classes_path, score=0.3, iou=0.45, max_boxes=20, nb_threads=None):
+        """
+
+        :param str path_model: path to exported model, e.g. 'model_data/tiny-yolo.tflite'
+        :param str classes_path: path to loaded trained classes, e.g. 'model_data/coco_classes.txt'
+        :param float score: confidence score
+        :param float iou: overlap threshold for non-maximum suppression
+        :param int max_boxes: maximal number of detections per class
+        :param int|None nb_threads: number of interpreter threads
+        """
+        self.path_model = update_path(path_model)
+        self.classes_path = update_path(classes_path)
+        self.score = score
+        self.iou = iou
+        self.max_boxes = max_boxes
+
+        self.class_names = get_class_names(self.classes_path)
+        self.colors = generate_class_colors(len(self.class_names))
+
+        Interpreter = _interpreter_class()
+        try:
+            self.interpreter = Interpreter(model_path=self.path_model, num_threads=nb_threads)
+        except TypeError:  # older interpreters do not support threads
+            self.interpreter = Interpreter(model_path=self.path_model)
+        self.interpreter.allocate_tensors()
+
+        inputs = self.interpreter.get_input_details()
+        self._input_image = [d for d in inputs if len(d['shape']) == 4][0]
+        self._input_shape = [d for d in inputs if len(d['shape']) == 1][0]
+        # the outputs keep the order given in export: boxes and box scores
+        self._output_boxes, self._output_scores = self.interpreter.get_output_details()[:2]
+        self.model_image_size = tuple(self._input_image['shape'][1:3])
+        logging.info('loaded TFLite model with input %r from %s',
+                     self.model_image_size, self.path_model)
+
+    def _filter_boxes(self, boxes, box_scores):
+        """per class score filtering and non-maximum suppression, mirror of `yolo_eval`"""
+        out_boxes, out_scores, out_classes = [], [], []
+        for c in range(box_scores.shape[-1]):
+            mask = box_scores[:, c] >= self.score
+            if not np.any(mask):
+                continue
+            class_boxes = boxes[mask]
+            class_scores = box_scores[mask, c]
+            nms_index = non_max_suppression(class_boxes, class_scores,
+                                            self.max_boxes, self.iou)
+            out_boxes.append(class_boxes[nms_index])
+            out_scores.append(class_scores[nms_index])
+            out_classes.append(np.full(len(nms_index), c, dtype=int))
+        if not out_boxes:
+            return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=int)
+        return np.concatenate(out_boxes), np.concatenate(out_scores), np.concatenate(out_classes)
+
+    def detect_image(self, image, render=True):
+        """detect objects in single image, as :meth:`keras_yolo3.yolo.YOLO.detect_image`
+
+        :param Image image: input image
+        :param bool render: draw the detections to the image
+        :return tuple(Image,list(dict)): image and predictions
+        """
+        start = time.time()
+        boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
+        image_data = np.array(boxed_image, dtype=self._input_image['dtype'])
+        if image_data.dtype != np.uint8:
+            image_data /= 255.
+        image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
+
+        self.interpreter.set_tensor(self._input_image['index'], image_data)
+        self.interpreter.set_tensor(self._input_shape['index'],
+                                    np.array([image.size[1], image.size[0]], dtype='float32'))
+        self.interpreter.invoke()
+        boxes = self.interpreter.get_tensor(self._output_boxes['index'])
+        box_scores = self.interpreter.get_tensor(self._output_scores['index'])
+        out_boxes, out_scores, out_classes = self._filter_boxes(boxes, box_scores)
+
+        end = time.time()
+        logging.debug('Found %i boxes in %f sec.', len(out_boxes), (end - start))
+
+        predicts = format_predictions(out_boxes, out_scores, out_classes, self.class_names)
+        if render:
+            draw_predictions(image, predicts, self.colors)
+        return image, predicts
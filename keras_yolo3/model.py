@@ -18,7 +18,7 @@ from keras.models import Model
 from keras.regularizers import l2
 from keras.utils import multi_gpu_model
 
-from keras_yolo3.utils import compose, update_path
+from keras_yolo3.utils import compose, update_path, get_anchor_mask, SPARSE_TARGET_COLUMNS
 
 
 @wraps(Conv2D)
@@ -149,12 +149,51 @@ def yolo_body_tiny(inputs, num_anchors, num_classes):
     return Model(inputs, [y1, y2])
 
 
+def layer_shape(feats, stride=1):
+    """spatial size (height, width) of the layer multiplied by `stride`
+
+    :return ndarray|tensor: numpy array if the size is static, tensor otherwise
+
+    >>> layer_shape(Input(shape=(13, 13, 21)), 32)
+    array([416, 416])
+    >>> layer_shape(Input(shape=(None, None, 21)), 32)  # doctest: +ELLIPSIS
+    <tf.Tensor 'mul...' shape=(2,) dtype=int32>
+    """
+    shape = K.int_shape(feats)[1:3]
+    if None in shape:
+        return K.shape(feats)[1:3] * stride
+    return np.array(shape) * stride
+
+
 def yolo_head(feats, anchors, num_classes, input_shape, calc_loss=False):
-    """Convert final layer features to bounding box parameters."""
+    """Convert final layer features to bounding box parameters.
+
+    With static layer size and `input_shape` as numpy array, see :func:`layer_shape`,
+    the grid offsets and scales are constants, otherwise they are built from the tensor shape.
+
+    >>> feats = np.random.RandomState(0).randn(2, 13, 13, 21).astype('float32')
+    >>> anchors = np.array([[10, 13], [16, 30], [33, 23]])
+    >>> static = yolo_head(K.constant(feats), anchors, 2, np.array([416, 416]))
+    >>> placeholder = K.placeholder((None, None, None, 21))
+    >>> dynamic = yolo_head(placeholder, anchors, 2, layer_shape(placeholder, 32))
+    >>> static = K.get_session().run(static)
+    >>> dynamic = K.get_session().run(dynamic, feed_dict={placeholder: feats})
+    >>> all(np.array_equal(a, b) for a, b in zip(static, dynamic))
+    True
+    """
     num_anchors = len(anchors)
     # Reshape to batch, height, width, num_anchors, box_params.
     anchors_tensor = K.reshape(K.constant(anchors), [1, 1, 1, num_anchors, 2])
 
+    grid_h, grid_w = K.int_shape(feats)[1:3]
+    if grid_h and grid_w and isinstance(input_shape, np.ndarray):
+        grid = np.stack(np.meshgrid(np.arange(grid_w), np.arange(grid_h)), axis=-1)
+        grid = K.constant(grid[:, :, np.newaxis, :], dtype=K.dtype(feats))
+        feats = K.reshape(feats, [-1, grid_h, grid_w, num_anchors, num_classes + 5])
+        grid_scale = K.constant([grid_w, grid_h], dtype=K.dtype(feats))
+        input_scale = K.constant(input_shape[::-1], dtype=K.dtype(feats))
+        return _yolo_head_boxes(feats, grid, grid_scale, anchors_tensor, input_scale, calc_loss)
+
     grid_shape = K.shape(feats)[1:3]  # height, width
     grid_y = K.tile(K.reshape(K.arange(0, stop=grid_shape[0]), [-1, 1, 1, 1]),
                     [1, grid_shape[1], 1, 1])
@@ -166,9 +205,15 @@ def yolo_head(feats, anchors, num_classes, input_shape, calc_loss=False):
     feats = K.reshape(feats, [-1, grid_shape[0], grid_shape[1],
                               num_anchors, num_classes + 5])
 
+    grid_scale = K.cast(grid_shape[::-1], K.dtype(feats))
+    input_scale = K.cast(input_shape[::-1], K.dtype(feats))
+    return _yolo_head_boxes(feats, grid, grid_scale, anchors_tensor, input_scale, calc_loss)
+
+
+def _yolo_head_boxes(feats, grid, grid_scale, anchors_tensor, input_scale, calc_loss=False):
     # Adjust predictions to each spatial grid point and anchor size.
-    box_xy = (K.sigmoid(feats[..., :2]) + grid) / K.cast(grid_shape[::-1], K.dtype(feats))
-    box_wh = K.exp(feats[..., 2:4]) * anchors_tensor / K.cast(input_shape[::-1], K.dtype(feats))
+    box_xy = (K.sigmoid(feats[..., :2]) + grid) / grid_scale
+    box_wh = K.exp(feats[..., 2:4]) * anchors_tensor / input_scale
     box_confidence = K.sigmoid(feats[..., 4:5])
     box_class_probs = K.sigmoid(feats[..., 5:])
 
@@ -218,9 +263,8 @@ def yolo_eval(yolo_outputs, anchors, num_classes, image_shape, max_boxes=20,
               score_threshold=.6, iou_threshold=.5):
     """Evaluate YOLO model on given input and return filtered boxes."""
     num_layers = len(yolo_outputs)
-    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]] \
-        if num_layers == 3 else [[3, 4, 5], [1, 2, 3]]  # default setting
-    input_shape = K.shape(yolo_outputs[0])[1:3] * 32
+    anchor_mask = get_anchor_mask(num_layers)
+    input_shape = layer_shape(yolo_outputs[0], 32)
     boxes = []
     box_scores = []
     for l in range(num_layers):
@@ -423,15 +467,17 @@ def box_iou_xywh(tensor1, tensor2):
     array([0.1764706], dtype=float32)
     """
     # Expand dim to apply broadcasting.
-    tensor1 = K.expand_dims(tensor1, -2)
+    return _box_iou_xywh_broadcast(K.expand_dims(tensor1, -2), K.expand_dims(tensor2, 0))
+
+
+def _box_iou_xywh_broadcast(tensor1, tensor2):
+    """iou of boxes in xywh with shapes broadcasted to each other"""
     b1_xy = tensor1[..., :2]
     b1_wh = tensor1[..., 2:4]
     b1_wh_half = b1_wh / 2.
     b1_mins = b1_xy - b1_wh_half
     b1_maxes = b1_xy + b1_wh_half
 
-    # Expand dim to apply broadcasting.
-    tensor2 = K.expand_dims(tensor2, 0)
     b2_xy = tensor2[..., :2]
     b2_wh = tensor2[..., 2:4]
     b2_wh_half = b2_wh / 2.
@@ -449,7 +495,7 @@ def box_iou_xywh(tensor1, tensor2):
     return iou
 
 
-def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
+def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False, vectorized=True):
     """Return yolo_loss tensor
 
     Parameters
@@ -459,20 +505,34 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
     anchors: array, shape=(N, 2), wh
     num_classes: integer
     ignore_thresh: float, the iou threshold whether to ignore object confidence loss
+    vectorized: bool, ignore mask for the whole batch at once, otherwise looping over images
 
     Returns
     -------
     loss: tensor, shape=(1,)
 
+    Example
+    -------
+    >>> from keras_yolo3.utils import get_anchors, preprocess_true_boxes
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> np.random.seed(0)
+    >>> xy = np.random.randint(0, 300, (4, 20, 2))
+    >>> bboxes = np.concatenate([xy, xy + np.random.randint(1, 100, (4, 20, 2)),
+    ...                          np.random.randint(0, 5, (4, 20, 1))], axis=-1)
+    >>> bboxes[0, 5:], bboxes[2] = 0, 0
+    >>> args = ([K.constant(np.random.randn(4, s, s, 30)) for s in (13, 26, 52)]
+    ...         + [K.constant(y) for y in preprocess_true_boxes(bboxes, (416, 416), anchors, 5)])
+    >>> losses = K.batch_get_value([yolo_loss(args, anchors, 5, ignore_thresh=.1),
+    ...                             yolo_loss(args, anchors, 5, ignore_thresh=.1, vectorized=False)])
+    >>> np.allclose(*losses)
+    True
     """
     num_layers = len(anchors) // 3  # default setting
     yolo_outputs = args[:num_layers]
     y_true = args[num_layers:]
-    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]] \
-        if num_layers == 3 else [[3, 4, 5], [0, 1, 2]]
-    input_shape = K.cast(K.shape(yolo_outputs[0])[1:3] * 32,
-                         K.dtype(y_true[0]))
-    grid_shapes = [K.cast(K.shape(yolo_outputs[l])[1:3], K.dtype(y_true[0]))
+    anchor_mask = get_anchor_mask(num_layers)
+    input_shape = layer_shape(yolo_outputs[0], 32)
+    grid_shapes = [K.cast(layer_shape(yolo_outputs[l]), K.dtype(y_true[0]))
                    for l in range(num_layers)]
     loss = 0
     m = K.shape(yolo_outputs[0])[0]  # batch size, tensor
@@ -490,7 +550,8 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
 
         # Darknet raw box to calculate loss.
         raw_true_xy = y_true[l][..., :2] * grid_shapes[l][::-1] - grid
-        raw_true_wh = K.log(y_true[l][..., 2:4] / anchors[anchor_mask[l]] * input_shape[::-1])
+        input_scale = K.cast(input_shape[::-1], K.dtype(y_true[0]))
+        raw_true_wh = K.log(y_true[l][..., 2:4] / anchors[anchor_mask[l]] * input_scale)
         # Keras switch allows scalr condition, bit here is expected to have elemnt-wise
         #  also the `object_mask` has in last dimension 1 but the in/out puts has 2 (some replication)
         # raw_true_wh = tf.where(tf.greater(K.concatenate([object_mask] * 2), 0),
@@ -499,23 +560,8 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
                                K.zeros_like(raw_true_wh))  # avoid log(0)=-inf
         box_loss_scale = 2 - y_true[l][..., 2:3] * y_true[l][..., 3:4]
 
-        # Find ignore mask, iterate over each of batch.
-        ignore_mask = tf.TensorArray(K.dtype(y_true[0]), size=1, dynamic_size=True)
-        object_mask_bool = K.cast(object_mask, 'bool')
-
-        def _loop_body(b, ignore_mask):
-            true_box = tf.boolean_mask(y_true[l][b, ..., 0:4],
-                                       object_mask_bool[b, ..., 0])
-            iou = box_iou_xywh(pred_box[b], true_box)
-            best_iou = K.max(iou, axis=-1)
-            ignore_mask = ignore_mask.write(b, K.cast(best_iou < ignore_thresh,
-                                                      K.dtype(true_box)))
-            return b + 1, ignore_mask
-
-        _, ignore_mask = K.control_flow_ops.while_loop(
-            lambda b, *args: b < m, _loop_body, [0, ignore_mask])
-        ignore_mask = ignore_mask.stack()
-        ignore_mask = K.expand_dims(ignore_mask, -1)
+        _ignore_mask = _ignore_mask_dense if vectorized else _ignore_mask_loop
+        ignore_mask = _ignore_mask(pred_box, y_true[l], ignore_thresh)
 
         # K.binary_crossentropy is helpful to avoid exp overflow.
         ce = K.binary_crossentropy(raw_true_xy, raw_pred[..., 0:2],
@@ -542,9 +588,206 @@ def yolo_loss(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
     return K.expand_dims(loss, axis=0)
 
 
+def _ignore_mask_loop(pred_box, y_true, ignore_thresh):
+    """Reference ignore mask of :func:`yolo_loss` iterating over the batch
+
+    It is kept for testing and benchmarking the vectorized version.
+    """
+    m = K.shape(y_true)[0]
+    ignore_mask = tf.TensorArray(K.dtype(y_true), size=1, dynamic_size=True)
+    object_mask_bool = K.cast(y_true[..., 4:5], 'bool')
+
+    def _loop_body(b, ignore_mask):
+        true_box = tf.boolean_mask(y_true[b, ..., 0:4], object_mask_bool[b, ..., 0])
+        iou = box_iou_xywh(pred_box[b], true_box)
+        best_iou = K.max(iou, axis=-1)
+        ignore_mask = ignore_mask.write(b, K.cast(best_iou < ignore_thresh, K.dtype(true_box)))
+        return b + 1, ignore_mask
+
+    _, ignore_mask = tf.while_loop(lambda b, *args: b < m, _loop_body, [0, ignore_mask])
+    ignore_mask = ignore_mask.stack()
+    return K.expand_dims(ignore_mask, -1)
+
+
+def _ignore_mask_dense(pred_box, y_true, ignore_thresh):
+    """ignore mask of :func:`yolo_loss` for the whole batch at once
+
+    The true boxes of each image are gathered from the dense targets and padded
+    to the largest number of boxes in the batch.
+
+    >>> from keras_yolo3.utils import get_anchors, preprocess_true_boxes
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> np.random.seed(0)
+    >>> xy = np.random.randint(0, 300, (4, 20, 2))
+    >>> bboxes = np.concatenate([xy, xy + np.random.randint(1, 100, (4, 20, 2)),
+    ...                          np.zeros((4, 20, 1))], axis=-1)
+    >>> bboxes[0, 5:], bboxes[2] = 0, 0
+    >>> y_true = K.constant(preprocess_true_boxes(bboxes, (416, 416), anchors, 1)[1])
+    >>> pred_box = K.constant(np.random.rand(4, 26, 26, 3, 4) * [1, 1, .3, .3])
+    >>> masks = K.batch_get_value([_ignore_mask_dense(pred_box, y_true, .5),
+    ...                            _ignore_mask_loop(pred_box, y_true, .5)])
+    >>> masks[0].shape, masks[0].sum() < masks[0].size, np.array_equal(*masks)
+    ((4, 26, 26, 3, 1), True, True)
+    """
+    m = K.shape(y_true)[0]
+    true_flat = K.reshape(y_true[..., :5], [m, -1, 5])
+    # the cells with objects are moved to the front, the rest is padding
+    nb_true = K.cast(K.max(K.sum(true_flat[..., 4], axis=1)), 'int32')
+    present, true_idx = tf.nn.top_k(true_flat[..., 4], k=nb_true)
+    batch_idx = K.tile(K.expand_dims(K.arange(0, m), 1), [1, nb_true])
+    true_box = tf.gather_nd(true_flat[..., :4], K.stack([batch_idx, true_idx], axis=-1))
+    return _ignore_mask_padded(pred_box, true_box, present > 0, ignore_thresh)
+
+
+def _ignore_mask_padded(pred_box, true_box, true_valid, ignore_thresh):
+    """mask of predictions overlapping no true box of the same image enough
+
+    :param tensor pred_box: predicted boxes, shape (m, h, w, A, 4), xywh
+    :param tensor true_box: true boxes padded to the same number, shape (m, T, 4), xywh
+    :param tensor true_valid: bool mask of not padded true boxes, shape (m, T)
+    :param float ignore_thresh: the iou threshold
+    :return tensor: shape (m, h, w, A, 1)
+    """
+    # padded boxes are zeroed, so they do not overlap any prediction
+    true_box = true_box * K.expand_dims(K.cast(true_valid, K.dtype(true_box)), -1)
+    # all predictions of an image against all its true boxes at once
+    true_box = K.reshape(true_box, [-1, 1, 1, 1, K.shape(true_box)[1], 4])
+    iou = _box_iou_xywh_broadcast(K.expand_dims(pred_box, -2), true_box)
+    best_iou = K.max(iou, axis=-1)
+    return K.expand_dims(K.cast(best_iou < ignore_thresh, K.dtype(iou)), -1)
+
+
+def yolo_loss_sparse(args, anchors, num_classes, ignore_thresh=0.5, print_loss=False):
+    """Return yolo_loss tensor for sparse training targets
+
+    The box and class losses are computed just for predictions gathered from
+    the cells with true boxes, the object mask is scattered from the same cells.
+    It gives the same loss as :func:`yolo_loss` on the dense targets.
+
+    Parameters
+    ----------
+    yolo_outputs: list of tensor, the output of yolo_body_full or yolo_body_tiny
+    true_records: tensor, shape=(m, T, 9), the output of preprocess_true_boxes_sparse
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
+    ignore_thresh: float, the iou threshold whether to ignore object confidence loss
+
+    Returns
+    -------
+    loss: tensor, shape=(1,)
+
+    Example
+    -------
+    >>> from keras_yolo3.utils import get_anchors, preprocess_true_boxes, preprocess_true_boxes_sparse
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> np.random.seed(0)
+    >>> xy = np.random.randint(0, 300, (2, 20, 2))
+    >>> bboxes = np.concatenate([xy, xy + np.random.randint(1, 100, (2, 20, 2)),
+    ...                          np.random.randint(0, 5, (2, 20, 1))], axis=-1)
+    >>> bboxes[0, 12:] = 0
+    >>> bboxes[1, 3] = bboxes[1, 4]  # two boxes in the same cell
+    >>> outputs = [K.constant(np.random.randn(2, s, s, 30)) for s in (13, 26, 52)]
+    >>> loss_dense = yolo_loss(outputs + [K.constant(y) for y in preprocess_true_boxes(
+    ...     bboxes, (416, 416), anchors, 5)], anchors, 5)
+    >>> loss_sparse = yolo_loss_sparse(outputs + [K.constant(preprocess_true_boxes_sparse(
+    ...     bboxes, (416, 416), anchors, 5))], anchors, 5)
+    >>> np.allclose(K.eval(loss_dense), K.eval(loss_sparse))
+    True
+
+    The same for the tiny model with two output layers
+
+    >>> outputs = [K.constant(np.random.randn(2, s, s, 30)) for s in (13, 26)]
+    >>> loss_dense = yolo_loss(outputs + [K.constant(y) for y in preprocess_true_boxes(
+    ...     bboxes, (416, 416), anchors[:6], 5)], anchors[:6], 5)
+    >>> loss_sparse = yolo_loss_sparse(outputs + [K.constant(preprocess_true_boxes_sparse(
+    ...     bboxes, (416, 416), anchors[:6], 5))], anchors[:6], 5)
+    >>> np.allclose(K.eval(loss_dense), K.eval(loss_sparse))
+    True
+    """
+    num_layers = len(anchors) // 3  # default setting
+    yolo_outputs = args[:num_layers]
+    true_records = args[num_layers]
+    anchor_mask = get_anchor_mask(num_layers)
+    dtype = K.dtype(yolo_outputs[0])
+    input_shape = layer_shape(yolo_outputs[0], 32)
+    loss = 0
+    m = K.shape(yolo_outputs[0])[0]  # batch size, tensor
+    mf = K.cast(m, dtype)
+    nb_boxes = K.shape(true_records)[1]
+
+    cells = K.cast(true_records[..., 0:4], 'int32')  # layer, cell_y, cell_x, anchor
+    true_box = true_records[..., 4:8]
+    true_class_probs = K.one_hot(K.cast(true_records[..., 8], 'int32'), num_classes)
+    batch_idx = K.tile(K.reshape(K.arange(0, m), [-1, 1, 1]), [1, nb_boxes, 1])
+    positions = K.arange(0, nb_boxes)
+    later = K.reshape(positions, [1, 1, -1]) > K.reshape(positions, [1, -1, 1])
+    same_position = K.all(K.equal(K.expand_dims(cells[..., 1:], 2), K.expand_dims(cells[..., 1:], 1)),
+                          axis=-1)
+
+    for l in range(num_layers):
+        in_layer = K.equal(cells[..., 0], l)
+        # for boxes in the same cell the last one wins, classes of all of them are kept
+        same_cell = same_position & K.expand_dims(in_layer, 2) & K.expand_dims(in_layer, 1)
+        is_last = in_layer & ~K.any(same_cell & later, axis=-1)
+        box_mask = K.expand_dims(K.cast(is_last, dtype), -1)
+        # indexes to gather predictions of the cells, boxes of other layers read the first one
+        pred_idx = K.concatenate([batch_idx, cells[..., 1:4] * K.expand_dims(K.cast(in_layer, 'int32'))])
+        cell_class_probs = K.minimum(tf.matmul(K.cast(same_cell, dtype), true_class_probs), 1.)
+
+        grid, raw_pred, pred_xy, pred_wh = yolo_head(yolo_outputs[l],
+                                                     anchors[anchor_mask[l]],
+                                                     num_classes, input_shape,
+                                                     calc_loss=True)
+        pred_box = K.concatenate([pred_xy, pred_wh])
+        raw_pred_cells = tf.gather_nd(raw_pred, pred_idx)
+        grid_shape = K.cast(layer_shape(yolo_outputs[l]), dtype)
+
+        # Darknet raw box to calculate loss.
+        raw_true_xy = true_box[..., :2] * grid_shape[::-1] - K.cast(cells[..., 2:0:-1], dtype)
+        cell_anchors = K.gather(K.constant(anchors[anchor_mask[l]]), pred_idx[..., 3])
+        raw_true_wh = K.log(true_box[..., 2:4] / cell_anchors * K.cast(input_shape[::-1], dtype))
+        raw_true_wh = tf.where(K.tile(K.expand_dims(is_last, -1), [1, 1, 2]), raw_true_wh,
+                               K.zeros_like(raw_true_wh))  # avoid log(0)=-inf
+        box_loss_scale = 2 - true_box[..., 2:3] * true_box[..., 3:4]
+
+        object_idx = tf.boolean_mask(pred_idx, is_last)
+        object_mask = tf.scatter_nd(object_idx, K.ones_like(object_idx[:, 0], dtype=dtype),
+                                    K.shape(raw_pred)[:4])
+        object_mask = K.expand_dims(object_mask, -1)
+        ignore_mask = _ignore_mask_padded(pred_box, true_box, is_last, ignore_thresh)
+
+        # K.binary_crossentropy is helpful to avoid exp overflow.
+        ce = K.binary_crossentropy(raw_true_xy, raw_pred_cells[..., 0:2], from_logits=True)
+        xy_loss = box_mask * box_loss_scale * ce
+        wh_loss = box_mask * box_loss_scale * 0.5 * K.square(raw_true_wh - raw_pred_cells[..., 2:4])
+        ce_loss = K.binary_crossentropy(object_mask, raw_pred[..., 4:5], from_logits=True)
+        confidence_loss = object_mask * ce_loss + (1 - object_mask) * ce_loss * ignore_mask
+        class_loss = box_mask * K.binary_crossentropy(cell_class_probs, raw_pred_cells[..., 5:],
+                                                      from_logits=True)
+
+        xy_loss = K.sum(xy_loss) / mf
+        wh_loss = K.sum(wh_loss) / mf
+        confidence_loss = K.sum(confidence_loss) / mf
+        class_loss = K.sum(class_loss) / mf
+        loss += xy_loss + wh_loss + confidence_loss + class_loss
+        if print_loss:
+            loss = tf.Print(loss, [loss, xy_loss, wh_loss, confidence_loss,
+                                   class_loss, K.sum(ignore_mask)],
+                            message='loss: ')
+    return K.expand_dims(loss, axis=0)
+
+
 def create_model(input_shape, anchors, num_classes, weights_path=None, model_factor=3,
-                 freeze_body=2, ignore_thresh=0.5, nb_gpu=1):
-    """create the training model"""
+                 freeze_body=2, ignore_thresh=0.5, nb_gpu=1, sparse_targets=False, max_boxes=20,
+                 recompute_body=False):
+    """create the training model
+
+    :param tuple(int|None,int|None) input_shape: CNN input size, `(None, None)` for any size
+    :param bool sparse_targets: take targets as records of boxes padded to `max_boxes`,
+        see :func:`keras_yolo3.utils.preprocess_true_boxes_sparse`
+    :param bool recompute_body: keep just outputs of residual blocks for the backward pass,
+        the model gets `checkpoint_layers` for :func:`keras_yolo3.optimizers.create_optimizer`
+    """
     _INPUT_SHAPES = {0: 32, 1: 16, 2: 8, 3: 4}
     _FACTOR_YOLO_BODY = {2: yolo_body_tiny, 3: yolo_body_full}
     _FACTOR_FREEZEING = {2: 20, 3: 185}
@@ -579,13 +822,16 @@ def create_model(input_shape, anchors, num_classes, weights_path=None, model_fac
             for i in range(num):
                 model_body.layers[i].trainable = False
 
-    model_loss_fn = Lambda(yolo_loss, output_shape=(1,), name='yolo_loss',
-                           arguments=_LOSS_ARGUMENTS)
-    y_true = [Input(shape=(cnn_h // {i: _INPUT_SHAPES[i] for i in range(model_factor)}[l],
-                           cnn_w // {i: _INPUT_SHAPES[i] for i in range(model_factor)}[l],
+    model_loss_fn = Lambda(yolo_loss_sparse if sparse_targets else yolo_loss,
+                           output_shape=(1,), name='yolo_loss', arguments=_LOSS_ARGUMENTS)
+    # the image size may be undefined, e.g. for training at several resolutions
+    y_true = [Input(shape=(cnn_h // _INPUT_SHAPES[l] if cnn_h else None,
+                           cnn_w // _INPUT_SHAPES[l] if cnn_w else None,
                            num_anchors // model_factor,
                            num_classes + 5))
               for l in range(model_factor)]
+    if sparse_targets:
+        y_true = [Input(shape=(max_boxes, len(SPARSE_TARGET_COLUMNS)))]
     model_loss = model_loss_fn([*model_body.output, *y_true])
     model = Model([model_body.input, *y_true], model_loss)
 
@@ -594,15 +840,20 @@ def create_model(input_shape, anchors, num_classes, weights_path=None, model_fac
     if nb_gpu >= 2:
         model = multi_gpu_model(model, gpus=nb_gpu)
 
+    # the residual blocks of the Darknet body, the tiny body has none
+    model.checkpoint_layers = [layer for layer in model_body.layers
+                               if isinstance(layer, Add)] if recompute_body else []
     return model
 
 
 def create_model_tiny(input_shape, anchors, num_classes, weights_path=None,
-                      freeze_body=2, ignore_thresh=0.5, nb_gpu=1):
+                      freeze_body=2, ignore_thresh=0.5, nb_gpu=1, sparse_targets=False, max_boxes=20,
+                      recompute_body=False):
     """create the training model, for Tiny YOLOv3 """
 
     return create_model(input_shape, anchors, num_classes, weights_path, model_factor=2,
-                        freeze_body=freeze_body, ignore_thresh=ignore_thresh, nb_gpu=nb_gpu)
+                        freeze_body=freeze_body, ignore_thresh=ignore_thresh, nb_gpu=nb_gpu,
+                        sparse_targets=sparse_targets, max_boxes=max_boxes, recompute_body=recompute_body)
 
 
 def create_model_bottleneck(input_shape, anchors, num_classes, freeze_body=2,
@@ -0,0 +1,205 @@
+"""
+Optimizers of the training model
+
+Mixed precision uses the automatic graph rewrite of TensorFlow (>= 1.14), on GPUs
+supporting float16 the convolutions run in float16 while the weights are kept
+in float32 and the loss is scaled dynamically, so small gradients do not underflow.
+Numerically sensitive operations as in `yolo_loss` stay float32. On CPU the graph
+is not rewritten, so the same training runs in float32, just slowly.
+The rewrite applies only to sessions created after it is enabled, so the Keras
+session is set by :func:`mixed_precision_session` before any model is built.
+
+Gradient accumulation averages gradients of several small batches before
+the weights are updated, so the update is as for a batch several times larger
+than fits to the memory. Note that BatchNorm still sees just the small batches.
+
+Recomputing activations, see :mod:`keras_yolo3.recompute`, replaces the gradients
+of the optimizer, so the update itself stays the same.
+"""
+
+import logging
+
+import tensorflow as tf
+import keras.backend as K
+from tensorflow.core.protobuf import rewriter_config_pb2
+from keras.optimizers import Adam, TFOptimizer
+from keras.legacy import interfaces
+
+from .recompute import gradients_recompute, layers_outputs
+
+
+def _mixed_precision_rewrite():
+    experimental = getattr(tf.train, 'experimental', None)
+    rewrite = getattr(experimental, 'enable_mixed_precision_graph_rewrite', None)
+    assert rewrite is not None, 'mixed precision requires TensorFlow >= 1.14'
+    return rewrite
+
+
+def mixed_precision_session(config=None):
+    """session running its graph rewritten to mixed precision, set it as the Keras session
+    before the model is built and its weights are loaded
+
+    :param config: TensorFlow session configuration
+    :return: TensorFlow session
+    """
+    _mixed_precision_rewrite()
+    config = config or tf.ConfigProto()
+    config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    return tf.Session(config=config)
+
+
+def is_mixed_precision_session(session=None):
+    """check whether the session rewrites its graph to mixed precision
+
+    :param session: TensorFlow session, the Keras session by default
+    :return bool:
+
+    >>> is_mixed_precision_session(mixed_precision_session())
+    True
+    """
+    session = session or K.get_session()
+    # sessions made after enabling the rewrite globally get the option too
+    config = getattr(session, '_config', None)
+    if config is None:
+        return False
+    options = config.graph_options.rewrite_options
+    return options.auto_mixed_precision == rewriter_config_pb2.RewriterConfig.ON
+
+
+class AdamAccumulate(Adam):
+    """Adam updating the weights by mean gradients of `accum_iters` batches
+
+    >>> import numpy as np
+    >>> from keras.models import Sequential
+    >>> from keras.layers import Dense
+    >>> x = np.random.RandomState(0).rand(4, 3)
+    >>> y = x.sum(axis=1, keepdims=True)
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> weights = model.get_weights()
+    >>> model.compile(optimizer=AdamAccumulate(lr=0.1), loss='mse')
+    >>> _ = model.train_on_batch(x, y)
+    >>> weights_batch = model.get_weights()
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> model.set_weights(weights)
+    >>> model.compile(optimizer=AdamAccumulate(lr=0.1, accum_iters=2), loss='mse')
+    >>> _ = model.train_on_batch(x[:2], y[:2])
+    >>> all(np.array_equal(w1, w2) for w1, w2 in zip(weights, model.get_weights()))
+    True
+    >>> _ = model.train_on_batch(x[2:], y[2:])
+    >>> all(np.allclose(w1, w2) for w1, w2 in zip(weights_batch, model.get_weights()))
+    True
+    """
+
+    def __init__(self, lr=0.001, accum_iters=1, **kwargs):
+        """
+
+        :param float lr: learning rate
+        :param int accum_iters: number of batches accumulated for a single update
+        :param kwargs: parameters of :class:`keras.optimizers.Adam`
+        """
+        assert accum_iters >= 1, 'at least one batch has to be accumulated'
+        super(AdamAccumulate, self).__init__(lr=lr, **kwargs)
+        self.accum_iters = accum_iters
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        iterations = K.update_add(self.iterations, 1)
+        self.updates = [iterations]
+        # read the counter after the increment, otherwise the order of both is not defined
+        with tf.control_dependencies([iterations]):
+            iterations = tf.identity(self.iterations)
+
+        # the moments and weights change just with the last accumulated batch
+        is_update = K.cast(K.equal(iterations % self.accum_iters, 0), K.floatx())
+        # the step of Adam, kept positive also for the batches between updates
+        t = K.cast(K.maximum(iterations // self.accum_iters, 1), K.floatx())
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr = lr * (1. / (1. + self.decay * (t - 1)))
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        gs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        if self.amsgrad:
+            vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        else:
+            vhats = [K.zeros(1) for _ in params]
+        self.weights = [self.iterations] + ms + vs + vhats + gs
+
+        for p, g, m, v, vhat, g_sum in zip(params, grads, ms, vs, vhats, gs):
+            g_sum_t = g_sum + g
+            g_t = g_sum_t / self.accum_iters
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g_t
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g_t)
+            if self.amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                self.updates.append(K.update(vhat, is_update * vhat_t + (1 - is_update) * vhat))
+            else:
+                p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+
+            self.updates.append(K.update(m, is_update * m_t + (1 - is_update) * m))
+            self.updates.append(K.update(v, is_update * v_t + (1 - is_update) * v))
+            # the sum starts again after the update
+            self.updates.append(K.update(g_sum, (1 - is_update) * g_sum_t))
+            new_p = p_t
+
+            # Apply constraints.
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+
+            self.updates.append(K.update(p, is_update * new_p + (1 - is_update) * p))
+        return self.updates
+
+    def get_config(self):
+        config = {'accum_iters': self.accum_iters}
+        base_config = super(AdamAccumulate, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def _recompute_gradients(optimizer, checkpoint_layers):
+    """gradients of the optimizer keep just outputs of the checkpoint layers from the forward pass"""
+    def get_gradients(loss, params):
+        grads = gradients_recompute(loss, params, layers_outputs(checkpoint_layers))
+        assert None not in grads, 'some of trainable weights do not affect the loss'
+        return grads
+
+    optimizer.get_gradients = get_gradients
+    return optimizer
+
+
+def create_optimizer(lr=1e-3, mixed_precision=False, accum_iters=1, checkpoint_layers=None):
+    """create Adam optimizer, optionally training in mixed precision or accumulating gradients
+
+    :param float lr: learning rate
+    :param bool mixed_precision: float16 compute with float32 weights and dynamic loss scaling
+    :param int accum_iters: number of batches accumulated for a single update
+    :param list|None checkpoint_layers: recompute activations between outputs of these layers
+        in the backward pass, see `checkpoint_layers` of :func:`keras_yolo3.model.create_model`
+    :return: Keras optimizer
+    """
+    if checkpoint_layers:
+        assert not mixed_precision, 'recomputing activations is not supported in mixed precision'
+        logging.info('recomputing activations between %i checkpoints', len(checkpoint_layers))
+    if accum_iters > 1:
+        assert not mixed_precision, 'gradient accumulation is not supported in mixed precision'
+        logging.info('accumulating gradients of %i batches', accum_iters)
+        optimizer = AdamAccumulate(lr=lr, accum_iters=accum_iters)
+        return _recompute_gradients(optimizer, checkpoint_layers) if checkpoint_layers else optimizer
+    if not mixed_precision:
+        optimizer = Adam(lr=lr)
+        return _recompute_gradients(optimizer, checkpoint_layers) if checkpoint_layers else optimizer
+    logging.info('training in mixed precision with dynamic loss scaling')
+    lr_var = K.variable(lr, name='lr')
+    optimizer = tf.train.AdamOptimizer(learning_rate=lr_var, epsilon=K.epsilon())
+    optimizer = _mixed_precision_rewrite()(optimizer, loss_scale='dynamic')
+    optimizer = TFOptimizer(optimizer)
+    # callbacks as ReduceLROnPlateau change the learning rate of Keras optimizers
+    optimizer.lr = lr_var
+    if not is_mixed_precision_session():
+        logging.warning('the Keras session was created before enabling mixed precision,'
+                        ' its graph is not rewritten, see `mixed_precision_session`')
+    return optimizer
@@ -0,0 +1,361 @@
+"""
+Consolidated storage of detections for many images
+
+Instead of a CSV file per image all predictions are kept in a single store,
+either append-friendly JSON Lines (`.jsonl`) or compressed columnar numpy
+archive (`.npz`) with an image index (offsets of each image in the columns).
+"""
+
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .utils import PREDICT_FIELDS
+
+#: supported formats of the prediction store
+STORE_FORMATS = ('jsonl', 'npz')
+#: numerical columns of the store and their types
+STORE_COLUMNS = (('class', 'int32'), ('confidence', 'float32'), ('ymin', 'int32'),
+                 ('xmin', 'int32'), ('ymax', 'int32'), ('xmax', 'int32'))
+
+
+def image_name(path_image):
+    """name of image used as key in the store, the same as for per-image CSV
+
+    >>> image_name('/data/images/bike-car-dog.jpg')
+    'bike-car-dog'
+    """
+    return os.path.splitext(os.path.basename(path_image))[0]
+
+
+def _truncate_partial_line(path_file, chunk_size=4096):
+    """drop unfinished last line left by an interrupted run
+
+    >>> path_file = './sample_partial.jsonl'
+    >>> with open(path_file, 'w') as fp:
+    ...     _ = fp.write('{"image": "img1"}\\n{"ima')
+    >>> _truncate_partial_line(path_file)
+    >>> open(path_file).read()
+    '{"image": "img1"}\\n'
+    >>> os.remove(path_file)
+    """
+    with open(path_file, 'rb+') as fp:
+        end = fp.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(chunk_size, pos)
+            fp.seek(pos - step)
+            idx = fp.read(step).rfind(b'\n')
+            if idx >= 0:
+                pos = pos - step + idx + 1
+                break
+            pos -= step
+        if pos < end:
+            logging.warning('dropping unfinished last line of "%s"', path_file)
+            fp.truncate(pos)
+
+
+class JsonLinesWriter(object):
+    """Append predictions as one JSON line per image
+
+    An unfinished last line, e.g. from an interrupted run, is dropped on open.
+
+    >>> path_store = './sample_predictions.jsonl'
+    >>> with JsonLinesWriter(path_store) as writer:
+    ...     writer.write('img1', [{'class': 1, 'label': 'dog', 'confidence': 0.8,
+    ...                            'ymin': 10, 'xmin': 20, 'ymax': 30, 'xmax': 40}])
+    ...     writer.write('img2', [])
+    >>> store = load_prediction_store(path_store)
+    >>> len(store), store.get('img1')['label'].tolist(), len(store.get('img2'))
+    (2, ['dog'], 0)
+    >>> os.remove(path_store)
+    """
+
+    def __init__(self, path_store):
+        self.path_store = path_store
+        self._lock = threading.Lock()
+        if os.path.isfile(path_store):
+            _truncate_partial_line(path_store)
+        self._fp = open(path_store, 'a')
+
+    def write(self, name, predicts):
+        """append predictions of single image
+
+        :param str name: image name
+        :param list(dict) predicts: predictions with `PREDICT_FIELDS`
+        """
+        line = json.dumps({'image': name, 'predictions': predicts})
+        with self._lock:
+            self._fp.write(line + '\n')
+            # keep the file complete in case the run is interrupted
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NpzWriter(object):
+    """Collect predictions into columns and save them as compressed numpy archive
+
+    The archive contains `images` with image names, `offsets` so predictions of
+    image `i` are rows `offsets[i]:offsets[i + 1]`, column `label` and `STORE_COLUMNS`.
+    Already existing store is loaded and extended.
+
+    >>> path_store = './sample_predictions.npz'
+    >>> with NpzWriter(path_store) as writer:
+    ...     writer.write('img1', [{'class': 1, 'label': 'dog', 'confidence': 0.8,
+    ...                            'ymin': 10, 'xmin': 20, 'ymax': 30, 'xmax': 40},
+    ...                           {'class': 0, 'label': 'cat', 'confidence': 0.6,
+    ...                            'ymin': 15, 'xmin': 25, 'ymax': 35, 'xmax': 45}])
+    ...     writer.write('img2', [])
+    >>> store = load_prediction_store(path_store)
+    >>> store.images.tolist(), store.offsets.tolist()
+    (['img1', 'img2'], [0, 2, 2])
+    >>> store.get('img1')[['class', 'xmin', 'xmax']]  # doctest: +NORMALIZE_WHITESPACE
+       class  xmin  xmax
+    0      1    20    40
+    1      0    25    45
+    >>> os.remove(path_store)
+    """
+
+    def __init__(self, path_store):
+        self.path_store = path_store
+        self._lock = threading.Lock()
+        self._images, self._counts, self._rows = [], [], []
+        if os.path.isfile(path_store):
+            store = load_prediction_store(path_store)
+            self._images = store.images.tolist()
+            self._counts = np.diff(store.offsets).tolist()
+            self._rows = store.to_dataframe()[list(PREDICT_FIELDS)].to_dict('records')
+
+    def write(self, name, predicts):
+        """add predictions of single image
+
+        :param str name: image name
+        :param list(dict) predicts: predictions with `PREDICT_FIELDS`
+        """
+        with self._lock:
+            self._images.append(name)
+            self._counts.append(len(predicts))
+            self._rows += predicts
+
+    def close(self):
+        with self._lock:
+            offsets = np.concatenate([[0], np.cumsum(self._counts, dtype='int64')])
+            columns = {col: np.array([r[col] for r in self._rows], dtype=tp)
+                       for col, tp in STORE_COLUMNS}
+            labels = np.array([str(r['label']) for r in self._rows], dtype=str)
+            np.savez_compressed(self.path_store, images=np.array(self._images, dtype=str),
+                                offsets=offsets, label=labels, **columns)
+        logging.debug('exported %i predictions of %i images to "%s"',
+                      len(self._rows), len(self._images), self.path_store)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CompletionManifest(object):
+    """Append-only record of completed inputs, one per line, used for resuming runs
+
+    >>> path_manifest = './sample_manifest.txt'
+    >>> manifest = CompletionManifest(path_manifest)
+    >>> manifest.add('/data/img1.jpg')
+    >>> manifest.close()
+    >>> manifest = CompletionManifest(path_manifest)
+    >>> '/data/img1.jpg' in manifest, '/data/img2.jpg' in manifest
+    (True, False)
+    >>> manifest.close()
+    >>> os.remove(path_manifest)
+    """
+
+    def __init__(self, path_manifest):
+        self.path_manifest = path_manifest
+        self._lock = threading.Lock()
+        self.completed = set()
+        if os.path.isfile(path_manifest):
+            _truncate_partial_line(path_manifest)
+            with open(path_manifest, 'r') as fp:
+                self.completed = set(ln.rstrip('\n') for ln in fp if ln.strip())
+        self._fp = open(path_manifest, 'a')
+
+    def __contains__(self, item):
+        return item in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def add(self, item):
+        """record completed input
+
+        :param str item: input identifier, e.g. image path
+        """
+        with self._lock:
+            self._fp.write(item + '\n')
+            self._fp.flush()
+            self.completed.add(item)
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def open_prediction_writer(path_store):
+    """open writer according to the store extension
+
+    :param str path_store: path to the store, `.jsonl` or `.npz`
+    :return JsonLinesWriter|NpzWriter:
+    """
+    ext = os.path.splitext(path_store)[-1].lower()
+    if ext == '.jsonl':
+        return JsonLinesWriter(path_store)
+    elif ext == '.npz':
+        return NpzWriter(path_store)
+    raise ValueError('unsupported prediction store: %s' % path_store)
+
+
+def is_prediction_store(path):
+    """check whether the path points to a prediction store
+
+    >>> is_prediction_store('predictions.jsonl'), is_prediction_store('results')
+    (True, False)
+    """
+    return os.path.splitext(path)[-1].lower()[1:] in STORE_FORMATS
+
+
+class PredictionStore(object):
+    """Columnar predictions of many images with an image index"""
+
+    def __init__(self, images, offsets, columns):
+        """
+
+        :param ndarray images: image names
+        :param ndarray offsets: offsets of image predictions in columns, size `len(images) + 1`
+        :param dict columns: arrays with `label` and `STORE_COLUMNS`
+        """
+        self.images = np.asarray(images)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.columns = columns
+        self._index = {name: i for i, name in enumerate(self.images.tolist())}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def get(self, name):
+        """predictions of single image
+
+        :param str name: image name
+        :return DataFrame|None: predictions or None if the image is not in the store
+        """
+        if name not in self._index:
+            return None
+        i = self._index[name]
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        return pd.DataFrame({col: self.columns[col][begin:end] for col in PREDICT_FIELDS},
+                            columns=list(PREDICT_FIELDS))
+
+    def to_dataframe(self):
+        """all predictions in single table with column `image`
+
+        :return DataFrame:
+        """
+        df = pd.DataFrame({col: self.columns[col] for col in PREDICT_FIELDS},
+                          columns=list(PREDICT_FIELDS))
+        df.insert(0, 'image', np.repeat(self.images, np.diff(self.offsets)))
+        return df
+
+
+def _load_jsonl(path_store):
+    images, counts, rows = [], [], []
+    with open(path_store, 'r') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('skipping corrupted line in "%s": %s', path_store, line[:100])
+                continue
+            images.append(record['image'])
+            counts.append(len(record['predictions']))
+            rows += record['predictions']
+    offsets = np.concatenate([[0], np.cumsum(counts, dtype='int64')])
+    columns = {col: np.array([r[col] for r in rows], dtype=tp) for col, tp in STORE_COLUMNS}
+    columns['label'] = np.array([str(r['label']) for r in rows], dtype=str)
+    return images, offsets, columns
+
+
+def merge_prediction_stores(paths_stores, path_output):
+    """merge several stores (e.g. from sharded runs) into one, ordered by image name
+
+    The result does not depend on the order of inputs, for duplicated images
+    the last record of the last store (in sorted order of paths) is kept.
+
+    :param list(str) paths_stores: paths to stores, `.jsonl` or `.npz`
+    :param str path_output: path to the merged store, `.jsonl` or `.npz`
+    :return int: number of images in merged store
+
+    >>> paths = ['./sample_shard-%i.jsonl' % i for i in range(2)]
+    >>> pred = {'class': 1, 'label': 'dog', 'confidence': 0.8,
+    ...         'ymin': 10, 'xmin': 20, 'ymax': 30, 'xmax': 40}
+    >>> for i, path in enumerate(paths):
+    ...     with JsonLinesWriter(path) as writer:
+    ...         # the same image twice, e.g. after a resumed run
+    ...         writer.write('img%i' % (2 - i), [pred])
+    ...         writer.write('img%i' % (2 - i), [pred])
+    >>> merge_prediction_stores(paths, './sample_merged.npz')
+    2
+    >>> store = load_prediction_store('./sample_merged.npz')
+    >>> store.images.tolist(), len(store.get('img1'))
+    (['img1', 'img2'], 1)
+    >>> for path in paths + ['./sample_merged.npz']:
+    ...     os.remove(path)
+    """
+    records = {}
+    for path_store in sorted(paths_stores):
+        store = load_prediction_store(path_store)
+        # the store index points to the last record of duplicated image
+        for name in set(store.images.tolist()):
+            records[name] = store.get(name).to_dict('records')
+    if os.path.isfile(path_output):
+        os.remove(path_output)
+    with open_prediction_writer(path_output) as writer:
+        for name in sorted(records):
+            writer.write(name, records[name])
+    logging.info('merged %i stores with %i images to "%s"', len(paths_stores), len(records), path_output)
+    return len(records)
+
+
+def load_prediction_store(path_store):
+    """load whole prediction store at once
+
+    :param str path_store: path to the store, `.jsonl` or `.npz`
+    :return PredictionStore:
+    """
+    ext = os.path.splitext(path_store)[-1].lower()
+    if ext == '.jsonl':
+        images, offsets, columns = _load_jsonl(path_store)
+    elif ext == '.npz':
+        with np.load(path_store) as data:
+            images, offsets = data['images'], data['offsets']
+            columns = {col: data[col] for col, _ in STORE_COLUMNS}
+            columns['label'] = data['label']
+    else:
+        raise ValueError('unsupported prediction store: %s' % path_store)
+    return PredictionStore(images, offsets, columns)
@@ -0,0 +1,129 @@
+"""
+Gradients recomputing activations between checkpoints
+
+Only the checkpoint tensors, e.g. outputs of the residual blocks of the Darknet body,
+are kept from the forward pass. The backward pass goes from the last segment to the first,
+each segment between checkpoints is computed again from a copy of its forward graph
+and its activations are released before the previous segment is recomputed.
+This costs about one more forward pass, but the peak memory scales with the number
+of checkpoints and the largest segment instead of with all layers.
+
+The copies are made by the TensorFlow graph editor, so the Keras model itself,
+its layers and weights stay untouched.
+"""
+
+import tensorflow as tf
+from tensorflow.contrib import graph_editor as ge
+
+
+def layers_outputs(layers):
+    """all output tensors of the layers, for each call of the layer
+
+    :param list layers: Keras layers
+    :return list(tensor): outputs
+
+    >>> from keras.layers import Input, Dense
+    >>> dense = Dense(2)
+    >>> y1, y2 = dense(Input((3, ))), dense(Input((3, )))
+    >>> layers_outputs([dense]) == [y1, y2]
+    True
+    """
+    tensors = []
+    for layer in layers:
+        for node in layer._inbound_nodes:
+            tensors += node.output_tensors
+    return tensors
+
+
+def _backward_ops(seed_ops, stop_at_ts, within_ops):
+    """ops between the seeds and the stop tensors, including the seeds"""
+    ops = ge.get_backward_walk_ops(seed_ops, stop_at_ts=stop_at_ts, inclusive=True)
+    within_ops = set(within_ops)
+    return [op for op in ops if op in within_ops]
+
+
+def _copy_ops(ops, replacements):
+    """copy the ops with inputs replaced by the disconnected checkpoints
+
+    :return dict: copied op for each original op
+    """
+    _, info = ge.copy_with_input_replacements(ge.sgv(ops), {})
+    copies = info._transformed_ops
+    for origin_op, op in copies.items():
+        op._set_device(origin_op.node_def.device)
+    ge.reroute_ts(list(replacements.values()), list(replacements.keys()),
+                  can_modify=list(copies.values()))
+    return copies
+
+
+def _sort_checkpoints(checkpoints, within_ops):
+    """order the checkpoints from the input to the output of the graph"""
+    ops = ge.get_forward_walk_ops([t.op for t in checkpoints], inclusive=True, within_ops=within_ops)
+    depends = {t: set(ge.get_forward_walk_ops([t.op], inclusive=False, within_ops=ops)) for t in checkpoints}
+    # a checkpoint follows all checkpoints it depends on
+    return sorted(checkpoints, key=lambda t: sum(t.op in depends[c] for c in checkpoints))
+
+
+def gradients_recompute(loss, params, checkpoints):
+    """gradients of the loss keeping just the checkpoints from the forward pass
+
+    :param tensor loss: scalar loss
+    :param list(tensor) params: variables
+    :param list(tensor) checkpoints: tensors kept for the backward pass,
+        those not between the params and the loss are skipped
+    :return list(tensor): gradients as from `tf.gradients(loss, params)`
+
+    >>> import numpy as np
+    >>> x = tf.constant([[1., 2.]])
+    >>> w1, w2 = tf.Variable([[1., 0.], [.5, 1.]]), tf.Variable([[2.], [-1.]])
+    >>> h = tf.nn.relu(tf.matmul(tf.tanh(tf.matmul(x, w1)), w1))
+    >>> loss = tf.reduce_sum(tf.square(tf.matmul(h, w2)))
+    >>> grads = gradients_recompute(loss, [w1, w2], [h])
+    >>> with tf.Session() as sess:
+    ...     sess.run(tf.global_variables_initializer())
+    ...     g1, g2 = sess.run(grads)
+    ...     r1, r2 = sess.run(tf.gradients(loss, [w1, w2]))
+    >>> np.allclose(g1, r1), np.allclose(g2, r2)
+    (True, True)
+    """
+    params = list(params)
+    bwd_ops = ge.get_backward_walk_ops([loss.op], inclusive=True)
+    fwd_ops = ge.get_forward_walk_ops([p.op for p in params], inclusive=True, within_ops=bwd_ops)
+    # the variables, their reads and assignments are not recomputed
+    param_ops = set(p.op for p in params) | set(p.value().op for p in params)
+    fwd_ops = [op for op in fwd_ops if op.inputs and op not in param_ops and '/assign' not in op.name]
+    fwd_ts = set(t for op in fwd_ops for t in op.outputs)
+    checkpoints = [t for t in set(checkpoints) if t in fwd_ts and t is not loss]
+    if not checkpoints:
+        return tf.gradients(loss, params)
+    checkpoints = _sort_checkpoints(checkpoints, fwd_ops)
+    disconnected = {t: tf.stop_gradient(t, name=t.op.name + '_sg') for t in checkpoints}
+
+    # the last segment from the last checkpoints to the loss
+    copies = _copy_ops(_backward_ops([loss.op], checkpoints, fwd_ops), disconnected)
+    boundary = [disconnected[t] for t in checkpoints]
+    grads = tf.gradients(copies[loss.op].outputs[0], boundary + params)
+    grads_checkpoints = dict(zip(checkpoints, grads[:len(checkpoints)]))
+    grads_params = grads[len(checkpoints):]
+
+    # the remaining segments from the output to the input
+    for checkpoint in checkpoints[::-1]:
+        if grads_checkpoints[checkpoint] is None:
+            continue
+        others = [t for t in checkpoints if t is not checkpoint]
+        ops = _backward_ops([checkpoint.op], others, fwd_ops)
+        if not ops:
+            continue
+        copies = _copy_ops(ops, {t: disconnected[t] for t in others})
+        # recompute the segment just when its gradient is needed
+        for op in copies.values():
+            ge.add_control_inputs(op, [grads_checkpoints[checkpoint].op])
+        boundary = [disconnected[t] for t in others]
+        grads = tf.gradients(copies[checkpoint.op].outputs[checkpoint.value_index], boundary + params,
+                             grad_ys=[grads_checkpoints[checkpoint]])
+        for t, grad in zip(others, grads[:len(others)]):
+            if grad is not None:
+                grads_checkpoints[t] = grad if grads_checkpoints[t] is None else grads_checkpoints[t] + grad
+        grads_params = [g if g_seg is None else (g_seg if g is None else g + g_seg)
+                        for g, g_seg in zip(grads_params, grads[len(others):])]
+    return grads_params
@@ -0,0 +1,77 @@
+"""
+Keras sequence of training batches
+
+The batches are prepared by the shared worker pool, so several sequences,
+e.g. for training and validation, can use the same workers and Keras can
+prefetch batches from more threads safely.
+"""
+
+import numpy as np
+from keras.utils import Sequence
+
+
+class YoloSequence(Sequence):
+    """Batches of a subset of samples of :class:`keras_yolo3.shared_pool.SharedBatchPool`
+
+    The samples are shuffled for every epoch and each sample gets its own random
+    seed, so the augmentation does not depend on which thread or worker prepares it.
+
+    >>> import os
+    >>> from keras_yolo3.utils import update_path, get_anchors
+    >>> from keras_yolo3.shared_pool import SharedBatchPool
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> lines = [path_img + ' 100,150,200,250,0 300,50,400,200,1'] * 5
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> pool = SharedBatchPool(lines, (416, 416), anchors, 3, batch_size=2, nb_workers=0)
+    >>> seq = YoloSequence(pool, range(5), batch_size=2, seed=0)
+    >>> len(seq)
+    2
+    >>> inputs, _ = seq[0]
+    >>> [x.shape for x in inputs]
+    [(2, 416, 416, 3), (2, 13, 13, 3, 8), (2, 26, 26, 3, 8), (2, 52, 52, 3, 8)]
+    >>> order = seq.order.tolist()
+    >>> seq.on_epoch_end()
+    >>> seq.epoch, seq.order.tolist() == order
+    (1, False)
+    >>> pool.close()
+    """
+
+    def __init__(self, pool, indices, batch_size, profile=None, shuffle=True, seed=None):
+        """
+
+        :param SharedBatchPool pool: pool preparing the batches
+        :param list(int) indices: indexes of samples of the pool
+        :param int batch_size: batch size, at most the pool batch size
+        :param str|None profile: augmentation profile of the pool
+        :param bool shuffle: shuffle the samples and change the seeds every epoch
+        :param int|None seed: base random seed, drawn from `np.random` if None
+        """
+        assert batch_size <= pool.batch_size, \
+            'batch size %i exceeds the pool slots %i' % (batch_size, pool.batch_size)
+        self.pool = pool
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.profile = profile
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.epoch = 0
+        self._prepare_epoch()
+
+    def _prepare_epoch(self):
+        # the validation keeps the same seeds, so its losses are comparable
+        rng = np.random.RandomState((self.seed + self.epoch) if self.shuffle else self.seed)
+        self.order = rng.permutation(self.indices) if self.shuffle else self.indices
+        self.seeds = rng.randint(2 ** 31, size=len(self.indices))
+
+    def __len__(self):
+        return max(1, len(self.indices) // self.batch_size)
+
+    def __getitem__(self, idx):
+        # a dataset smaller then the batch is wrapped around
+        pos = np.arange(idx * self.batch_size, (idx + 1) * self.batch_size) % len(self.indices)
+        images, y_true = self.pool.get_batch(self.order[pos], self.seeds[pos], self.profile)
+        return [images, *y_true], np.zeros(len(pos))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._prepare_epoch()
@@ -0,0 +1,311 @@
+"""
+Pool of persistent data workers writing batches to shared memory
+
+Workers keep the dataset (annotation lines or samples of a dataset index)
+and receive only sample indices with random seeds. Each sample is augmented,
+its targets encoded and both written directly to a batch slot of a ring buffer
+in shared memory, images as uint8, so nothing is pickled back to the main process.
+For augmentation in the training graph the workers just copy images to a canvas,
+ideally from the image cache without any resizing, and pass image sizes with
+padded boxes, see :mod:`keras_yolo3.graph_augment`.
+"""
+
+import ctypes
+import logging
+import threading
+import traceback
+import multiprocessing as mproc
+from collections import deque
+from queue import Empty
+
+import numpy as np
+
+from .utils import get_image_canvas, get_augmented_sample, SPARSE_TARGET_COLUMNS
+
+#: ctypes of the shared buffers for used numpy types
+_CTYPES = {'uint8': ctypes.c_uint8, 'float32': ctypes.c_float}
+
+
+def _target_shapes(input_shape, nb_anchors, nb_classes):
+    """shapes of training targets of a single image, the same as in :func:`preprocess_true_boxes`"""
+    num_layers = nb_anchors // 3
+    return [(input_shape[0] // s, input_shape[1] // s, 3, 5 + nb_classes)
+            for s in (32, 16, 8)[:num_layers]]
+
+
+def _buffer_views(buffers, shapes, dtypes):
+    return [np.frombuffer(buf, dtype=tp).reshape(shape)
+            for buf, shape, tp in zip(buffers, shapes, dtypes)]
+
+
+def _fill_sample(samples, views, profiles, task, encode_targets=True):
+    """augment single sample and write it to the batch slot"""
+    slot, pos, idx, seed, profile = task
+    np.random.seed(seed)
+    if encode_targets:
+        image, targets = get_augmented_sample(samples[idx], **profiles[profile])
+    else:
+        params = profiles[profile]
+        image, size, boxes = get_image_canvas(samples[idx], params['canvas_size'],
+                                              max_boxes=params.get('max_boxes', 20),
+                                              image_cache=params.get('image_cache'))
+        targets = [size, boxes]
+    views[0][slot, pos] = image
+    for view, y in zip(views[1:], targets):
+        view[slot, pos] = y
+
+
+def _worker_loop(samples, buffers, shapes, dtypes, profiles, tasks, done, encode_targets=True):
+    """process tasks `(slot, position, sample index, seed, profile)` until `None` comes"""
+    views = _buffer_views(buffers, shapes, dtypes)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        try:
+            _fill_sample(samples, views, profiles, task, encode_targets)
+            done.put((task[0], None))
+        except Exception:
+            done.put((task[0], traceback.format_exc()))
+
+
+class SharedBatchPool(object):
+    """Persistent workers filling batches in a shared-memory ring buffer
+
+    Batches can be requested from several threads at once, e.g. by the Keras
+    enqueuer, and with different augmentation profiles, e.g. for training
+    and validation. With no workers the samples are prepared in the calling thread.
+
+    >>> import os
+    >>> from keras_yolo3.utils import update_path, get_anchors
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> lines = [path_img + ' 100,150,200,250,0 300,50,400,200,1'] * 3
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> with SharedBatchPool(lines, (416, 416), anchors, 3, batch_size=2, nb_workers=2,
+    ...                      profiles={'valid': dict(augment=False)}) as pool:
+    ...     batches = list(pool.iter_batches([[0, 1], [2, 0], [1, 2]]))
+    ...     images_valid, _ = pool.get_batch([0, 1], seeds=[1, 2], profile='valid')
+    >>> len(batches)
+    3
+    >>> images, y_true = batches[0]
+    >>> images.shape, images.dtype, [y.shape for y in y_true]
+    ((2, 416, 416, 3), dtype('float32'), [(2, 13, 13, 3, 8), (2, 26, 26, 3, 8), (2, 52, 52, 3, 8)])
+    >>> with SharedBatchPool(lines, (416, 416), anchors, 3, batch_size=2, nb_workers=0,
+    ...                      profiles={'valid': dict(augment=False)}) as pool:
+    ...     images_inline, _ = pool.get_batch([0, 1], seeds=[1, 2], profile='valid')
+    >>> np.array_equal(images_valid, images_inline)
+    True
+
+    Raw samples for augmentation in the graph, uint8 canvases with image sizes
+
+    >>> with SharedBatchPool(lines, (416, 416), anchors, 3, batch_size=2, nb_workers=0,
+    ...                      encode_targets=False, canvas_size=520) as pool:
+    ...     images, (sizes, boxes) = pool.get_batch([0, 1])
+    >>> images.shape, images.dtype, sizes[0].tolist(), boxes.shape
+    ((2, 520, 520, 3), dtype('uint8'), [518.0, 520.0], (2, 20, 5))
+
+    Sparse targets, a record per box
+
+    >>> with SharedBatchPool(lines, (416, 416), anchors, 3, batch_size=2, nb_workers=0,
+    ...                      sparse_targets=True, augment=False) as pool:
+    ...     images, (records, ) = pool.get_batch([0, 1])
+    >>> images.dtype, records.shape
+    (dtype('float32'), (2, 20, 9))
+    """
+
+    def __init__(self, samples, input_shape, anchors, nb_classes, batch_size,
+                 nb_workers=2, nb_slots=None, profiles=None, encode_targets=True,
+                 sparse_targets=False, canvas_size=None, **kwargs):
+        """
+
+        :param list samples: annotation lines or samples of dataset index
+        :param tuple(int,int) input_shape: CNN input size
+        :param ndarray anchors:
+        :param int nb_classes:
+        :param int batch_size: maximal batch size
+        :param int nb_workers: number of worker processes, 0 for preparing samples in the caller
+        :param int|None nb_slots: number of batches prepared at once, by default two per worker
+        :param dict|None profiles: named changes of `kwargs`, e.g. `{'valid': {'augment': False}}`
+        :param bool encode_targets: encode training targets, otherwise give uint8 canvases,
+            image sizes and boxes padded to `max_boxes` for :mod:`keras_yolo3.graph_augment`
+        :param bool sparse_targets: encode targets as records of boxes padded to `max_boxes`,
+            see :func:`keras_yolo3.utils.preprocess_true_boxes_sparse`
+        :param int|None canvas_size: side of the canvas for raw images,
+            see :func:`keras_yolo3.utils.get_image_canvas`, by default the larger CNN input side
+        :param kwargs: parameters of :func:`get_augmented_data`, the default profile
+        """
+        self.batch_size = batch_size
+        self.nb_slots = nb_slots or max(2, 2 * nb_workers)
+        self.encode_targets = encode_targets
+        item_shapes = [tuple(input_shape) + (3, )]
+        if not encode_targets:
+            canvas_size = canvas_size or max(input_shape)
+            item_shapes = [(canvas_size, canvas_size, 3)]
+            kwargs.update(canvas_size=canvas_size)
+        if encode_targets and sparse_targets:
+            item_shapes += [(kwargs.get('max_boxes', 20), len(SPARSE_TARGET_COLUMNS))]
+            kwargs.update(anchors=anchors, nb_classes=nb_classes, sparse_targets=True)
+        elif encode_targets:
+            item_shapes += _target_shapes(input_shape, len(anchors), nb_classes)
+            kwargs.update(anchors=anchors, nb_classes=nb_classes)
+        else:
+            item_shapes += [(2, ), (kwargs.get('max_boxes', 20), 5)]
+        self._shapes = [(self.nb_slots, batch_size) + shape for shape in item_shapes]
+        self._dtypes = ['uint8'] + ['float32'] * (len(item_shapes) - 1)
+        self._buffers = [mproc.RawArray(_CTYPES[tp], int(np.prod(shape)))
+                         for shape, tp in zip(self._shapes, self._dtypes)]
+        self._views = _buffer_views(self._buffers, self._shapes, self._dtypes)
+
+        kwargs.update(input_shape=input_shape)
+        self._profiles = {None: kwargs}
+        for name, changes in (profiles or {}).items():
+            self._profiles[name] = dict(kwargs, **changes)
+        self._samples = samples
+
+        # bookkeeping of slots shared by requesting threads
+        self._cond = threading.Condition()
+        self._free = deque(range(self.nb_slots))
+        self._counts = [0] * self.nb_slots
+        self._sizes = [0] * self.nb_slots
+        self._reading = False
+
+        self._tasks = mproc.Queue()
+        self._done = mproc.Queue()
+        self._workers = [mproc.Process(target=_worker_loop, daemon=True,
+                                       args=(samples, self._buffers, self._shapes, self._dtypes,
+                                             self._profiles, self._tasks, self._done,
+                                             encode_targets))
+                         for _ in range(nb_workers)]
+        for worker in self._workers:
+            worker.start()
+        logging.debug('started %i data workers with %i batch slots', nb_workers, self.nb_slots)
+
+    def _read_slot(self, slot, size, out=None):
+        """copy the batch out of the slot, so the slot can be refilled
+
+        :param list(ndarray)|None out: arrays for images and targets to copy to, new if None
+        """
+        views = [view[slot, :size] for view in self._views]
+        if out is None:
+            # raw images are normalized in the graph
+            dtype = np.float32 if self.encode_targets else np.uint8
+            out = [np.empty(views[0].shape, dtype=dtype)] + [np.empty_like(view) for view in views[1:]]
+        out = [arr[:size] for arr in out]
+        if self.encode_targets:
+            np.divide(views[0], 255., out=out[0], casting='unsafe')
+        else:
+            np.copyto(out[0], views[0])
+        for arr, view in zip(out[1:], views[1:]):
+            np.copyto(arr, view)
+        return out[0], out[1:]
+
+    def _wait_done(self):
+        while True:
+            try:
+                slot, error = self._done.get(timeout=1)
+            except Empty:
+                if not all(w.is_alive() for w in self._workers):
+                    raise RuntimeError('data worker has died unexpectedly')
+                continue
+            if error:
+                raise RuntimeError('data worker failed:\n%s' % error)
+            return slot
+
+    def submit(self, idxs, seeds=None, profile=None):
+        """start preparing a batch, it waits for a free slot
+
+        :param list(int) idxs: sample indexes
+        :param list(int)|None seeds: random seed of each sample, drawn from `np.random` if None
+        :param str|None profile: augmentation profile
+        :return int: slot to be collected
+        """
+        assert len(idxs) <= self.batch_size, 'batch is larger than the slot'
+        if seeds is None:
+            seeds = np.random.randint(2 ** 31, size=len(idxs))
+        with self._cond:
+            while not self._free:
+                self._cond.wait()
+            slot = self._free.popleft()
+            self._counts[slot] = self._sizes[slot] = len(idxs)
+        tasks = [(slot, pos, int(idx), int(seed), profile)
+                 for pos, (idx, seed) in enumerate(zip(idxs, seeds))]
+        if self._workers:
+            for task in tasks:
+                self._tasks.put(task)
+        else:
+            for task in tasks:
+                _fill_sample(self._samples, self._views, self._profiles, task, self.encode_targets)
+            with self._cond:
+                self._counts[slot] = 0
+        return slot
+
+    def collect(self, slot, out=None):
+        """wait until the batch is ready, copy it out and free the slot
+
+        :param int slot: slot returned by :meth:`submit`
+        :param list(ndarray)|None out: arrays for images and targets to copy to, new if None
+        :return tuple(ndarray,list(ndarray)): images as float32 in range (0, 1), uint8 if raw, and targets
+        """
+        with self._cond:
+            while self._counts[slot] > 0:
+                # just one thread reads the results, the others wait for notification
+                if self._reading:
+                    self._cond.wait()
+                    continue
+                self._reading = True
+                self._cond.release()
+                try:
+                    done_slot = self._wait_done()
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                self._counts[done_slot] -= 1
+                self._cond.notify_all()
+        batch = self._read_slot(slot, self._sizes[slot], out)
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify_all()
+        return batch
+
+    def get_batch(self, idxs, seeds=None, profile=None):
+        """prepare single batch, see :meth:`submit`"""
+        return self.collect(self.submit(idxs, seeds, profile))
+
+    def iter_batches(self, batch_indices, profile=None, buffers=None):
+        """generate batches for given sample indexes, keeping all slots busy
+
+        :param iterable(list(int)) batch_indices: sample indexes of each batch, can be infinite
+        :param str|None profile: augmentation profile
+        :param list(list(ndarray))|None buffers: ring of arrays reused for the batches, new if None
+        :return iterable(tuple(ndarray,list(ndarray))): images as float32 in range (0, 1), uint8 if raw, and targets
+        """
+        batch_indices = iter(batch_indices)
+        pending = deque()
+        nb_batches = 0
+        while True:
+            while len(pending) < self.nb_slots:
+                idxs = next(batch_indices, None)
+                if idxs is None:
+                    break
+                pending.append(self.submit(idxs, profile=profile))
+            if not pending:
+                break
+            out = buffers[nb_batches % len(buffers)] if buffers else None
+            nb_batches += 1
+            yield self.collect(pending.popleft(), out)
+
+    def close(self):
+        """stop the workers, unfinished tasks are dropped"""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,208 @@
+"""
+Sharded TFRecord dataset and its `tf.data` input pipeline
+
+The annotation file, with a line `image_path x_min,y_min,x_max,y_max,class_id ...`
+per image, is converted to a few large TFRecord files, each example holds
+the image encoded as it is stored on the disk and its boxes. The shards are
+read sequentially and interleaved, the examples are decoded, augmented and
+batched by parallel TensorFlow operations, see :mod:`keras_yolo3.graph_augment`.
+
+The training model from :func:`keras_yolo3.model.create_model` is fed by::
+
+    dataset = create_dataset(paths_shards, (416, 416), anchors, nb_classes, batch_size=16)
+    model.fit_generator(iterate_dataset(dataset), steps_per_epoch=nb_samples // 16, workers=0)
+"""
+
+import os
+import logging
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from pathos.multiprocessing import ProcessPool
+
+from .utils import update_path, nb_workers
+from .dataset import load_dataset_index
+from .graph_augment import augment_batch, preprocess_true_boxes_graph
+
+#: name of a shard as (dataset name, shard index, number of shards)
+NAME_SHARD = '%s-%05i-of-%05i.tfrecord'
+#: features of a single example
+FEATURES = {
+    'image/path': tf.FixedLenFeature([], tf.string),
+    'image/encoded': tf.FixedLenFeature([], tf.string),
+    'boxes': tf.VarLenFeature(tf.int64),
+}
+
+
+def serialize_sample(path_img, boxes):
+    """create an example from the image file and its boxes
+
+    :param str path_img: path to the image
+    :param ndarray boxes: boxes in shape (N, 5)
+    :return bytes: serialized example
+    """
+    with open(update_path(path_img), 'rb') as fp:
+        img_bytes = fp.read()
+    feature = {
+        'image/path': tf.train.Feature(bytes_list=tf.train.BytesList(value=[path_img.encode()])),
+        'image/encoded': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img_bytes])),
+        'boxes': tf.train.Feature(int64_list=tf.train.Int64List(
+            value=np.asarray(boxes, dtype=int).ravel().tolist())),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def _write_shard(samples, path_shard):
+    with tf.python_io.TFRecordWriter(path_shard) as writer:
+        for path_img, boxes in samples:
+            writer.write(serialize_sample(path_img, boxes))
+    return len(samples)
+
+
+def convert_to_tfrecords(path_annot, path_output, name='dataset', nb_shards=8, nb_threads=1):
+    """convert annotated dataset to sharded TFRecord files
+
+    :param str path_annot: path to the annotation file
+    :param str path_output: output folder
+    :param str name: name prefix of the shards
+    :param int nb_shards: number of TFRecord files
+    :param float|int nb_threads: nb processes writing shards in parallel
+    :return list(str): paths to the shards
+
+    >>> import tempfile
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> path_dir = tempfile.mkdtemp()
+    >>> path_annot = os.path.join(path_dir, 'dataset.txt')
+    >>> with open(path_annot, 'w') as fp:
+    ...     _ = fp.write((path_img + ' 100,150,200,250,0 300,50,400,200,1\\n') * 3)
+    >>> paths = convert_to_tfrecords(path_annot, path_dir, nb_shards=2)
+    >>> [os.path.basename(p) for p in paths]
+    ['dataset-00000-of-00002.tfrecord', 'dataset-00001-of-00002.tfrecord']
+    >>> dataset = create_dataset(paths, (416, 416), np.array([[10, 13], [16, 30], [33, 23],
+    ...                          [30, 61], [62, 45], [59, 119]]), 2, batch_size=2, augment=False)
+    >>> inputs, _ = next(iterate_dataset(dataset, session=tf.Session()))
+    >>> [x.shape for x in inputs]
+    [(2, 416, 416, 3), (2, 13, 13, 3, 7), (2, 26, 26, 3, 7)]
+    >>> import shutil
+    >>> shutil.rmtree(path_dir)
+    """
+    if not os.path.isdir(path_output):
+        os.makedirs(path_output)
+    index = load_dataset_index(path_annot)
+    samples = [(path, boxes) for path, boxes in index if os.path.isfile(path)]
+    if len(samples) < len(index):
+        logging.warning('skipping %i missing images', len(index) - len(samples))
+    # spread the samples over all shards, so each shard is a sample of the whole dataset
+    shards = [samples[i::nb_shards] for i in range(nb_shards)]
+    paths_shards = [os.path.join(path_output, NAME_SHARD % (name, i, nb_shards))
+                    for i in range(nb_shards)]
+
+    nb_threads = nb_workers(nb_threads)
+    pool = ProcessPool(nb_threads) if nb_threads > 1 else None
+    map_process = pool.imap if pool else map
+    counts = list(map_process(_write_shard, shards, paths_shards))
+    if pool:
+        pool.close()
+        pool.join()
+        pool.clear()
+    logging.info('written %i samples to %i shards', sum(counts), nb_shards)
+    return paths_shards
+
+
+def _fit_to_input(image, boxes, input_shape):
+    """scale the image to fit the CNN input, as :func:`keras_yolo3.utils._scale_image_to_cnn`"""
+    cnn_h, cnn_w = input_shape
+    img_hw = tf.cast(tf.shape(image)[:2], tf.float32)
+    scale = tf.minimum(cnn_h / img_hw[0], cnn_w / img_hw[1])
+    new_hw = tf.cast(img_hw * scale, tf.int32)
+    offset = (tf.constant([cnn_h, cnn_w]) - new_hw) // 2
+    image = tf.image.resize_images(image, new_hw, method=tf.image.ResizeMethod.BICUBIC)
+    image = tf.image.pad_to_bounding_box(image - 128., offset[0], offset[1], cnn_h, cnn_w) + 128.
+    image = tf.cast(tf.clip_by_value(tf.round(image), 0., 255.), tf.uint8)
+    image.set_shape([cnn_h, cnn_w, 3])
+    offset_xy = tf.tile(tf.cast(offset[::-1], tf.float32), [2])
+    boxes = tf.concat([boxes[:, :4] * scale + offset_xy, boxes[:, 4:]], axis=1)
+    return image, boxes
+
+
+def parse_example(serialized, input_shape, max_boxes=20, shuffle_boxes=False):
+    """decode single example and fit it to the CNN input
+
+    :param tensor serialized: serialized example
+    :param tuple(int,int) input_shape: CNN input size
+    :param int max_boxes: maximal number of boxes per image
+    :param bool shuffle_boxes: shuffle boxes before dropping those over `max_boxes`
+    :return tuple(tensor,tensor): uint8 image and boxes padded by zeros to (max_boxes, 5)
+    """
+    example = tf.parse_single_example(serialized, FEATURES)
+    image = tf.image.decode_image(example['image/encoded'], channels=3)
+    image.set_shape([None, None, 3])
+    boxes = tf.reshape(tf.cast(tf.sparse_tensor_to_dense(example['boxes']), tf.float32), [-1, 5])
+    if shuffle_boxes:
+        boxes = tf.random_shuffle(boxes)
+    image, boxes = _fit_to_input(tf.cast(image, tf.float32), boxes[:max_boxes], input_shape)
+    boxes = tf.pad(boxes, [[0, max_boxes - tf.shape(boxes)[0]], [0, 0]])
+    boxes.set_shape([max_boxes, 5])
+    return image, boxes
+
+
+def create_dataset(paths_shards, input_shape, anchors, nb_classes, batch_size, augment=True,
+                   max_boxes=20, shuffle_buffer=1000, nb_parallel=4, repeat=True, **kwargs):
+    """create the input pipeline reading TFRecord shards
+
+    :param list(str) paths_shards: paths to the shards, see :func:`convert_to_tfrecords`
+    :param tuple(int,int) input_shape: CNN input size
+    :param ndarray anchors:
+    :param int nb_classes:
+    :param int batch_size:
+    :param bool augment: shuffle and augment the samples
+    :param int max_boxes: maximal number of boxes per image
+    :param int shuffle_buffer: number of samples shuffled at once
+    :param int nb_parallel: number of shards read and samples decoded in parallel
+    :param bool repeat: repeat the dataset infinitely
+    :param kwargs: parameters of :func:`keras_yolo3.graph_augment.augment_batch`
+    :return tf.data.Dataset: batches `([images, *y_true], zeros)` of the training model
+    """
+    paths_shards = list(paths_shards)
+    dataset = tf.data.Dataset.from_tensor_slices(paths_shards)
+    if augment:
+        dataset = dataset.shuffle(len(paths_shards))
+    nb_readers = min(nb_parallel, len(paths_shards))
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=nb_readers,
+                                 block_length=1, num_parallel_calls=nb_readers)
+    if augment:
+        dataset = dataset.shuffle(shuffle_buffer)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.map(lambda x: parse_example(x, input_shape, max_boxes, shuffle_boxes=augment),
+                          num_parallel_calls=nb_parallel)
+    dataset = dataset.batch(batch_size)
+
+    def _prepare_batch(images, boxes):
+        if augment:
+            images, boxes = augment_batch(images, boxes, input_shape, **kwargs)
+        else:
+            images = tf.cast(images, tf.float32) / 255.
+        y_true = preprocess_true_boxes_graph(boxes, input_shape, anchors, nb_classes)
+        return tuple([images] + y_true), tf.zeros(tf.shape(images)[:1])
+
+    dataset = dataset.map(_prepare_batch, num_parallel_calls=nb_parallel)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def iterate_dataset(dataset, session=None):
+    """generate numpy batches of the dataset, e.g. for `fit_generator`
+
+    :param tf.data.Dataset dataset: batches, see :func:`create_dataset`
+    :param session: TF session, by default the Keras one
+    :return iterable(tuple(list(ndarray),ndarray)): inputs and dummy targets
+    """
+    session = session or K.get_session()
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    while True:
+        try:
+            inputs, targets = session.run(next_batch)
+        except tf.errors.OutOfRangeError:
+            break
+        yield list(inputs), targets
@@ -0,0 +1,235 @@
+"""
+Resumable training state
+
+At the end of every epoch the training state is written to the output folder,
+the weights of the model, slots of the optimizer, the learning rate, counters
+of callbacks as `ReduceLROnPlateau` or `EarlyStopping`, the training phase,
+the next epoch and the random states, so the training can continue after
+an interruption where it stopped.
+
+The state file is written after the weights and arrays it points to,
+so an interruption while saving keeps the previous state valid.
+"""
+
+import os
+import logging
+
+import yaml
+import numpy as np
+import keras.backend as K
+from keras.callbacks import Callback
+from keras.optimizers import TFOptimizer
+
+#: file describing the last state
+NAME_STATE = 'training_state.yaml'
+#: weights of the model in a state as (phase, next epoch)
+NAME_STATE_WEIGHTS = 'training_state-%s-ep%03d.h5'
+#: optimizer slots and random state in a state as (phase, next epoch)
+NAME_STATE_ARRAYS = 'training_state-%s-ep%03d.npz'
+#: attributes of Keras callbacks changing during the training
+CALLBACK_STATE = ('best', 'wait', 'cooldown_counter', 'stopped_epoch', 'epochs_since_last_save')
+
+
+def _to_builtin(val):
+    """numpy scalars as python numbers, so YAML writes them plainly"""
+    return val.item() if isinstance(val, np.generic) else val
+
+
+def optimizer_variables(optimizer):
+    """variables with the state of the optimizer, also of a TensorFlow optimizer
+    wrapped by `TFOptimizer`, e.g. in mixed precision, whose `weights` are not available
+
+    :param optimizer: Keras optimizer
+    :return list: variables
+    """
+    if isinstance(optimizer, TFOptimizer):
+        # the TensorFlow optimizer gives its slots sorted by name, so the order is stable
+        return [optimizer.iterations] + list(optimizer.optimizer.variables())
+    return list(optimizer.weights)
+
+
+class TrainingState(Callback):
+    """Save the training state at the end of each epoch and restore it at the train begin
+
+    Goes after all the callbacks it saves, as Keras callbacks reset themselves
+    at the train begin too. The callback counters are also carried over between
+    several fits of the same phase, e.g. resolution stages, so early stopping
+    and the learning rate schedule span the whole phase.
+
+    >>> import tempfile, shutil
+    >>> from keras.models import Sequential
+    >>> from keras.layers import Dense
+    >>> from keras.optimizers import Adam
+    >>> from keras.callbacks import ReduceLROnPlateau
+    >>> path_dir = tempfile.mkdtemp()
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> model.compile(optimizer=Adam(), loss='mse')
+    >>> reduce_lr = ReduceLROnPlateau(monitor='loss', patience=5)
+    >>> state = TrainingState(path_dir, model, callbacks=[reduce_lr], phase='full')
+    >>> x = np.random.rand(8, 3)
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=2, verbose=0, callbacks=[reduce_lr, state])
+    >>> weights, slots, best = model.get_weights(), model.optimizer.get_weights(), reduce_lr.best
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> model.compile(optimizer=Adam(), loss='mse')
+    >>> reduce_lr = ReduceLROnPlateau(monitor='loss', patience=5)
+    >>> state = TrainingState(path_dir, model, callbacks=[reduce_lr])
+    >>> state.load()
+    True
+    >>> state.phase, state.epoch
+    ('full', 2)
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=2, initial_epoch=2, verbose=0, callbacks=[reduce_lr, state])
+    >>> all(np.array_equal(w1, w2) for w1, w2 in zip(weights, model.get_weights()))
+    True
+    >>> all(np.array_equal(w1, w2) for w1, w2 in zip(slots, model.optimizer.get_weights()))
+    True
+    >>> reduce_lr.best == best
+    True
+
+    Counters of callbacks continue in the next fit of the same phase
+
+    >>> from keras.callbacks import EarlyStopping
+    >>> stopping = EarlyStopping(monitor='loss', min_delta=1e9, patience=100)
+    >>> state = TrainingState(path_dir, model, callbacks=[stopping], phase='full')
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=2, verbose=0, callbacks=[stopping, state])
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=4, initial_epoch=2, verbose=0, callbacks=[stopping, state])
+    >>> stopping.wait
+    3
+    >>> state.phase = 'head'
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=1, verbose=0, callbacks=[stopping, state])
+    >>> stopping.wait
+    0
+
+    The state of the optimizer in mixed precision
+
+    >>> from keras_yolo3.optimizers import create_optimizer
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> model.compile(optimizer=create_optimizer(0.01, mixed_precision=True), loss='mse')
+    >>> state = TrainingState(path_dir, model, phase='full')
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=2, verbose=0, callbacks=[state])
+    >>> slots = K.batch_get_value(optimizer_variables(model.optimizer))
+    >>> model = Sequential([Dense(1, input_shape=(3, ))])
+    >>> model.compile(optimizer=create_optimizer(0.01, mixed_precision=True), loss='mse')
+    >>> state = TrainingState(path_dir, model)
+    >>> state.load()
+    True
+    >>> _ = model.fit(x, x.sum(axis=1), epochs=2, initial_epoch=2, verbose=0, callbacks=[state])
+    >>> restored = K.batch_get_value(optimizer_variables(model.optimizer))
+    >>> len(slots) > 1, all(np.array_equal(w1, w2) for w1, w2 in zip(slots, restored))
+    (True, True)
+    >>> shutil.rmtree(path_dir)
+    """
+
+    def __init__(self, path_output, model, callbacks=(), phase=None, save=True):
+        """
+
+        :param str path_output: folder of the state
+        :param model: Keras model with the saved weights, e.g. without wrappers of the trained one
+        :param list callbacks: Keras callbacks with the saved state
+        :param str|None phase: name of the training phase, e.g. `head` or `full`
+        :param bool save: write the state, e.g. just in the first of data-parallel workers
+        """
+        super(TrainingState, self).__init__()
+        self.path_output = path_output
+        self.model_weights = model
+        self.callbacks = list(callbacks)
+        self.phase = phase
+        self.save_state = save
+        self.epoch = 0
+        # base seed of the training sequences, restored with the state
+        self.seed = np.random.randint(2 ** 31)
+        self._restore = None
+        # phase and counters of the callbacks after the last epoch
+        self._callback_state = None
+        self._paths = []
+
+    def load(self):
+        """load the last state, the model weights and seed are set now, the rest at the train begin
+
+        :return bool: the state was found
+        """
+        path_state = os.path.join(self.path_output, NAME_STATE)
+        if not os.path.isfile(path_state):
+            logging.warning('No training state "%s", training from the beginning.', path_state)
+            return False
+        with open(path_state, 'r') as fp:
+            state = yaml.safe_load(fp)
+        self.phase, self.epoch, self.seed = state['phase'], state['epoch'], state['seed']
+        self.model_weights.load_weights(os.path.join(self.path_output, state['weights']))
+        arrays = np.load(os.path.join(self.path_output, state['arrays']))
+        rnd_name, rnd_pos, rnd_gauss, rnd_cached = state['np_random']
+        self._restore = {
+            'phase': self.phase,
+            'np_random': (rnd_name, arrays['np_random'], rnd_pos, rnd_gauss, rnd_cached),
+            'optimizer': [arrays['optimizer_%i' % i] for i in range(state['nb_optimizer_weights'])],
+            'lr': state['lr'],
+            'callbacks': state['callbacks'],
+        }
+        self._paths = [state['weights'], state['arrays']]
+        logging.info('Resume the training phase "%s" at epoch %i.', self.phase, self.epoch)
+        return True
+
+    def _callback_values(self):
+        return [{name: _to_builtin(getattr(cb, name)) for name in CALLBACK_STATE if hasattr(cb, name)}
+                for cb in self.callbacks]
+
+    def on_train_begin(self, logs=None):
+        # the optimizer slots exist since the train function is made
+        if self._restore and self._restore['phase'] == self.phase:
+            restore, self._restore = self._restore, None
+            np.random.set_state(restore['np_random'])
+            optimizer = self.model.optimizer
+            if restore['optimizer']:
+                variables = optimizer_variables(optimizer)
+                assert len(variables) == len(restore['optimizer']), \
+                    'the optimizer state has %i arrays, expected %i' % (len(restore['optimizer']), len(variables))
+                K.batch_set_value(list(zip(variables, restore['optimizer'])))
+            if restore['lr'] is not None:
+                K.set_value(optimizer.lr, restore['lr'])
+            self._callback_state = (self.phase, restore['callbacks'])
+        # the callbacks have just reset themselves, a new phase starts them again
+        if not self._callback_state or self._callback_state[0] != self.phase:
+            return
+        for callback, values in zip(self.callbacks, self._callback_state[1]):
+            for name, val in values.items():
+                setattr(callback, name, val)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        self._callback_state = (self.phase, self._callback_values())
+        self.save(self.model.optimizer)
+
+    def save(self, optimizer=None):
+        """write the current state
+
+        :param optimizer: Keras optimizer of the current phase, None at the phase begin
+        """
+        if not self.save_state:
+            return
+        name_weights = NAME_STATE_WEIGHTS % (self.phase, self.epoch)
+        name_arrays = NAME_STATE_ARRAYS % (self.phase, self.epoch)
+        self.model_weights.save_weights(os.path.join(self.path_output, name_weights))
+        slots = K.batch_get_value(optimizer_variables(optimizer)) if optimizer else []
+        rnd_name, rnd_keys, rnd_pos, rnd_gauss, rnd_cached = np.random.get_state()
+        np.savez(os.path.join(self.path_output, name_arrays), np_random=rnd_keys,
+                 **{'optimizer_%i' % i: w for i, w in enumerate(slots)})
+        state = {
+            'phase': self.phase,
+            'epoch': self.epoch,
+            'seed': int(self.seed),
+            'weights': name_weights,
+            'arrays': name_arrays,
+            'nb_optimizer_weights': len(slots),
+            'lr': float(K.get_value(optimizer.lr)) if optimizer else None,
+            # at the phase begin the callbacks start again
+            'callbacks': self._callback_values() if optimizer else [],
+            'np_random': [rnd_name, int(rnd_pos), int(rnd_gauss), float(rnd_cached)],
+        }
+        path_state = os.path.join(self.path_output, NAME_STATE)
+        with open(path_state + '.tmp', 'w') as fp:
+            yaml.safe_dump(state, fp, default_flow_style=False)
+        os.replace(path_state + '.tmp', path_state)
+        # the previous state is not needed anymore
+        for name in self._paths:
+            if name not in (name_weights, name_arrays) and os.path.isfile(os.path.join(self.path_output, name)):
+                os.remove(os.path.join(self.path_output, name))
+        self._paths = [name_weights, name_arrays]
@@ -3,7 +3,6 @@
 import os
 import logging
 import warnings
-import gc
 from functools import reduce, partial, wraps
 import multiprocessing as mproc
 
@@ -11,9 +10,12 @@ import numpy as np
 import pandas as pd
 from PIL import Image
 from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
-from pathos.multiprocessing import ProcessPool
 
 CPU_COUNT = mproc.cpu_count()
+# swap X-Y axis
+PREDICT_FIELDS = ('class', 'label', 'confidence', 'ymin', 'xmin', 'ymax', 'xmax')
+#: columns of sparse training targets, a record per box, see :func:`preprocess_true_boxes_sparse`
+SPARSE_TARGET_COLUMNS = ('layer', 'cell_y', 'cell_x', 'anchor', 'x', 'y', 'w', 'h', 'class')
 
 
 def nb_workers(ratio):
@@ -82,6 +84,59 @@ def letterbox_image(image, size):
     return new_image
 
 
+def non_max_suppression(boxes, scores, max_boxes=20, iou_threshold=.5):
+    """greedy non-maximum suppression, numpy twin of `tf.image.non_max_suppression`
+
+    :param ndarray boxes: boxes in shape (N, 4) as ymin, xmin, ymax, xmax
+    :param ndarray scores: box scores in shape (N, )
+    :param int max_boxes: maximal number of selected boxes
+    :param float iou_threshold: drop boxes overlapping selected one more then this
+    :return ndarray: indexes of selected boxes
+
+    >>> boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30]])
+    >>> non_max_suppression(boxes, np.array([0.9, 0.8, 0.7]))
+    array([0, 2])
+    >>> non_max_suppression(boxes, np.array([0.9, 0.8, 0.7]), iou_threshold=0.9)
+    array([0, 1, 2])
+    """
+    boxes = np.asarray(boxes, dtype=float)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(scores, kind='stable')[::-1]
+    selected = []
+    while order.size and len(selected) < max_boxes:
+        idx = order[0]
+        selected.append(idx)
+        inter_min = np.maximum(boxes[idx, :2], boxes[order[1:], :2])
+        inter_max = np.minimum(boxes[idx, 2:], boxes[order[1:], 2:])
+        inter = np.prod(np.clip(inter_max - inter_min, 0, None), axis=1)
+        iou = inter / (areas[idx] + areas[order[1:]] - inter)
+        order = order[1:][iou <= iou_threshold]
+    return np.array(selected, dtype=int)
+
+
+def format_predictions(out_boxes, out_scores, out_classes, class_names):
+    """convert raw detections to list of records with `PREDICT_FIELDS`
+
+    :param ndarray out_boxes: boxes as ymin, xmin, ymax, xmax
+    :param ndarray out_scores: detection confidences
+    :param ndarray out_classes: class indexes
+    :param list(str) class_names: class labels
+    :return list(dict):
+
+    >>> format_predictions([[10.2, 20.7, 30.1, 40.9]], [0.8], [1], ['cat', 'dog'])
+    [{'class': 1, 'label': 'dog', 'confidence': 0.8, 'ymin': 10, 'xmin': 20, 'ymax': 30, 'xmax': 40}]
+    """
+    predicts = []
+    for i, c in reversed(list(enumerate(out_classes))):
+        pred = dict(zip(
+            PREDICT_FIELDS,
+            (int(c), class_names[c], float(out_scores[i]),
+             *[int(x) for x in out_boxes[i]])
+        ))
+        predicts.append(pred)
+    return predicts
+
+
 def _rand(a=0, b=1):
     """ random number in given range
 
@@ -137,23 +192,64 @@ def image_open(path_img):
     return Image.open(update_path(path_img))
 
 
+def _color_lookup_table(hue, sat, val):
+    """lookup table of PIL HSV bands, all in range (0, 255)
+
+    >>> lut = _color_lookup_table(0.5, 2., 0.5)
+    >>> lut[:3], lut[256:259], lut[-3:]
+    ([128, 129, 130], [0, 2, 4], [126, 127, 128])
+    """
+    values = np.arange(256)
+    lut_hue = (values + int(round(hue * 256))) % 256
+    lut_sat = np.clip(np.round(values * sat), 0, 255)
+    lut_val = np.clip(np.round(values * val), 0, 255)
+    return np.concatenate([lut_hue, lut_sat, lut_val]).astype(int).tolist()
+
+
 def augment_image_color(image, hue, sat, val):
     """Randomize image colour in HSV spectrum in given range.
 
+    The colour is changed on uint8 with a lookup table of HSV bands,
+    saturation and value are clipped before converting back to RGB.
+    The output stays uint8, it is normalized once when the batch is assembled.
+
     :param image: Input image
     :param float hue: range in +/-
     :param float sat: greater then 1
     :param float val: greater then 1
-    :return:
+    :return ndarray: uint8 image
 
     >>> img = image_open(os.path.join(update_path('model_data'), 'bike-car-dog.jpg'))
-    >>> augment_image_color(img, 0.1, 1.1, 1.2).shape
-    (518, 520, 3)
+    >>> img_fast = augment_image_color(img, 0.1, 1.1, 1.2)
+    >>> img_fast.shape, img_fast.dtype
+    ((518, 520, 3), dtype('uint8'))
+    >>> augment_image_color(np.asarray(img), 0.1, 1.1, 1.2).dtype
+    dtype('uint8')
+    >>> np.random.seed(0)
+    >>> img_fast = augment_image_color(img, 0.1, 1.1, 1.2) / 255.
+    >>> np.random.seed(0)
+    >>> img_ref = _augment_image_color_matplotlib(img, 0.1, 1.1, 1.2)
+    >>> bool(np.abs(img_fast - img_ref).mean() < 0.01)
+    True
+    >>> bool(np.abs(img_fast.mean(axis=(0, 1)) - img_ref.mean(axis=(0, 1))).max() < 0.01)
+    True
     """
     hue = _rand(-hue, hue)
     sat = _rand(1 - abs(1 - sat), sat)
     val = _rand(1 - abs(1 - val), val)
 
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image, dtype=np.uint8))
+    img = image.convert('RGB').convert('HSV').point(_color_lookup_table(hue, sat, val))
+    return np.asarray(img.convert('RGB'))
+
+
+def _augment_image_color_matplotlib(image, hue, sat, val):
+    """reference implementation of :func:`augment_image_color` on float images"""
+    hue = _rand(-hue, hue)
+    sat = _rand(1 - abs(1 - sat), sat)
+    val = _rand(1 - abs(1 - val), val)
+
     img = rgb_to_hsv(np.array(image) / 255.)
     img[..., 0] += hue
     img[..., 0][img[..., 0] > 1] -= 1
@@ -297,10 +393,11 @@ def normalize_image_bboxes(image, boxes, input_shape, resize_img,
     array([[ 2,  5,  3, 10,  1]])
     """
     if resize_img:
-        img_data, scale, (dx, dy) = _scale_image_to_cnn(
+        image, scale, (dx, dy) = _scale_image_to_cnn(
             image, input_shape, allow_rnd_shift=allow_rnd_shift, interp=interp)
     else:
-        img_data, scale, (dx, dy) = _crop_image_to_cnn(image, input_shape, allow_rnd_shift)
+        image, scale, (dx, dy) = _crop_image_to_cnn(image, input_shape, allow_rnd_shift)
+    img_data = np.asarray(image) / 255.
 
     if len(boxes) == 0:
         return img_data, np.zeros((1, 5))
@@ -325,7 +422,7 @@ def _scale_image_to_cnn(image, input_shape, scaling=1., allow_rnd_shift=True,
     :param float scaling: scaling factor
     :param bool allow_rnd_shift: allow shifting image not only centered crop
     :param interp: image interpolation
-    :return:
+    :return tuple(Image,float,tuple(int,int)): RGB image of CNN input size, scale and shift
     """
     img_w, img_h = image.size
     cnn_h, cnn_w = input_shape
@@ -339,9 +436,7 @@ def _scale_image_to_cnn(image, input_shape, scaling=1., allow_rnd_shift=True,
 
     new_image = Image.new('RGB', (cnn_w, cnn_h), (128, 128, 128))
     new_image.paste(image, (dx, dy))
-    img_data = np.array(new_image) / 255.
-
-    return img_data, scale, (dx, dy)
+    return new_image, scale, (dx, dy)
 
 
 def _crop_image_to_cnn(image, input_shape, allow_rnd_shift=True):
@@ -358,9 +453,7 @@ def _crop_image_to_cnn(image, input_shape, allow_rnd_shift=True):
 
     new_image = Image.new('RGB', (cnn_w, cnn_h), (128, 128, 128))
     new_image.paste(image, (dx, dy))
-    img_data = np.array(new_image) / 255.
-
-    return img_data, 1., (dx, dy)
+    return new_image, 1., (dx, dy)
 
 
 def _image_shift(cnn_w, cnn_h, img_w, img_h, allow_rnd_shift):
@@ -416,13 +509,48 @@ def _filter_empty_bboxes(boxes, cnn_w, cnn_h, bb_sizes, bb_overlap):
     return boxes
 
 
+def _load_image(path_img, image_cache=None):
+    """open the image from the cache if it is there, otherwise from the file
+
+    :param str path_img: path to the image
+    :param image_cache: cache of decoded images, see :class:`keras_yolo3.image_cache.ImageCache`
+    :return tuple(Image,float): image and its scale with respect to the original
+    """
+    cached = image_cache.get(path_img) if image_cache is not None else None
+    if cached is None:
+        return image_open(path_img), 1.
+    img, scale = cached
+    return Image.fromarray(img), scale
+
+
+def _parse_sample(annotation_line):
+    """image path and a copy of boxes from annotation line or dataset sample
+
+    >>> _parse_sample('image.jpg 100,150,200,250,0 300,50,400,200,1')
+    ('image.jpg', array([[100, 150, 200, 250,   0],
+           [300,  50, 400, 200,   1]]))
+    """
+    if isinstance(annotation_line, str):
+        line_split = annotation_line.split()
+        path_img = line_split[0]
+        boxes = np.array([list(map(float, box.split(',')))
+                          for box in line_split[1:]]).astype(int)
+    else:
+        path_img, boxes = annotation_line
+        # make a copy, the boxes are shuffled in place
+        boxes = np.array(boxes, dtype=int)
+    return path_img, boxes
+
+
 def get_augmented_data(annotation_line, input_shape, augment=True, max_boxes=20,
                        hue=.1, sat=1.5, val=1.5, jitter=0.3, img_scaling=1.2,
                        flip_horizontal=True, flip_vertical=False, resize_img=True,
-                       allow_rnd_shift=True, bbox_overlap=0.95, interp=Image.BICUBIC):
+                       allow_rnd_shift=True, bbox_overlap=0.95, interp=Image.BICUBIC,
+                       image_cache=None):
     """augment pre-processing for real-time data augmentation
 
-    :param str annotation_line:
+    :param str|tuple(str,ndarray) annotation_line: annotation line or image path with boxes,
+        see :class:`keras_yolo3.dataset.DatasetIndex`
     :param tuple(int,int) input_shape: CNN input size
     :param bool augment: perform augmentation
     :param int max_boxes: maximal number of training bounding boxes
@@ -437,14 +565,15 @@ def get_augmented_data(annotation_line, input_shape, augment=True, max_boxes=20,
     :param bool allow_rnd_shift: allow shifting image not only centered crop
     :param float bbox_overlap: threshold in case cut image, drop all boxes with lower overlap
     :param int interp: image interpolation
-    :return:
+    :param image_cache: cache of decoded images, see :class:`keras_yolo3.image_cache.ImageCache`
+    :return tuple(ndarray,ndarray): uint8 image and boxes padded to `max_boxes`
 
     >>> np.random.seed(0)
     >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
     >>> line = path_img + ' 100,150,200,250,0 300,50,400,200,1'
     >>> image_data, box_data = get_augmented_data(line, (416, 416), augment=True)
-    >>> image_data.shape
-    (416, 416, 3)
+    >>> image_data.shape, image_data.dtype
+    ((416, 416, 3), dtype('uint8'))
     >>> box_data  # doctest: +ELLIPSIS
     array([[243.,  39., 325., 162.,   1.],
            [ 80., 121., 162., 202.,   0.],
@@ -460,21 +589,28 @@ def get_augmented_data(annotation_line, input_shape, augment=True, max_boxes=20,
            [  0.,   0.,   0.,   0.,   0.],
            ...
            [  0.,   0.,   0.,   0.,   0.]])
+    >>> sample = (path_img, np.array([[100, 150, 200, 250, 0], [300, 50, 400, 200, 1]]))
+    >>> np.random.seed(0)
+    >>> _, box_data = get_augmented_data(line, (416, 416), augment=False)
+    >>> np.random.seed(0)
+    >>> _, box_data2 = get_augmented_data(sample, (416, 416), augment=False)
+    >>> np.array_equal(box_data, box_data2)
+    True
     """
-    line_split = annotation_line.split()
-    image = image_open(line_split[0])
-    boxes = np.array([list(map(float, box.split(',')))
-                      for box in line_split[1:]]).astype(int)
+    path_img, boxes = _parse_sample(annotation_line)
+    image, img_scale = _load_image(path_img, image_cache)
+    if img_scale != 1 and len(boxes):
+        # the cached image is downscaled, so are the annotations
+        boxes[:, :4] = np.round(boxes[:, :4] * img_scale)
 
     # resize image
     # new_ar = cnn_w / cnn_h * _rand(1 - jitter, 1 + jitter) / _rand(1 - jitter, 1 + jitter)
     if resize_img:
         scaling = _rand(1 - abs(1 - img_scaling), img_scaling) if augment else 1.
-        img_data, scaling, (dx, dy) = _scale_image_to_cnn(
+        image, scaling, (dx, dy) = _scale_image_to_cnn(
             image, input_shape, scaling, allow_rnd_shift=allow_rnd_shift, interp=interp)
     else:
-        img_data, scaling, (dx, dy) = _crop_image_to_cnn(image, input_shape, allow_rnd_shift)
-    image = Image.fromarray(np.round(img_data * 255).astype(np.uint8))
+        image, scaling, (dx, dy) = _crop_image_to_cnn(image, input_shape, allow_rnd_shift)
 
     if augment:
         # flip image or not
@@ -488,6 +624,7 @@ def get_augmented_data(annotation_line, input_shape, augment=True, max_boxes=20,
         # distort image
         img_data = augment_image_color(image, hue, sat, val)
     else:
+        img_data = np.asarray(image)
         flip_horizontal = False
         flip_vertical = False
 
@@ -504,6 +641,51 @@ def get_augmented_data(annotation_line, input_shape, augment=True, max_boxes=20,
     return img_data, box_data
 
 
+def get_image_canvas(annotation_line, canvas_size, max_boxes=20, image_cache=None):
+    """place the image to the top-left corner of a grey square canvas, for augmentation
+    in the graph, see :func:`keras_yolo3.graph_augment.augment_batch`
+
+    The image is not fitted to the CNN input, it is just downscaled if it exceeds the canvas,
+    so taking the images from cache with the same maximal side as the canvas avoids any resizing.
+
+    :param str|tuple(str,ndarray) annotation_line: annotation line or image path with boxes
+    :param int canvas_size: side of the canvas
+    :param int max_boxes: maximal number of training bounding boxes
+    :param image_cache: cache of decoded images, see :class:`keras_yolo3.image_cache.ImageCache`
+    :return tuple(ndarray,ndarray,ndarray): uint8 canvas, image size as (height, width)
+        and boxes in pixels of the placed image padded to `max_boxes`
+
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> line = path_img + ' 100,150,200,250,0 300,50,400,200,1'
+    >>> canvas, size, box_data = get_image_canvas(line, 260)
+    >>> canvas.shape, canvas.dtype, size
+    ((260, 260, 3), dtype('uint8'), array([259., 260.]))
+    >>> box_data[np.argsort(box_data[:2, 4])]
+    array([[ 50.,  75., 100., 125.,   0.],
+           [150.,  25., 200., 100.,   1.]])
+    >>> int(canvas[-1, 0, 0])
+    128
+    """
+    path_img, boxes = _parse_sample(annotation_line)
+    image, img_scale = _load_image(path_img, image_cache)
+    image = image.convert('RGB')
+    if max(image.size) > canvas_size:
+        scale = float(canvas_size) / max(image.size)
+        size = tuple(min(canvas_size, int(round(s * scale))) for s in image.size)
+        img_scale *= float(size[0]) / image.size[0]
+        image = image.resize(size, Image.BICUBIC)
+    if img_scale != 1 and len(boxes):
+        boxes[:, :4] = np.round(boxes[:, :4] * img_scale)
+
+    canvas = np.full((canvas_size, canvas_size, 3), 128, dtype=np.uint8)
+    img_w, img_h = image.size
+    canvas[:img_h, :img_w] = np.asarray(image)
+    if len(boxes) > max_boxes:
+        np.random.shuffle(boxes)
+    box_data = _copy_bboxes(boxes, boxes, max_boxes)
+    return canvas, np.array([img_h, img_w], dtype=float), box_data
+
+
 def get_class_names(path_classes):
     logging.debug('loading classes from "%s"', path_classes)
     with open(path_classes) as f:
@@ -513,13 +695,10 @@ def get_class_names(path_classes):
 
 
 def get_dataset_class_names(path_train_annot, path_classes=None):
+    # import here to avoid circular import, the dataset module uses these utils
+    from .dataset import load_dataset_index
     logging.debug('loading training dataset from "%s"', path_train_annot)
-    with open(path_train_annot) as fp:
-        lines = fp.readlines()
-    classes = []
-    for ln in lines:
-        classes += [bbox.split(',')[-1] for bbox in ln.rstrip().split(' ')[1:]]
-    uq_classes = sorted(set([int(c) for c in classes]))
+    uq_classes = load_dataset_index(path_train_annot).class_ids()
     if path_classes and os.path.isfile(path_classes):
         cls_names = get_class_names(path_classes)
         uq_classes = {cls: cls_names[cls] for cls in uq_classes}
@@ -555,9 +734,27 @@ def get_anchors(path_anchors):
     return anchors
 
 
+def get_anchor_mask(num_layers):
+    """anchors of each output layer, the same as the `mask` of YOLO layers in `model_data/*.cfg`
+
+    :param int num_layers: number of output layers, 3 for full and 2 for tiny model
+    :return list(list(int)): indexes of anchors of each layer, each anchor in just one layer
+
+    >>> get_anchor_mask(3)
+    [[6, 7, 8], [3, 4, 5], [0, 1, 2]]
+    >>> get_anchor_mask(2)
+    [[3, 4, 5], [0, 1, 2]]
+    """
+    return [[6, 7, 8], [3, 4, 5], [0, 1, 2]] if num_layers == 3 else [[3, 4, 5], [0, 1, 2]]
+
+
 def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     """Preprocess true boxes to training input format
 
+    All boxes of the batch are encoded at once, the anchor IoUs and the grid
+    cells are computed for all boxes and written with fancy indexing.
+    Boxes with zero width are skipped wherever they are, not only as padding.
+
     Parameters
     ----------
     true_boxes: array, shape=(m, T, 5)
@@ -582,12 +779,93 @@ def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     3
     >>> true_boxes[0].shape
     (1, 13, 13, 3, 10)
+
+    The same output as the reference loop for batches padded by zero boxes
+
+    >>> np.random.seed(0)
+    >>> xy = np.random.randint(0, 300, (4, 20, 2))
+    >>> wh = np.random.randint(1, 100, (4, 20, 2))
+    >>> bboxes = np.concatenate([xy, xy + wh, np.random.randint(0, 5, (4, 20, 1))], axis=-1)
+    >>> for i, nb in enumerate(np.random.randint(0, 20, 4)):
+    ...     bboxes[i, nb:] = 0
+    >>> all(np.array_equal(y1, y2) for anch in (anchors, anchors[:6]) for y1, y2 in zip(
+    ...     preprocess_true_boxes(bboxes, (416, 416), anch, 5),
+    ...     _preprocess_true_boxes_loop(bboxes, (416, 416), anch, 5)))
+    True
+
+    Boxes falling to the same cell and anchor, the last one is kept
+
+    >>> bboxes = np.array([[[200 + d, 200 + d, 240 + d, 240 + d, 0] for d in range(30)]])
+    >>> y_true = preprocess_true_boxes(bboxes, (416, 416), anchors, 5)
+    >>> all(np.array_equal(y1, y2) for y1, y2 in zip(
+    ...     y_true, _preprocess_true_boxes_loop(bboxes, (416, 416), anchors, 5)))
+    True
+    """
+    assert (true_boxes[..., 4] < num_classes).all(), \
+        'class id must be less than num_classes'
+    num_layers = len(anchors) // 3  # default setting
+    anchor_mask = get_anchor_mask(num_layers)
+
+    true_boxes = np.array(true_boxes, dtype='float32')
+    input_shape = np.array(input_shape, dtype='int32')
+    boxes_xy = (true_boxes[..., 0:2] + true_boxes[..., 2:4]) // 2
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    true_boxes[..., 0:2] = boxes_xy / input_shape[::-1]
+    true_boxes[..., 2:4] = boxes_wh / input_shape[::-1]
+
+    nb_boxes = true_boxes.shape[0]
+    grid_shapes = [input_shape // {0: 32, 1: 16, 2: 8}[l]
+                   for l in range(num_layers)]
+    y_true = [np.zeros((nb_boxes, grid_shapes[l][0], grid_shapes[l][1],
+                        len(anchor_mask[l]), 5 + num_classes),
+                       dtype='float32') for l in range(num_layers)]
+
+    # Discard zero rows, keep image and box index of all valid boxes.
+    img_idx, box_idx = np.nonzero(boxes_wh[..., 0] > 0)
+    if len(img_idx) == 0:
+        return y_true
+
+    # Boxes and anchors share the center, so the intersection is given by sizes.
+    wh = np.expand_dims(boxes_wh[img_idx, box_idx], -2)
+    anchors = np.expand_dims(anchors, 0)
+    intersect_wh = np.maximum(np.minimum(wh, anchors), 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = wh[..., 0] * wh[..., 1]
+    anchor_area = anchors[..., 0] * anchors[..., 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
+
+    # Find best anchor for each true box
+    best_anchor = np.argmax(iou, axis=-1)
+    boxes = true_boxes[img_idx, box_idx]
+
+    for l in range(num_layers):
+        # boxes with the best anchor in this layer and the anchor position in the mask
+        sel, k = np.nonzero(best_anchor[:, None] == np.array(anchor_mask[l])[None, :])
+        b = img_idx[sel]
+        i = np.floor(boxes[sel, 0].astype('float64') * grid_shapes[l][1]).astype('int32')
+        j = np.floor(boxes[sel, 1].astype('float64') * grid_shapes[l][0]).astype('int32')
+        c = boxes[sel, 4].astype('int32')
+        y_true[l][b, j, i, k, 4] = 1
+        y_true[l][b, j, i, k, 5 + c] = 1
+        # for boxes in the same cell the last one wins, as when looping over them,
+        # the order of repeated fancy indices is undefined so keep just the last ones
+        cells = np.ravel_multi_index((b, j, i, k), y_true[l].shape[:4])
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        y_true[l][b[last], j[last], i[last], k[last], 0:4] = boxes[sel[last], 0:4]
+
+    return y_true
+
+
+def _preprocess_true_boxes_loop(true_boxes, input_shape, anchors, num_classes):
+    """Reference implementation of :func:`preprocess_true_boxes` looping over boxes
+
+    It is kept for testing and benchmarking the vectorized version.
     """
     assert (true_boxes[..., 4] < num_classes).all(), \
         'class id must be less than num_classes'
     num_layers = len(anchors) // 3  # default setting
-    anchor_mask = [[6, 7, 8], [3, 4, 5], [0, 1, 2]] \
-        if num_layers == 3 else [[3, 4, 5], [1, 2, 3]]
+    anchor_mask = get_anchor_mask(num_layers)
 
     true_boxes = np.array(true_boxes, dtype='float32')
     input_shape = np.array(input_shape, dtype='int32')
@@ -645,15 +923,193 @@ def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     return y_true
 
 
+def preprocess_true_boxes_sparse(true_boxes, input_shape, anchors, num_classes):
+    """Preprocess true boxes to sparse training targets, a record per box
+
+    Each box gets output layer, grid cell and anchor as in :func:`preprocess_true_boxes`,
+    the records keep the padding of `true_boxes` and the padded ones have layer -1.
+    The anchor masks are given by :func:`get_anchor_mask`, as for the dense targets.
+
+    Parameters
+    ----------
+    true_boxes: array, shape=(m, T, 5)
+        Absolute x_min, y_min, x_max, y_max, class_id relative to input_shape.
+    input_shape: array-like, hw, multiples of 32
+    anchors: array, shape=(N, 2), wh
+    num_classes: integer
+
+    Returns
+    -------
+    records: array, shape=(m, T, 9), see `SPARSE_TARGET_COLUMNS`, xywh are reletive value
+
+    Example
+    -------
+    >>> bboxes = [[100, 150, 200, 250, 0], [300, 50, 400, 200, 1], [0, 0, 0, 0, 0]]
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> records = preprocess_true_boxes_sparse(np.array([bboxes]), (416, 416), anchors, 5)
+    >>> records.shape
+    (1, 3, 9)
+    >>> records[0, :, :4]
+    array([[ 0.,  6.,  4.,  0.],
+           [ 0.,  3., 10.,  0.],
+           [-1.,  0.,  0.,  0.]], dtype=float32)
+
+    Scattered to the grid it gives the same targets as the dense encoding
+
+    >>> np.random.seed(0)
+    >>> xy = np.random.randint(0, 300, (4, 20, 2))
+    >>> wh = np.random.randint(1, 100, (4, 20, 2))
+    >>> bboxes = np.concatenate([xy, xy + wh, np.random.randint(0, 5, (4, 20, 1))], axis=-1)
+    >>> for i, nb in enumerate(np.random.randint(0, 20, 4)):
+    ...     bboxes[i, nb:] = 0
+    >>> records = preprocess_true_boxes_sparse(bboxes, (416, 416), anchors, 5)
+    >>> all(np.array_equal(y1, y2) for y1, y2 in zip(
+    ...     _sparse_to_dense_targets(records, (416, 416), 3, 5),
+    ...     preprocess_true_boxes(bboxes, (416, 416), anchors, 5)))
+    True
+
+    The same for the tiny model with two output layers
+
+    >>> records = preprocess_true_boxes_sparse(bboxes, (416, 416), anchors[:6], 5)
+    >>> all(np.array_equal(y1, y2) for y1, y2 in zip(
+    ...     _sparse_to_dense_targets(records, (416, 416), 2, 5),
+    ...     preprocess_true_boxes(bboxes, (416, 416), anchors[:6], 5)))
+    True
+    """
+    assert (true_boxes[..., 4] < num_classes).all(), \
+        'class id must be less than num_classes'
+    num_layers = len(anchors) // 3  # default setting
+    anchor_mask = get_anchor_mask(num_layers)
+    # output layer and position in its mask of each anchor
+    anchor_layer, anchor_pos = np.zeros(len(anchors), dtype=int), np.zeros(len(anchors), dtype=int)
+    for l, mask in enumerate(anchor_mask):
+        anchor_layer[mask] = l
+        anchor_pos[mask] = range(len(mask))
+
+    true_boxes = np.array(true_boxes, dtype='float32')
+    input_shape = np.array(input_shape, dtype='int32')
+    boxes_xy = (true_boxes[..., 0:2] + true_boxes[..., 2:4]) // 2
+    boxes_wh = true_boxes[..., 2:4] - true_boxes[..., 0:2]
+    records = np.zeros(true_boxes.shape[:2] + (len(SPARSE_TARGET_COLUMNS), ), dtype='float32')
+    records[..., 0] = -1
+    records[..., 4:6] = boxes_xy / input_shape[::-1]
+    records[..., 6:8] = boxes_wh / input_shape[::-1]
+    records[..., 8] = true_boxes[..., 4]
+
+    img_idx, box_idx = np.nonzero(boxes_wh[..., 0] > 0)
+    if len(img_idx) == 0:
+        return records
+
+    # Boxes and anchors share the center, so the intersection is given by sizes.
+    wh = np.expand_dims(boxes_wh[img_idx, box_idx], -2)
+    anchors = np.expand_dims(anchors, 0)
+    intersect_wh = np.maximum(np.minimum(wh, anchors), 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    box_area = wh[..., 0] * wh[..., 1]
+    anchor_area = anchors[..., 0] * anchors[..., 1]
+    iou = intersect_area / (box_area + anchor_area - intersect_area)
+    best_anchor = np.argmax(iou, axis=-1)
+
+    layer = anchor_layer[best_anchor]
+    grid_shapes = input_shape // np.array([32, 16, 8])[layer, None]
+    xy = records[img_idx, box_idx, 4:6].astype('float64')
+    records[img_idx, box_idx, 0] = layer
+    records[img_idx, box_idx, 1] = np.floor(xy[:, 1] * grid_shapes[:, 0])
+    records[img_idx, box_idx, 2] = np.floor(xy[:, 0] * grid_shapes[:, 1])
+    records[img_idx, box_idx, 3] = anchor_pos[best_anchor]
+    return records
+
+
+def _sparse_to_dense_targets(records, input_shape, num_layers, num_classes):
+    """scatter sparse targets to the dense ones, for testing
+
+    Boxes in the same cell overwrite each other and their classes are joined,
+    as in :func:`preprocess_true_boxes`.
+    """
+    y_true = [np.zeros((len(records), input_shape[0] // s, input_shape[1] // s,
+                        3, 5 + num_classes), dtype='float32')
+              for s in (32, 16, 8)[:num_layers]]
+    b, t = np.nonzero(records[..., 0] >= 0)
+    l, j, i, k = records[b, t, :4].astype(int).T
+    for n in range(len(b)):
+        y_true[l[n]][b[n], j[n], i[n], k[n], :4] = records[b[n], t[n], 4:8]
+        y_true[l[n]][b[n], j[n], i[n], k[n], 4] = 1
+        y_true[l[n]][b[n], j[n], i[n], k[n], 5 + int(records[b[n], t[n], 8])] = 1
+    return y_true
+
+
+def get_augmented_sample(annotation_line, input_shape, anchors, nb_classes, sparse_targets=False, **kwargs):
+    """augment single sample and encode its training targets, it runs in the data workers
+
+    :param str|tuple(str,ndarray) annotation_line: annotation line or image path with boxes
+    :param tuple(int,int) input_shape: CNN input size
+    :param ndarray anchors:
+    :param int nb_classes:
+    :param bool sparse_targets: encode records of boxes, see :func:`preprocess_true_boxes_sparse`
+    :param kwargs: parameters of :func:`get_augmented_data`
+    :return tuple(ndarray,list(ndarray)): uint8 image and targets of all output layers
+
+    >>> path_img = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+    >>> line = path_img + ' 100,150,200,250,0 300,50,400,200,1'
+    >>> anchors = get_anchors(os.path.join(update_path('model_data'), 'yolo_anchors.csv'))
+    >>> image_data, y_true = get_augmented_sample(line, (416, 416), anchors, 3, augment=False)
+    >>> image_data.shape, [y.shape for y in y_true]
+    ((416, 416, 3), [(13, 13, 3, 8), (26, 26, 3, 8), (52, 52, 3, 8)])
+    >>> [int(y[..., 4].sum()) for y in y_true]
+    [1, 1, 0]
+    >>> _, y_true = get_augmented_sample(line, (416, 416), anchors, 3, sparse_targets=True, augment=False)
+    >>> [y.shape for y in y_true]
+    [(20, 9)]
+    """
+    image_data, box_data = get_augmented_data(annotation_line, input_shape, **kwargs)
+    if sparse_targets:
+        records = preprocess_true_boxes_sparse(box_data[np.newaxis], input_shape, anchors, nb_classes)
+        return image_data, [records[0]]
+    y_true = preprocess_true_boxes(box_data[np.newaxis], input_shape, anchors, nb_classes)
+    return image_data, [y[0] for y in y_true]
+
+
+def augmentation_params(augment=True, max_boxes=20, jitter=0.3, img_scaling=1.2, resize_img=True,
+                        allow_rnd_shift=True, color_hue=0.1, color_sat=1.5, color_val=1.5,
+                        flip_horizontal=True, flip_vertical=False, bbox_overlap=0.95,
+                        image_cache=None):
+    """convert generator configuration to parameters of :func:`get_augmented_data`
+
+    >>> sorted(augmentation_params(color_sat=0.5).items())  # doctest: +ELLIPSIS
+    [('allow_rnd_shift', True), ('augment', True), ..., ('sat', 2.0), ('val', 1.5)]
+    """
+    return dict(
+        augment=augment,
+        max_boxes=max_boxes,
+        jitter=jitter,
+        resize_img=resize_img,
+        img_scaling=img_scaling,
+        allow_rnd_shift=allow_rnd_shift,
+        hue=abs(color_hue),
+        sat=color_sat if color_sat > 1 else 1. / color_sat,
+        val=color_val if color_val > 1 else 1. / color_val,
+        flip_horizontal=flip_horizontal,
+        flip_vertical=flip_vertical,
+        bbox_overlap=bbox_overlap,
+        image_cache=image_cache,
+    )
+
+
 def data_generator(annotation_lines, input_shape, anchors, nb_classes,
                    batch_size=1, augment=True, max_boxes=20,
                    jitter=0.3, img_scaling=1.2, resize_img=True, allow_rnd_shift=True,
                    color_hue=0.1, color_sat=1.5, color_val=1.5,
                    flip_horizontal=True, flip_vertical=False,
-                   bbox_overlap=0.95, nb_threads=1):
+                   bbox_overlap=0.95, nb_threads=1, image_cache=None, nb_buffers=None):
     """data generator for fit_generator
 
-    :param list(str) annotation_lines:
+    With `nb_buffers` the batches are written to a ring of preallocated float32 buffers,
+    so a yielded batch is valid until `nb_buffers - 1` next batches are generated,
+    by default each batch gets new arrays, so it can be queued safely.
+    The samples stay uint8 and the images are normalized once for the whole batch.
+
+    :param list(str)|DatasetIndex annotation_lines: annotation lines or samples,
+        see :class:`keras_yolo3.dataset.DatasetIndex`
     :param int batch_size:
     :param ndarray anchors:
     :param int nb_classes:
@@ -671,6 +1127,10 @@ def data_generator(annotation_lines, input_shape, anchors, nb_classes,
     :param bool allow_rnd_shift: allow shifting image not only centered crop
     :param float bbox_overlap: threshold in case cut image, drop all boxes with lower overlap
     :param float|int nb_threads: nb threads running in parallel
+    :param image_cache: cache of decoded images, see :class:`keras_yolo3.image_cache.ImageCache`
+    :param int|None nb_buffers: number of reused batch buffers, it has to be larger than
+        the number of batches held by the consumer, e.g. `max_queue_size + workers + 1`
+        for Keras, see :func:`keras_buffers`; None for new arrays for each batch
     :return:
 
     >>> np.random.seed(0)
@@ -689,67 +1149,90 @@ def data_generator(annotation_lines, input_shape, anchors, nb_classes,
     2
     >>> [b.shape for b in batch[0]]
     [(1, 416, 416, 3), (1, 13, 13, 3, 8), (1, 26, 26, 3, 8), (1, 52, 52, 3, 8)]
+    >>> batch[0][0].dtype
+    dtype('float32')
+    >>> batch2 = next(gen)
+    >>> np.shares_memory(batch[0][0], batch2[0][0])
+    False
+    >>> gen = data_generator([line], (416, 416), anchors, 3, augment=False, nb_buffers=2)
+    >>> batch, batch2, batch3 = next(gen), next(gen), next(gen)
+    >>> batch[0][0] is batch3[0][0], batch[0][0] is batch2[0][0]
+    (True, False)
     """
+    # import here to avoid circular import, the pool runs `get_augmented_sample`
+    from .shared_pool import SharedBatchPool, _target_shapes
+    annotation_lines = list(annotation_lines)
     nb_lines = len(annotation_lines)
-    circ_i = 0
     if nb_lines == 0 or batch_size <= 0:
         return None
 
-    color_hue = abs(color_hue)
-    color_sat = color_sat if color_sat > 1 else 1. / color_sat
-    color_val = color_val if color_val > 1 else 1. / color_val
+    kwargs_augment = augmentation_params(
+        augment=augment, max_boxes=max_boxes, jitter=jitter, img_scaling=img_scaling,
+        resize_img=resize_img, allow_rnd_shift=allow_rnd_shift, color_hue=color_hue,
+        color_sat=color_sat, color_val=color_val, flip_horizontal=flip_horizontal,
+        flip_vertical=flip_vertical, bbox_overlap=bbox_overlap, image_cache=image_cache)
+    batch_indices = _iter_batch_indices(nb_lines, batch_size)
+    item_shapes = [tuple(input_shape) + (3, )] + _target_shapes(input_shape, len(anchors), nb_classes)
+    buffers = None
+    if nb_buffers:
+        buffers = [[np.zeros((batch_size, ) + shape, dtype=np.float32) for shape in item_shapes]
+                   for _ in range(max(2, nb_buffers))]
+    dummy_targets = np.zeros(batch_size)
 
     nb_threads = nb_workers(nb_threads)
-    pool = ProcessPool(nb_threads) if nb_threads > 1 else None
-    _wrap_rand_data = partial(
-        get_augmented_data,
-        input_shape=input_shape,
-        augment=augment,
-        max_boxes=max_boxes,
-        jitter=jitter,
-        resize_img=resize_img,
-        img_scaling=img_scaling,
-        allow_rnd_shift=allow_rnd_shift,
-        hue=color_hue,
-        sat=color_sat,
-        val=color_val,
-        flip_horizontal=flip_horizontal,
-        flip_vertical=flip_vertical,
-        bbox_overlap=bbox_overlap,
-    )
+    if nb_threads > 1:
+        # persistent workers get just sample indexes and fill batches in shared memory
+        with SharedBatchPool(annotation_lines, input_shape, anchors, nb_classes, batch_size,
+                             nb_workers=nb_threads, **kwargs_augment) as pool:
+            for batch_image_data, y_true in pool.iter_batches(batch_indices, buffers=buffers):
+                yield [batch_image_data, *y_true], dummy_targets
+
+    _wrap_rand_data = partial(get_augmented_sample, input_shape=input_shape, anchors=anchors,
+                              nb_classes=nb_classes, **kwargs_augment)
+    for n, idxs in enumerate(batch_indices):
+        batch = buffers[n % len(buffers)] if buffers \
+            else [np.empty((batch_size, ) + shape, dtype=np.float32) for shape in item_shapes]
+        for pos, i in enumerate(idxs):
+            image, y_true = _wrap_rand_data(annotation_lines[i])
+            batch[0][pos] = image
+            for buffer, y in zip(batch[1:], y_true):
+                buffer[pos] = y
+        np.multiply(batch[0], 1. / 255, out=batch[0])
+        yield list(batch), dummy_targets
+
+
+def keras_buffers(max_queue_size=10, workers=1):
+    """number of batch buffers of :func:`data_generator` safe for Keras `fit_generator`,
+    the enqueuer holds up to `max_queue_size` batches and each worker one more
+
+    >>> keras_buffers()
+    12
+    """
+    return max_queue_size + max(1, workers) + 1
 
+
+def _iter_batch_indices(nb_samples, batch_size):
+    """infinite sequence of sample indexes of each batch, shuffled for every cycle
+
+    >>> np.random.seed(0)
+    >>> gen = _iter_batch_indices(5, 2)
+    >>> [next(gen).tolist() for _ in range(4)]
+    [[2, 0], [1, 3], [4, 2], [1, 0]]
+    """
+    order = np.arange(nb_samples)
+    circ_i = 0
     while True:
         if circ_i < batch_size:
             # shuffle while you are starting new cycle
-            np.random.shuffle(annotation_lines)
-        batch_image_data = []
-        batch_box_data = []
-
-        # create the list of lines to be loaded in batch
-        annot_lines = annotation_lines[circ_i:circ_i + batch_size]
-        batch_offset = (circ_i + batch_size) - nb_lines
-        # chekck if the loaded batch size have sufficient size
+            np.random.shuffle(order)
+        # create the list of samples to be loaded in batch
+        idxs = order[circ_i:circ_i + batch_size]
+        batch_offset = (circ_i + batch_size) - nb_samples
+        # check if the loaded batch size have sufficient size
         if batch_offset > 0:
-            annot_lines += annotation_lines[:batch_offset]
-        # multiprocessing loading of batch data
-        map_process = pool.imap if pool else map
-        for image, box in map_process(_wrap_rand_data, annot_lines):
-            batch_image_data.append(image)
-            batch_box_data.append(box)
-
-        circ_i = (circ_i + batch_size) % nb_lines
-
-        batch_image_data = np.array(batch_image_data)
-        batch_box_data = np.array(batch_box_data)
-        y_true = preprocess_true_boxes(batch_box_data, input_shape, anchors, nb_classes)
-        batch = [batch_image_data, *y_true], np.zeros(batch_size)
-        yield batch
-        gc.collect()
-
-    if pool:
-        pool.close()
-        pool.join()
-        pool.clear()
+            idxs = np.concatenate([idxs, order[:batch_offset]])
+        circ_i = (circ_i + batch_size) % nb_samples
+        yield idxs
 
 
 def generator_bottleneck(annotation_lines, batch_size, input_shape, anchors, nb_classes,
@@ -4,6 +4,7 @@ Visualisation module
 """
 
 import logging
+import colorsys
 
 import numpy as np
 from PIL import ImageDraw
@@ -61,6 +62,52 @@ def draw_bounding_box(image, predicted_class, box, score=None, color=(255, 0, 0)
     return image
 
 
+def generate_class_colors(nb_classes):
+    """Generate colors for drawing bounding boxes.
+
+    :param int nb_classes: number of classes
+    :return list(tuple(int,int,int)):
+
+    >>> generate_class_colors(3)
+    [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
+    """
+    hsv_tuples = [(x / nb_classes, 1., 1.) for x in range(nb_classes)]
+    colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
+    _fn_colorr = lambda x: (int(x[0] * 255), int(x[1] * 255), int(x[2] * 255))
+    colors = list(map(_fn_colorr, colors))
+    # Fixed seed for consistent colors across runs, without touching the global state.
+    # Shuffle colors to decorrelate adjacent classes.
+    rnd_state = np.random.get_state()
+    np.random.seed(10101)
+    np.random.shuffle(colors)
+    np.random.set_state(rnd_state)
+    return colors
+
+
+def draw_predictions(image, predicts, colors):
+    """draw all predicted bounding boxes to the image
+
+    :param Image image: input image
+    :param list(dict) predicts: predictions with `PREDICT_FIELDS`
+    :param list(tuple(int,int,int)) colors: color per class
+    :return Image:
+
+    >>> import os
+    >>> from keras_yolo3.utils import update_path, image_open
+    >>> img = image_open(os.path.join(update_path('model_data'), 'bike-car-dog.jpg'))
+    >>> preds = [{'class': 1, 'label': 'dog', 'confidence': 0.8,
+    ...           'ymin': 150, 'xmin': 200, 'ymax': 250, 'xmax': 300}]
+    >>> draw_predictions(img, preds, generate_class_colors(2))  # doctest: +ELLIPSIS
+    <PIL.JpegImagePlugin.JpegImageFile image mode=RGB size=520x518 at ...>
+    """
+    thickness = (image.size[0] + image.size[1]) // 500
+    for pred in predicts:
+        box = [pred['ymin'], pred['xmin'], pred['ymax'], pred['xmax']]
+        draw_bounding_box(image, pred['label'], box, pred['confidence'],
+                          colors[pred['class']], thickness)
+    return image
+
+
 def _draw_bbox(ax, bbox, color='r'):
     x_min, y_min, x_max, y_max = bbox[:4]
     if (x_max - x_min) * (y_max - y_min) == 0:
@@ -6,7 +6,6 @@ Class definition of YOLO_v3 style detection model on image and video
 import os
 import time
 import logging
-import colorsys
 
 import numpy as np
 import keras.backend as K
@@ -15,11 +14,9 @@ from keras.layers import Input
 from keras.utils import multi_gpu_model
 
 from .model import yolo_eval, yolo_body_full, yolo_body_tiny
-from .utils import letterbox_image, update_path, get_anchors, get_class_names
-from .visual import draw_bounding_box
-
-# swap X-Y axis
-PREDICT_FIELDS = ('class', 'label', 'confidence', 'ymin', 'xmin', 'ymax', 'xmax')
+from .utils import (
+    letterbox_image, update_path, get_anchors, get_class_names, format_predictions)
+from .visual import draw_predictions, generate_class_colors
 
 
 class YOLO(object):
@@ -42,6 +39,9 @@ class YOLO(object):
     >>> img = image_open(os.path.join(update_path('model_data'), 'bike-car-dog.jpg'))
     >>> yolo.detect_image(img)  # doctest: +ELLIPSIS
     (<PIL.JpegImagePlugin.JpegImageFile image mode=RGB size=520x518 at ...>, [...])
+    >>> results = yolo.detect_batch([img, img.copy()], render=False)
+    >>> [type(preds) for _, preds in results]
+    [<class 'list'>, <class 'list'>]
     """
 
     _DEFAULT_PARAMS = {
@@ -153,18 +153,14 @@ class YOLO(object):
 
     def _generate_class_colors(self):
         """Generate colors for drawing bounding boxes."""
-        hsv_tuples = [(x / len(self.class_names), 1., 1.)
-                      for x in range(len(self.class_names))]
-        self.colors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_tuples))
-        _fn_colorr = lambda x: (int(x[0] * 255), int(x[1] * 255), int(x[2] * 255))
-        self.colors = list(map(_fn_colorr, self.colors))
-        np.random.seed(10101)  # Fixed seed for consistent colors across runs.
-        # Shuffle colors to decorrelate adjacent classes.
-        np.random.shuffle(self.colors)
-        np.random.seed(None)  # Reset seed to default.
-
-    def detect_image(self, image):
-        start = time.time()
+        self.colors = generate_class_colors(len(self.class_names))
+
+    def preprocess_image(self, image):
+        """letterbox the image to the model input and normalize it
+
+        :param Image image: input image
+        :return ndarray: float32 image data in shape (height, width, 3)
+        """
         # this should be taken from the model
         model_image_size = self.yolo_model._input_layers[0].input_shape[1:3]
 
@@ -181,6 +177,23 @@ class YOLO(object):
         logging.debug('image shape: %s', repr(image_data.shape))
         if image_data.max() > 1.5:
             image_data /= 255.
+        return image_data
+
+    def _postprocess(self, image, out_boxes, out_scores, out_classes, render=True):
+        predicts = format_predictions(out_boxes, out_scores, out_classes, self.class_names)
+        if render:
+            draw_predictions(image, predicts, self.colors)
+        return image, predicts
+
+    def detect_image(self, image, render=True):
+        """detect objects in single image
+
+        :param Image image: input image
+        :param bool render: draw the detections to the image
+        :return tuple(Image,list(dict)): image and predictions
+        """
+        start = time.time()
+        image_data = self.preprocess_image(image)
         image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
 
         out_boxes, out_scores, out_classes = self.sess.run(
@@ -194,19 +207,45 @@ class YOLO(object):
         end = time.time()
         logging.debug('Found %i boxes in %f sec.', len(out_boxes), (end - start))
 
-        thickness = (image.size[0] + image.size[1]) // 500
-
-        predicts = []
-        for i, c in reversed(list(enumerate(out_classes))):
-            draw_bounding_box(image, self.class_names[c], out_boxes[i],
-                              out_scores[i], self.colors[c], thickness)
-            pred = dict(zip(
-                PREDICT_FIELDS,
-                (int(c), self.class_names[c], float(out_scores[i]),
-                 *[int(x) for x in out_boxes[i]])
-            ))
-            predicts.append(pred)
-        return image, predicts
+        return self._postprocess(image, out_boxes, out_scores, out_classes, render)
+
+    def detect_batch(self, images, images_data=None, render=True):
+        """detect objects in a batch of images, running the CNN on all of them at once
+
+        The CNN features are computed for whole batch and the box filtering
+        is evaluated per image by feeding the features back to the graph.
+
+        :param list(Image) images: input images
+        :param list(ndarray) images_data: already preprocessed images,
+            see :meth:`preprocess_image`, for example prepared in parallel
+        :param bool render: draw the detections to the images
+        :return list(tuple(Image,list(dict))): images and predictions, in the input order
+        """
+        start = time.time()
+        if images_data is None:
+            images_data = [self.preprocess_image(img) for img in images]
+        results = [None] * len(images)
+        # only images of the same shape can be stacked, which is always the case for fixed model size
+        for shape in set(img.shape for img in images_data):
+            idxs = [i for i, img in enumerate(images_data) if img.shape == shape]
+            features = self.sess.run(
+                self.yolo_model.output,
+                feed_dict={
+                    self.yolo_model.input: np.array([images_data[i] for i in idxs]),
+                    K.learning_phase(): 0
+                })
+            for j, i in enumerate(idxs):
+                feed_dict = {out: feat[j:j + 1] for out, feat in zip(self.yolo_model.output, features)}
+                feed_dict.update({
+                    self.input_image_shape: [images[i].size[1], images[i].size[0]],
+                    K.learning_phase(): 0
+                })
+                out_boxes, out_scores, out_classes = self.sess.run(
+                    [self.boxes, self.scores, self.classes], feed_dict=feed_dict)
+                results[i] = self._postprocess(images[i], out_boxes, out_scores, out_classes, render)
+
+        logging.debug('Processed batch of %i images in %f sec.', len(images), time.time() - start)
+        return results
 
     def _close_session(self):
         self.sess.close()
@@ -0,0 +1,328 @@
+"""
+Micro-benchmarks of the training pipeline, each task compares
+the current implementation with the reference one.
+
+    python benchmark.py true-boxes --batch_size 16 --nb_boxes 20 --nb_classes 80
+    python benchmark.py color --hue 0.1 --sat 1.5 --val 1.5
+    python benchmark.py generator --batch_size 8 --nb_batches 50
+    python benchmark.py ignore-mask --batch_size 8 --nb_boxes 20
+    python benchmark.py recompute --batch_sizes 1 2 4 --image_size 608 608
+    python benchmark.py data-parallel --nb_processes 1 2 4 8 --batch_size 4
+    python benchmark.py tfrecords --path_dataset ../model_data/VOC_2007_train.txt \
+        --path_shards ../model_data/tfrecords/voc-train-*.tfrecord
+
+"""
+
+import os
+import sys
+import time
+import glob
+import argparse
+import logging
+import tracemalloc
+
+import numpy as np
+
+sys.path += [os.path.abspath('.'), os.path.abspath('..')]
+from keras_yolo3.utils import (
+    update_path, get_anchors, image_open, preprocess_true_boxes, _preprocess_true_boxes_loop,
+    augment_image_color, _augment_image_color_matplotlib, augmentation_params, data_generator)
+from keras_yolo3.dataset import load_dataset_index
+
+PATH_ANCHORS = os.path.join(update_path('model_data'), 'yolo_anchors.csv')
+PATH_ANCHORS_TINY = os.path.join(update_path('model_data'), 'tiny-yolo_anchors.csv')
+PATH_IMAGE = os.path.join(update_path('model_data'), 'bike-car-dog.jpg')
+
+
+def _timeit(func, repeat):
+    """run the function several times and return the mean time in ms"""
+    func()  # warm-up
+    t_start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - t_start) / repeat * 1e3
+
+
+def _peak_memory(func):
+    """peak memory in MB traced during a single run, it covers numpy arrays but not PIL buffers"""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024. ** 2
+
+
+def _random_boxes(batch_size, nb_boxes, image_size, nb_classes):
+    """random boxes padded by zeros as produced by the data generator"""
+    img_h, img_w = image_size
+    xy = np.random.randint(0, min(img_h, img_w) // 2, (batch_size, nb_boxes, 2))
+    wh = np.random.randint(8, min(img_h, img_w) // 2, (batch_size, nb_boxes, 2))
+    boxes = np.concatenate([xy, xy + wh, np.random.randint(0, nb_classes, (batch_size, nb_boxes, 1))],
+                           axis=-1)
+    for i, nb in enumerate(np.random.randint(1, nb_boxes + 1, batch_size)):
+        boxes[i, nb:] = 0
+    return boxes
+
+
+def bench_true_boxes(batch_size=16, nb_boxes=20, nb_classes=80, image_size=(416, 416),
+                     repeat=50, path_anchors=PATH_ANCHORS):
+    anchors = get_anchors(path_anchors)
+    boxes = _random_boxes(batch_size, nb_boxes, image_size, nb_classes)
+    results = {}
+    for name, func in (('loop', _preprocess_true_boxes_loop),
+                       ('vectorized', preprocess_true_boxes)):
+        results[name] = _timeit(lambda: func(boxes, image_size, anchors, nb_classes), repeat)
+        logging.info('%s: %.3f ms per batch', name, results[name])
+    logging.info('speed-up: %.2fx', results['loop'] / results['vectorized'])
+    return results
+
+
+def bench_color(hue=0.1, sat=1.5, val=1.5, image_size=(416, 416), repeat=50, path_image=PATH_IMAGE):
+    image = image_open(path_image).convert('RGB').resize(tuple(image_size))
+    results = {}
+    for name, func in (('matplotlib', _augment_image_color_matplotlib),
+                       ('lookup-table', augment_image_color)):
+        results[name] = _timeit(lambda: func(image, hue, sat, val), repeat)
+        memory = _peak_memory(lambda: func(image, hue, sat, val))
+        logging.info('%s: %.3f ms and %.1f MB per sample', name, results[name], memory)
+    logging.info('speed-up: %.2fx', results['matplotlib'] / results['lookup-table'])
+    return results
+
+
+def _samples_per_second(batches, batch_size, nb_batches):
+    next(batches)  # warm-up, it starts the workers
+    t_start = time.time()
+    for _ in range(nb_batches):
+        next(batches)
+    return nb_batches * batch_size / (time.time() - t_start)
+
+
+def bench_generator(batch_size=8, nb_batches=50, image_size=(416, 416), nb_threads=1,
+                    path_image=PATH_IMAGE, path_anchors=PATH_ANCHORS):
+    anchors = get_anchors(path_anchors)
+    lines = [path_image + ' 100,150,200,250,0 300,50,400,200,1'] * batch_size
+    gen = data_generator(lines, image_size, anchors, 3, batch_size=batch_size, nb_threads=nb_threads)
+    next(gen)  # warm-up, it allocates the buffers
+    tracemalloc.start()
+    memory = []
+    t_start = time.time()
+    for _ in range(nb_batches):
+        next(gen)
+        memory.append(tracemalloc.get_traced_memory()[0] / 1024. ** 2)
+    elapsed = (time.time() - t_start) / nb_batches * 1e3
+    tracemalloc.stop()
+    gen.close()
+    logging.info('%.1f ms per batch, traced memory %.1f MB after the first and %.1f MB after the last batch',
+                 elapsed, memory[0], memory[-1])
+    return elapsed, memory
+
+
+def bench_tfrecords(path_dataset, path_shards, batch_size=16, nb_batches=20, image_size=(416, 416),
+                    nb_threads=4, path_anchors=PATH_ANCHORS):
+    # TensorFlow is loaded only for this task
+    import tensorflow as tf
+    from keras_yolo3.tfrecords import create_dataset, iterate_dataset
+    from keras_yolo3.graph_augment import GRAPH_AUGMENT_PARAMS
+
+    anchors = get_anchors(path_anchors)
+    index = load_dataset_index(path_dataset)
+    nb_classes = max(index.class_ids()) + 1
+    params = augmentation_params()
+    results = {}
+    gen = data_generator(list(index), image_size, anchors, nb_classes, batch_size=batch_size,
+                         nb_threads=nb_threads)
+    results['data_generator'] = _samples_per_second(gen, batch_size, nb_batches)
+    gen.close()
+    dataset = create_dataset(sorted(glob.glob(path_shards)), image_size, anchors, nb_classes,
+                             batch_size=batch_size, max_boxes=params['max_boxes'], nb_parallel=nb_threads,
+                             **{k: params[k] for k in GRAPH_AUGMENT_PARAMS})
+    with tf.Session() as sess:
+        results['tf.data'] = _samples_per_second(iterate_dataset(dataset, sess), batch_size, nb_batches)
+    for name, speed in results.items():
+        logging.info('%s: %.1f samples per second', name, speed)
+    return results
+
+
+def bench_ignore_mask(batch_size=8, nb_boxes=20, image_size=(416, 416), repeat=20,
+                      path_anchors=PATH_ANCHORS):
+    # TensorFlow is loaded only for this task
+    import tensorflow as tf
+    import keras.backend as K
+    from keras_yolo3.model import _ignore_mask_dense, _ignore_mask_loop
+
+    anchors = get_anchors(path_anchors)
+    boxes = _random_boxes(batch_size, nb_boxes, image_size, 1)
+    y_true = preprocess_true_boxes(boxes, image_size, anchors, 1)
+    pred_boxes = [np.random.rand(*y.shape[:-1], 4).astype(np.float32) for y in y_true]
+    # fed as placeholders, so the graph is not folded to constants
+    inputs = [(K.placeholder(pred.shape), K.placeholder(y.shape)) for pred, y in zip(pred_boxes, y_true)]
+    feed = dict(zip([x for pair in inputs for x in pair], [x for pair in zip(pred_boxes, y_true) for x in pair]))
+    results = {}
+    with tf.Session() as sess:
+        for name, func in (('loop', _ignore_mask_loop), ('vectorized', _ignore_mask_dense)):
+            masks = [func(pred, y, 0.5) for pred, y in inputs]
+            results[name] = _timeit(lambda: sess.run(masks, feed_dict=feed), repeat)
+            logging.info('%s: %.3f ms per batch', name, results[name])
+    logging.info('speed-up: %.2fx', results['loop'] / results['vectorized'])
+    return results
+
+
+def _peak_step_memory(run_metadata):
+    """peak memory in MB of tensors allocated during a traced TF step, so without the weights"""
+    records = [(rec.alloc_micros, rec.alloc_bytes)
+               for dev in run_metadata.step_stats.dev_stats
+               for node in dev.node_stats
+               for mem in node.memory
+               for rec in mem.allocation_records]
+    # the deallocations are records with negative bytes
+    in_use = np.cumsum([nb for _, nb in sorted(records)])
+    return (in_use.max() if len(in_use) else 0) / 1024. ** 2
+
+
+def bench_recompute(batch_sizes=(1, 2, 4), image_size=(608, 608), nb_classes=80, repeat=3,
+                    path_anchors=PATH_ANCHORS):
+    # TensorFlow is loaded only for this task
+    import tensorflow as tf
+    import keras.backend as K
+    from keras_yolo3.model import create_model
+    from keras_yolo3.optimizers import create_optimizer
+
+    anchors = get_anchors(path_anchors)
+    results = {}
+    for batch_size in batch_sizes:
+        boxes = _random_boxes(batch_size, 20, image_size, nb_classes)
+        y_true = preprocess_true_boxes(boxes, image_size, anchors, nb_classes)
+        images = np.random.rand(batch_size, *image_size, 3)
+        for name, recompute in (('stored', False), ('recomputed', True)):
+            K.clear_session()
+            model = create_model(image_size, anchors, nb_classes, freeze_body=0, recompute_body=recompute)
+            model.compile(optimizer=create_optimizer(checkpoint_layers=model.checkpoint_layers),
+                          loss={'yolo_loss': lambda y_true, y_pred: y_pred})
+            time_step = _timeit(lambda: model.train_on_batch([images, *y_true], np.zeros(batch_size)), repeat)
+            # trace just one more step, the tracing slows the training
+            run_metadata = tf.RunMetadata()
+            model.train_function.run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            model.train_function.run_metadata = run_metadata
+            model.train_function._callable_fn = None
+            model.train_on_batch([images, *y_true], np.zeros(batch_size))
+            results[(batch_size, name)] = (_peak_step_memory(run_metadata), time_step)
+            logging.info('batch %i, %s activations: peak %.0f MB, %.0f ms per step',
+                         batch_size, name, *results[(batch_size, name)])
+        (mem_stored, time_stored), (mem_recomp, time_recomp) = \
+            results[(batch_size, 'stored')], results[(batch_size, 'recomputed')]
+        logging.info('batch %i: %.2fx peak memory for %.2fx time',
+                     batch_size, mem_recomp / mem_stored, time_recomp / time_stored)
+    return results
+
+
+def _train_synthetic(data_parallel, batch_size, nb_batches, image_size, nb_classes, path_anchors):
+    """time of training steps on random batches in a data-parallel worker"""
+    from keras_yolo3.model import create_model, create_model_tiny
+    from keras_yolo3.optimizers import create_optimizer
+
+    anchors = get_anchors(path_anchors)
+    _create_model = create_model_tiny if len(anchors) == 6 else create_model
+    model = _create_model(image_size, anchors, nb_classes, freeze_body=0)
+    model.compile(optimizer=data_parallel.wrap_optimizer(create_optimizer()),
+                  loss={'yolo_loss': lambda y_true, y_pred: y_pred})
+    data_parallel.broadcast_weights(model)
+    boxes = _random_boxes(batch_size, 20, image_size, nb_classes)
+    inputs = [np.random.rand(batch_size, *image_size, 3)] + preprocess_true_boxes(
+        boxes, image_size, anchors, nb_classes)
+    return _timeit(lambda: model.train_on_batch(inputs, np.zeros(batch_size)), nb_batches)
+
+
+def bench_data_parallel(nb_processes=(1, 2, 4, 8), batch_size=4, nb_batches=10, image_size=(416, 416),
+                        nb_classes=80, path_anchors=PATH_ANCHORS_TINY):
+    from keras_yolo3.data_parallel import run_workers
+
+    results = {}
+    for nb in nb_processes:
+        # all workers wait for the slowest one in each step
+        times = run_workers(_train_synthetic, nb, batch_size=batch_size, nb_batches=nb_batches,
+                            image_size=image_size, nb_classes=nb_classes, path_anchors=path_anchors)
+        results[nb] = nb * batch_size / max(times) * 1e3
+        logging.info('%i processes: %.2f samples per second, %.2fx of %i processes',
+                     nb, results[nb], results[nb] / results[nb_processes[0]], nb_processes[0])
+    return results
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='Benchmarks of the training pipeline.')
+    subparsers = parser.add_subparsers(dest='task')
+    subparsers.required = True
+    parser_boxes = subparsers.add_parser('true-boxes', help='encoding of training targets')
+    parser_boxes.add_argument('--batch_size', type=int, required=False, default=16)
+    parser_boxes.add_argument('--nb_boxes', type=int, required=False, default=20,
+                              help='maximal number of boxes per image')
+    parser_boxes.add_argument('--nb_classes', type=int, required=False, default=80)
+    parser_boxes.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_boxes.add_argument('--repeat', type=int, required=False, default=50)
+    parser_boxes.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS)
+    parser_boxes.set_defaults(func=bench_true_boxes)
+    parser_color = subparsers.add_parser('color', help='colour augmentation in HSV')
+    parser_color.add_argument('--hue', type=float, required=False, default=0.1)
+    parser_color.add_argument('--sat', type=float, required=False, default=1.5)
+    parser_color.add_argument('--val', type=float, required=False, default=1.5)
+    parser_color.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_color.add_argument('--repeat', type=int, required=False, default=50)
+    parser_color.add_argument('--path_image', type=str, required=False, default=PATH_IMAGE)
+    parser_color.set_defaults(func=bench_color)
+    parser_gen = subparsers.add_parser('generator', help='time and memory of the data generator')
+    parser_gen.add_argument('--batch_size', type=int, required=False, default=8)
+    parser_gen.add_argument('--nb_batches', type=int, required=False, default=50)
+    parser_gen.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_gen.add_argument('--nb_threads', type=int, required=False, default=1)
+    parser_gen.add_argument('--path_image', type=str, required=False, default=PATH_IMAGE)
+    parser_gen.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS)
+    parser_gen.set_defaults(func=bench_generator)
+    parser_ignore = subparsers.add_parser('ignore-mask', help='ignore mask of the YOLO loss')
+    parser_ignore.add_argument('--batch_size', type=int, required=False, default=8)
+    parser_ignore.add_argument('--nb_boxes', type=int, required=False, default=20,
+                               help='maximal number of boxes per image')
+    parser_ignore.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_ignore.add_argument('--repeat', type=int, required=False, default=20)
+    parser_ignore.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS)
+    parser_ignore.set_defaults(func=bench_ignore_mask)
+    parser_recomp = subparsers.add_parser('recompute', help='peak memory of training with recomputed activations')
+    parser_recomp.add_argument('--batch_sizes', type=int, nargs='+', required=False, default=(1, 2, 4))
+    parser_recomp.add_argument('--image_size', type=int, nargs=2, required=False, default=(608, 608))
+    parser_recomp.add_argument('--nb_classes', type=int, required=False, default=80)
+    parser_recomp.add_argument('--repeat', type=int, required=False, default=3)
+    parser_recomp.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS)
+    parser_recomp.set_defaults(func=bench_recompute)
+    parser_parallel = subparsers.add_parser('data-parallel', help='throughput of data-parallel training')
+    parser_parallel.add_argument('--nb_processes', type=int, nargs='+', required=False, default=(1, 2, 4, 8))
+    parser_parallel.add_argument('--batch_size', type=int, required=False, default=4,
+                                 help='batch size of a single process')
+    parser_parallel.add_argument('--nb_batches', type=int, required=False, default=10)
+    parser_parallel.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_parallel.add_argument('--nb_classes', type=int, required=False, default=80)
+    parser_parallel.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS_TINY)
+    parser_parallel.set_defaults(func=bench_data_parallel)
+    parser_records = subparsers.add_parser('tfrecords', help='data generator against tf.data on TFRecords')
+    parser_records.add_argument('--path_dataset', type=str, required=True,
+                                help='annotation file the shards were converted from')
+    parser_records.add_argument('--path_shards', type=str, required=True,
+                                help='glob pattern of the TFRecord shards')
+    parser_records.add_argument('--batch_size', type=int, required=False, default=16)
+    parser_records.add_argument('--nb_batches', type=int, required=False, default=20)
+    parser_records.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416))
+    parser_records.add_argument('--nb_threads', type=int, required=False, default=4)
+    parser_records.add_argument('--path_anchors', type=str, required=False, default=PATH_ANCHORS)
+    parser_records.set_defaults(func=bench_tfrecords)
+    arg_params = vars(parser.parse_args())
+    logging.debug('PARAMETERS: \n %s', repr(arg_params))
+    return arg_params
+
+
+def _main(func, task, **kwargs):
+    logging.info('Benchmark: %s', task)
+    func(**kwargs)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arg_params = parse_params()
+    _main(**arg_params)
+    logging.info('Done')
@@ -0,0 +1,55 @@
+"""
+Decode training images once and store them in memory-mapped cache.
+
+    python build_image_cache.py \
+        --path_dataset ../model_data/VOC_2007_train.txt \
+        --path_output ../model_data/image_cache \
+        --max_side 832
+
+The cache is then passed to training with `--path_image_cache`.
+Running the build again refreshes only new or changed images.
+Keep the maximal side at least the CNN input size times the image scaling.
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path += [os.path.abspath('.'), os.path.abspath('..')]
+from keras_yolo3.image_cache import build_image_cache
+from keras_yolo3.utils import check_params_path
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='Build cache of decoded images.')
+    parser.add_argument('-d', '--path_dataset', type=str, required=True,
+                        help='path to the dataset, with single training instance per line')
+    parser.add_argument('-o', '--path_output', type=str, required=True,
+                        help='path to the cache folder')
+    parser.add_argument('--max_side', type=int, required=False, default=1024,
+                        help='maximal image side in pixels, 0 to keep original size')
+    parser.add_argument('--nb_jobs', type=float, required=False, default=0.9,
+                        help='number of parallel processes, fraction of CPUs if < 1')
+    arg_params = vars(parser.parse_args())
+    path_output = arg_params.pop('path_output')
+    arg_params = check_params_path(arg_params)
+    arg_params['path_output'] = path_output
+    logging.debug('PARAMETERS: \n %s', repr(arg_params))
+    return arg_params
+
+
+def _main(path_dataset, path_output, max_side=1024, nb_jobs=0.9):
+    with open(path_dataset) as fp:
+        paths_images = [ln.split()[0] for ln in fp if ln.strip()]
+    nb_jobs = int(nb_jobs) if nb_jobs >= 1 else nb_jobs
+    nb = build_image_cache(paths_images, path_output, max_side=max_side or None,
+                           nb_threads=nb_jobs)
+    logging.info('cached %i images in "%s"', nb, path_output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arg_params = parse_params()
+    _main(**arg_params)
+    logging.info('Done')
@@ -0,0 +1,69 @@
+"""
+Export trained Keras YOLO model to TensorFlow Lite for edge devices.
+
+    python convert_tflite.py \
+        --path_weights ../model_data/tiny-yolo.h5 \
+        --path_anchors ../model_data/tiny-yolo_anchors.csv \
+        --path_classes ../model_data/coco_classes.txt \
+        --path_output ../model_data/tiny-yolo.tflite \
+        --image_size 416 416 \
+        --quantization float16
+
+For full integer quantization you can pass sample images for calibration::
+
+    python convert_tflite.py <...> --quantization int8 --path_calibration ../model_data/*.jpg
+
+The exported model can be used with `keras_yolo3.lite.YOLOLite`
+which requires only the TFLite interpreter (e.g. `tflite_runtime`).
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path += [os.path.abspath('.'), os.path.abspath('..')]
+from keras_yolo3.lite import export_tflite, QUANTIZATIONS
+from keras_yolo3.utils import check_params_path
+from scripts.detection import expand_file_paths
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='Keras to TFLite converter.')
+    parser.add_argument('-w', '--path_weights', type=str, required=True,
+                        help='path to model weight file')
+    parser.add_argument('-a', '--path_anchors', type=str, required=True,
+                        help='path to anchor definitions')
+    parser.add_argument('-c', '--path_classes', type=str, required=True,
+                        help='path to class definitions')
+    parser.add_argument('-o', '--path_output', type=str, required=True,
+                        help='path to the output TFLite model')
+    parser.add_argument('--image_size', type=int, nargs=2, required=False, default=(416, 416),
+                        help='fixed model input size as height and width')
+    parser.add_argument('--quantization', type=str, required=False, default=None,
+                        choices=[q for q in QUANTIZATIONS if q],
+                        help='quantization of the model weights')
+    parser.add_argument('--path_calibration', nargs='*', type=str, required=False, default=(),
+                        help='images for calibration of the int8 quantization')
+    arg_params = vars(parser.parse_args())
+    path_output = arg_params.pop('path_output')
+    paths_calib = arg_params.pop('path_calibration')
+    arg_params = check_params_path(arg_params)
+    arg_params.update(path_output=path_output,
+                      path_calibration=expand_file_paths(paths_calib))
+    logging.debug('PARAMETERS: \n %s', repr(arg_params))
+    return arg_params
+
+
+def _main(path_weights, path_anchors, path_classes, path_output, image_size=(416, 416),
+          quantization=None, path_calibration=()):
+    export_tflite(path_weights, path_anchors, path_classes, path_output,
+                  model_image_size=tuple(image_size), quantization=quantization,
+                  paths_calibration=path_calibration)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arg_params = parse_params()
+    _main(**arg_params)
+    logging.info('Done')
@@ -0,0 +1,55 @@
+"""
+Convert annotated dataset to sharded TFRecord files.
+
+    python convert_tfrecords.py \
+        --path_dataset ../model_data/VOC_2007_train.txt \
+        --path_output ../model_data/tfrecords \
+        --name voc-train --nb_shards 16
+
+Each example holds the encoded image file and its boxes,
+the shards are read by :func:`keras_yolo3.tfrecords.create_dataset`,
+e.g. in `benchmark.py tfrecords`; `training.py` reads the annotation file instead.
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path += [os.path.abspath('.'), os.path.abspath('..')]
+from keras_yolo3.tfrecords import convert_to_tfrecords
+from keras_yolo3.utils import check_params_path
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='Convert dataset to TFRecord shards.')
+    parser.add_argument('-d', '--path_dataset', type=str, required=True,
+                        help='path to the dataset, with single training instance per line')
+    parser.add_argument('-o', '--path_output', type=str, required=True,
+                        help='path to the output folder')
+    parser.add_argument('--name', type=str, required=False, default='dataset',
+                        help='name prefix of the shards')
+    parser.add_argument('--nb_shards', type=int, required=False, default=8,
+                        help='number of TFRecord files')
+    parser.add_argument('--nb_jobs', type=float, required=False, default=0.9,
+                        help='number of parallel processes, fraction of CPUs if < 1')
+    arg_params = vars(parser.parse_args())
+    path_output = arg_params.pop('path_output')
+    arg_params = check_params_path(arg_params)
+    arg_params['path_output'] = path_output
+    logging.debug('PARAMETERS: \n %s', repr(arg_params))
+    return arg_params
+
+
+def _main(path_dataset, path_output, name='dataset', nb_shards=8, nb_jobs=0.9):
+    nb_jobs = int(nb_jobs) if nb_jobs >= 1 else nb_jobs
+    paths = convert_to_tfrecords(path_dataset, path_output, name=name, nb_shards=nb_shards,
+                                 nb_threads=nb_jobs)
+    logging.info('exported %i shards to "%s"', len(paths), path_output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arg_params = parse_params()
+    _main(**arg_params)
+    logging.info('Done')
@@ -19,6 +19,28 @@ You can run detection on whole folder with images/videos::
         --path_image ./model_data/*.jpg \
         --path_video /samples/*.mp4
 
+Repeated images can skip the inference with the detection cache,
+in memory (size in MB) and optionally on disk::
+
+    python detection.py <...> --cache_size 256 --path_cache ./results/cache
+
+Large image folders can be processed in batches, with images decoded ahead
+of the inference in parallel threads and outputs written asynchronously::
+
+    python detection.py <...> --batch_size 16 --nb_jobs 8 --no_visual
+
+Instead of CSV per image all detections can be written to a single store,
+JSON Lines or compressed numpy archive in the output folder::
+
+    python detection.py <...> --output_format jsonl
+
+Long runs can be split into shards (e.g. over several machines) and restarted
+after interruption, skipping images which have already been processed::
+
+    python detection.py <...> --output_format jsonl --shard_index 0 --num_shards 4 --resume
+    python merge_predictions.py --path_stores ./results/predictions_shard-*.jsonl \
+        --path_output ./results/predictions.jsonl
+
 """
 
 import os
@@ -28,6 +50,9 @@ import logging
 import json
 import time
 import glob
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import tqdm
@@ -37,9 +62,16 @@ import numpy as np
 
 sys.path += [os.path.abspath('.'), os.path.abspath('..')]
 from keras_yolo3.yolo import YOLO
-from keras_yolo3.utils import update_path
+from keras_yolo3.cache import DetectionCache, CachedYOLO, image_from_bytes
+from keras_yolo3.utils import update_path, nb_workers
+from keras_yolo3.predictions import (open_prediction_writer, image_name, load_prediction_store,
+                                     CompletionManifest, STORE_FORMATS)
+from keras_yolo3.visual import draw_predictions
 
 VISUAL_EXT = '_detect'
+NAME_PREDICTIONS = 'predictions%s.%s'
+NAME_MANIFEST = 'detection-manifest%s.txt'
+SHARD_SUFFIX = '_shard-%i-of-%i'
 VIDEO_FORMAT = cv2.VideoWriter_fourcc('F', 'M', 'P', '4')
 
 
@@ -67,6 +99,25 @@ def parse_params():
                         help='Images to be processed (sequence of paths)')
     parser.add_argument('-v', '--path_video', nargs='*', type=str, required=False,
                         help='Video to be processed (sequence of paths)')
+    parser.add_argument('--cache_size', type=float, required=False, default=0,
+                        help='size of in-memory detection cache in MB, 0 to disable')
+    parser.add_argument('--path_cache', type=str, required=False, default=None,
+                        help='folder for on-disk detection cache')
+    parser.add_argument('--batch_size', type=int, required=False, default=1,
+                        help='number of images processed by CNN at once')
+    parser.add_argument('--nb_jobs', type=int, required=False, default=1,
+                        help='number of parallel threads for image decoding')
+    parser.add_argument('--no_visual', default=False, action='store_true',
+                        help='skip drawing and exporting the detections to images')
+    parser.add_argument('--output_format', type=str, required=False, default='csv',
+                        choices=('csv', ) + STORE_FORMATS,
+                        help='CSV per image or single store with all detections')
+    parser.add_argument('--shard_index', type=int, required=False, default=0,
+                        help='index of processed shard of the input images')
+    parser.add_argument('--num_shards', type=int, required=False, default=1,
+                        help='number of shards the input images are split into')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='skip images which have been already processed')
     arg_params = vars(parser.parse_args())
     for k_name in ('path_image', 'path_video'):
         # if there is only single path still make it as a list
@@ -76,6 +127,8 @@ def parse_params():
     for k in (k for k in arg_params if 'path' in k):
         if k in ('path_image', 'path_video'):
             arg_params[k] = [update_path(path_) for path_ in arg_params[k]]
+        elif k == 'path_cache':
+            continue
         elif arg_params[k]:
             arg_params[k] = update_path(arg_params[k])
             assert os.path.exists(arg_params[k]), 'missing (%s): %s' % (k, arg_params[k])
@@ -83,25 +136,131 @@ def parse_params():
     return arg_params
 
 
-def predict_image(yolo, path_image, path_output=None):
+def export_prediction(path_image, image_pred, pred_items, path_output, writer=None,
+                      manifest=None):
+    """export detection as CSV or to prediction store and optionally the visualisation
+
+    :param str path_image: path to the input image
+    :param Image|None image_pred: image with drawn detections, None to skip it
+    :param list(dict) pred_items: predictions
+    :param str path_output: path to the output directory
+    :param writer: writer of prediction store, None for CSV per image
+    :param CompletionManifest|None manifest: record the image as completed after export
+    """
+    name = image_name(path_image)
+    if image_pred is not None:
+        path_out_img = os.path.join(path_output, name + VISUAL_EXT + '.jpg')
+        logging.debug('exporting image: "%s"', path_out_img)
+        image_pred.save(path_out_img)
+    if writer is not None:
+        writer.write(name, pred_items)
+    else:
+        path_out_csv = os.path.join(path_output, name + '.csv')
+        logging.debug('exporting detection: "%s"', path_out_csv)
+        pd.DataFrame(pred_items).to_csv(path_out_csv)
+    if manifest is not None:
+        manifest.add(path_image)
+
+
+def predict_image(yolo, path_image, path_output=None, render=True, writer=None, manifest=None):
     path_image = update_path(path_image)
     if not path_image:
         logging.debug('no image given')
     elif not os.path.isfile(path_image):
         logging.warning('missing image: %s', path_image)
 
-    image = Image.open(path_image)
-    image_pred, pred_items = yolo.detect_image(image)
-    if path_output is None or not os.path.isdir(path_output):
+    show = path_output is None or not os.path.isdir(path_output)
+    render = render or show
+    if isinstance(yolo, CachedYOLO):
+        image_pred, pred_items = yolo.detect_file(path_image, render=render)
+    else:
+        image = Image.open(path_image)
+        image_pred, pred_items = yolo.detect_image(image, render=render)
+    if show:
         image_pred.show()
     else:
-        name = os.path.splitext(os.path.basename(path_image))[0]
-        path_out_img = os.path.join(path_output, name + VISUAL_EXT + '.jpg')
-        path_out_csv = os.path.join(path_output, name + '.csv')
-        logging.debug('exporting image: "%s" and detection: "%s"',
-                      path_out_img, path_out_csv)
-        image_pred.save(path_out_img)
-        pd.DataFrame(pred_items).to_csv(path_out_csv)
+        export_prediction(path_image, image_pred if render else None, pred_items, path_output,
+                          writer=writer, manifest=manifest)
+
+
+def _load_image(path_image, yolo, render=True):
+    """read, decode and preprocess single image, it runs in the prefetching threads
+
+    :return tuple: image path, cache key, image, preprocessed image data and cached predictions
+    """
+    key, pred_items = None, None
+    if isinstance(yolo, CachedYOLO):
+        key, pred_items, image_bytes = yolo.lookup_file(path_image)
+        if pred_items is not None and not render:
+            return path_image, key, None, None, pred_items
+        image = image_from_bytes(image_bytes)
+    else:
+        image = Image.open(path_image)
+        image.load()
+    image_data = yolo.preprocess_image(image) if pred_items is None else None
+    return path_image, key, image, image_data, pred_items
+
+
+def _prefetch(func, items, executor, depth):
+    """map function in executor keeping at most `depth` items ahead of the consumer"""
+    items = iter(items)
+    futures = deque(executor.submit(func, it) for it in itertools.islice(items, depth))
+    while futures:
+        result = futures.popleft().result()
+        futures.extend(executor.submit(func, it) for it in itertools.islice(items, 1))
+        yield result
+
+
+def predict_images_batch(yolo, paths_images, path_output, batch_size=8, nb_jobs=1, render=True,
+                         writer=None, manifest=None):
+    """detection over many images, with parallel image decoding ahead of the batched
+    inference and with asynchronous exporting
+
+    :param yolo: detector, :class:`YOLO` or :class:`CachedYOLO`
+    :param list(str) paths_images: images to be processed
+    :param str path_output: path to the output directory
+    :param int batch_size: number of images processed by CNN at once
+    :param int nb_jobs: number of decoding threads
+    :param bool render: draw and export visualisation of detections
+    :param writer: writer of prediction store, None for CSV per image
+    :param CompletionManifest|None manifest: record of completed images
+    """
+    nb_jobs = nb_workers(nb_jobs)
+    pool_read = ThreadPoolExecutor(max_workers=nb_jobs)
+    pool_write = ThreadPoolExecutor(max_workers=max(1, nb_jobs // 2))
+    samples = _prefetch(lambda p: _load_image(p, yolo, render), paths_images,
+                        pool_read, depth=2 * max(batch_size, nb_jobs))
+    pending = deque()
+
+    with tqdm.tqdm(total=len(paths_images), desc='images') as pbar:
+        while True:
+            batch = list(itertools.islice(samples, batch_size))
+            if not batch:
+                break
+            # run the inference only for images without cached detections
+            todo = [i for i, s in enumerate(batch) if s[4] is None]
+            results = yolo.detect_batch([batch[i][2] for i in todo], [batch[i][3] for i in todo],
+                                        render=render) if todo else []
+            results = dict(zip(todo, results))
+            for i, (path_img, key, image, _, pred_items) in enumerate(batch):
+                if i in results:
+                    image, pred_items = results[i]
+                    if key is not None:
+                        yolo.cache.put(key, pred_items)
+                elif render:
+                    draw_predictions(image, pred_items, yolo.colors)
+                pending.append(pool_write.submit(export_prediction, path_img,
+                                                 image if render else None,
+                                                 pred_items, path_output, writer, manifest))
+            # limit the number of waiting outputs, so they do not pile up in memory
+            while len(pending) > 4 * batch_size:
+                pending.popleft().result()
+            pbar.update(len(batch))
+
+    for future in pending:
+        future.result()
+    pool_read.shutdown()
+    pool_write.shutdown()
 
 
 def predict_video(yolo, path_video, path_output=None, show_stream=False):
@@ -163,26 +322,95 @@ def predict_video(yolo, path_video, path_output=None, show_stream=False):
 
 
 def expand_file_paths(paths):
+    """expand wildcards, the result is sorted so it is the same for every run"""
     paths_unrolled = []
     for ph in paths:
         if '*' in ph:
             paths_unrolled += glob.glob(ph)
         elif os.path.isfile(ph):
             paths_unrolled.append(ph)
-    return paths_unrolled
+    return sorted(paths_unrolled)
+
+
+def shard_paths(paths, shard_index=0, num_shards=1):
+    """select the paths of given shard, every `num_shards`-th item
+
+    >>> shard_paths(['a', 'b', 'c', 'd', 'e'], 1, 2)
+    ['b', 'd']
+    """
+    assert 0 <= shard_index < num_shards, \
+        'invalid shard %i of %i' % (shard_index, num_shards)
+    return paths[shard_index::num_shards]
+
+
+def _completed_images(paths_images, path_output, manifest, path_store=None):
+    """images recorded in the manifest or with already existing outputs"""
+    done = set(p for p in paths_images if p in manifest)
+    if path_store is not None:
+        if os.path.isfile(path_store):
+            store = load_prediction_store(path_store)
+            done.update(p for p in paths_images if image_name(p) in store)
+    else:
+        done.update(p for p in paths_images
+                    if os.path.isfile(os.path.join(path_output, image_name(p) + '.csv')))
+    return done
 
 
-def _main(path_weights, path_anchors, path_classes, path_output, nb_gpu=0, **kwargs):
+def _main(path_weights, path_anchors, path_classes, path_output, nb_gpu=0,
+          cache_size=0, path_cache=None, batch_size=1, nb_jobs=1, no_visual=False,
+          output_format='csv', shard_index=0, num_shards=1, resume=False, **kwargs):
 
     yolo = YOLO(weights_path=path_weights, anchors_path=path_anchors,
                 classes_path=path_classes, nb_gpu=nb_gpu)
+    if cache_size or path_cache:
+        cache = DetectionCache(max_size=int(cache_size * 1024 ** 2), path_dir=path_cache)
+        yolo = CachedYOLO(yolo, cache)
 
     logging.info('Start image/video processing..')
     if 'path_image' in kwargs:
-        paths_img = expand_file_paths(kwargs['path_image'])
-        for path_img in tqdm.tqdm(paths_img, desc='images'):
-            logging.debug('processing: "%s"', path_img)
-            predict_image(yolo, path_img, path_output)
+        paths_img = shard_paths(expand_file_paths(kwargs['path_image']), shard_index, num_shards)
+        suffix = SHARD_SUFFIX % (shard_index, num_shards) if num_shards > 1 else ''
+        path_store = os.path.join(path_output, NAME_PREDICTIONS % (suffix, output_format)) \
+            if output_format in STORE_FORMATS else None
+        path_manifest = os.path.join(path_output, NAME_MANIFEST % suffix)
+        if not resume:
+            # fresh run, drop records of any previous one
+            for path in (path_store, path_manifest):
+                if path and os.path.isfile(path):
+                    os.remove(path)
+        manifest = CompletionManifest(path_manifest)
+        if resume:
+            done = _completed_images(paths_img, path_output, manifest, path_store)
+            logging.info('resuming, skipping %i of %i images', len(done), len(paths_img))
+            paths_img = [p for p in paths_img if p not in done]
+        writer = None
+        if path_store is not None:
+            logging.info('exporting detections to: %s', path_store)
+            writer = open_prediction_writer(path_store)
+        # the npz store is written only on closing, so record the images afterwards
+        manifest_run = None if output_format == 'npz' else manifest
+        try:
+            if batch_size > 1 or nb_jobs > 1:
+                assert os.path.isdir(path_output), \
+                    'batch mode requires output folder: %s' % path_output
+                predict_images_batch(yolo, paths_img, path_output, batch_size=batch_size,
+                                     nb_jobs=nb_jobs, render=not no_visual, writer=writer,
+                                     manifest=manifest_run)
+            else:
+                for path_img in tqdm.tqdm(paths_img, desc='images'):
+                    logging.debug('processing: "%s"', path_img)
+                    predict_image(yolo, path_img, path_output, render=not no_visual,
+                                  writer=writer, manifest=manifest_run)
+        finally:
+            # save also an interrupted npz run, resume finds its images in the store
+            if writer is not None:
+                writer.close()
+        if manifest_run is None:
+            for path_img in paths_img:
+                manifest.add(path_img)
+        manifest.close()
+        if isinstance(yolo, CachedYOLO):
+            logging.info('detection cache: %r', yolo.cache.stats())
     if 'path_video' in kwargs:
         paths_vid = expand_file_paths(kwargs['path_video'])
         for path_vid in tqdm.tqdm(paths_vid, desc='videos'):
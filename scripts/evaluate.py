@@ -9,6 +9,12 @@ We expect that the predictions are in single folder and image names in dataset a
         --iou 0.5 \
         --visual
 
+The predictions can be also a single store exported by `detection.py --output_format jsonl`::
+
+    python evaluate.py \
+        --path_dataset ../model_data/VOC_2007_train.txt \
+        --path_results ../results/predictions.jsonl
+
 It generates
 * statistic per image (mean over all classes)
 * statistic per class (mean over all images)
@@ -29,6 +35,7 @@ import pandas as pd
 
 sys.path += [os.path.abspath('.'), os.path.abspath('..')]
 from keras_yolo3.utils import check_params_path, nb_workers, image_open, update_path
+from keras_yolo3.predictions import load_prediction_store, is_prediction_store, image_name
 from keras_yolo3.model import compute_detect_metrics
 from keras_yolo3.visual import draw_bounding_box
 
@@ -45,7 +52,7 @@ def parse_params():
     parser.add_argument('-d', '--path_dataset', type=str, required=True,
                         help='path to the dataset, with single instance per line')
     parser.add_argument('-r', '--path_results', type=str, required=True,
-                        help='path to the predictions')
+                        help='path to the predictions, folder with CSV or single store')
     parser.add_argument('-c', '--confidence', type=float, required=False, default=0.5,
                         help='detection confidence score')
     parser.add_argument('--iou', type=float, required=False, default=0.5,
@@ -77,20 +84,32 @@ def draw_export_bboxes(img_path, path_out, bboxes_anot, bboxes_pred):
     return path_visu
 
 
-def eval_image(line, path_results, thr_confidence=0.5, thr_iou=0.5, path_out=None):
+def eval_image(line, path_results, thr_confidence=0.5, thr_iou=0.5, path_out=None,
+               df_preds=None):
+    """evaluate predictions of single image
+
+    :param str line: annotation line
+    :param str path_results: folder with CSV predictions
+    :param float thr_confidence: filter predictions with lower confidence
+    :param float thr_iou: IoU threshold for matching boxes
+    :param str|None path_out: folder for exporting visualisations
+    :param DataFrame|None df_preds: already loaded predictions, otherwise they are read from CSV
+    :return list(dict)|None:
+    """
     line_elems = line.strip().split()
     img_path = line_elems[0]
-    img_name, _ = os.path.splitext(os.path.basename(img_path))
+    img_name = image_name(img_path)
 
-    path_pred = os.path.join(path_results, '%s.csv' % img_name)
-    if not os.path.isfile(path_pred):
-        return None
+    if df_preds is None:
+        path_pred = os.path.join(path_results, '%s.csv' % img_name)
+        if not os.path.isfile(path_pred):
+            return None
+        df_preds = pd.read_csv(path_pred, index_col=None)
 
     boxes = [list(map(int, el.split(','))) for el in line_elems[1:]]
     df_annot = pd.DataFrame(boxes, columns=list(ANNOT_COLUMNS))
     if df_annot.empty:
         df_annot = pd.DataFrame(columns=ANNOT_COLUMNS)
-    df_preds = pd.read_csv(path_pred, index_col=None)
     if df_preds.empty:
         df_preds = pd.DataFrame(columns=ANNOT_COLUMNS)
 
@@ -123,6 +142,13 @@ def eval_image(line, path_results, thr_confidence=0.5, thr_iou=0.5, path_out=Non
     return stats
 
 
+def _eval_image_stored(line_preds, **kwargs):
+    line, df_preds = line_preds
+    if df_preds is None:
+        return None
+    return eval_image(line, df_preds=df_preds, **kwargs)
+
+
 def _main(path_dataset, path_results, confidence, iou, visual=False, nb_jobs=0.9):
     with open(path_dataset, 'r') as fp:
         dataset = fp.readlines()
@@ -133,9 +159,18 @@ def _main(path_dataset, path_results, confidence, iou, visual=False, nb_jobs=0.9
 
     nb_jobs = nb_workers(nb_jobs)
     pool = ProcessPool(nb_jobs) if nb_jobs > 1 else None
-    _wrap_eval = partial(eval_image, path_results=path_results,
+    path_store = None
+    if is_prediction_store(path_results):
+        path_store, path_results = path_results, os.path.dirname(path_results)
+    _wrap_eval = partial(eval_image if path_store is None else _eval_image_stored,
+                         path_results=path_results,
                          thr_confidence=confidence, thr_iou=iou,
                          path_out=path_results if visual else None)
+    if path_store:
+        # load all predictions at once and send to workers just the image slices
+        store = load_prediction_store(path_store)
+        logging.info('loaded predictions of %i images from: %s', len(store), path_store)
+        dataset = ((line, store.get(image_name(line.split()[0]))) for line in dataset if line.strip())
     # multiprocessing loading of batch data
     map_process = pool.imap if pool else map
 
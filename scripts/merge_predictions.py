@@ -0,0 +1,44 @@
+"""
+Merge prediction stores of sharded detection runs into a single store.
+
+    python merge_predictions.py \
+        --path_stores ./results/predictions_shard-*.jsonl \
+        --path_output ./results/predictions.npz
+
+The merged store is ordered by image names, so it does not depend on
+how the images were split into shards.
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path += [os.path.abspath('.'), os.path.abspath('..')]
+from keras_yolo3.predictions import merge_prediction_stores
+from keras_yolo3.utils import update_path
+from scripts.detection import expand_file_paths
+
+
+def parse_params():
+    parser = argparse.ArgumentParser(description='Merge prediction stores.')
+    parser.add_argument('-s', '--path_stores', nargs='+', type=str, required=True,
+                        help='prediction stores to be merged (sequence of paths)')
+    parser.add_argument('-o', '--path_output', type=str, required=True,
+                        help='path to the merged prediction store')
+    arg_params = vars(parser.parse_args())
+    arg_params['path_stores'] = expand_file_paths([update_path(p) for p in arg_params['path_stores']])
+    assert arg_params['path_stores'], 'no prediction stores found'
+    logging.debug('PARAMETERS: \n %s', repr(arg_params))
+    return arg_params
+
+
+def _main(path_stores, path_output):
+    merge_prediction_stores(path_stores, path_output)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    arg_params = parse_params()
+    _main(**arg_params)
+    logging.info('Done')
@@ -16,12 +16,14 @@ import logging
 from functools import partial
 
 import numpy as np
-from keras.optimizers import Adam
 from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 
 sys.path += [os.path.abspath('.'), os.path.abspath('..')]
 from keras_yolo3.model import create_model_bottleneck
-from keras_yolo3.utils import get_anchors, get_nb_classes, data_generator, generator_bottleneck, get_dataset_class_names
+from keras_yolo3.image_cache import ImageCache
+from keras_yolo3.optimizers import create_optimizer
+from keras_yolo3.utils import (get_anchors, get_nb_classes, data_generator, generator_bottleneck,
+                               get_dataset_class_names, keras_buffers)
 from scripts.training import parse_params, load_config, load_training_lines, _export_classes, _export_model
 
 
@@ -33,6 +35,9 @@ DEFAULT_CONFIG = {
         {'head': 50, 'bottlenecks': 30, 'full': 50},
     'valid-split': 0.1,
     'recompute-bottlenecks': True,
+    # number of batches with gradients averaged for a single update
+    'accumulate-batches':
+        {'head': 1, 'full': 1},
     'generator': {}
 }
 NAME_BOTTLENECKS = 'bottlenecks.npz'
@@ -40,7 +45,7 @@ NAME_CHECKPOINT = 'ep{epoch:03d}-loss{loss:.3f}-val_loss{val_loss:.3f}.h5'
 
 
 def _main(path_dataset, path_anchors, path_weights=None, path_output='.',
-          path_config=None, path_classes=None, nb_gpu=1, **kwargs):
+          path_config=None, path_classes=None, nb_gpu=1, path_image_cache=None, **kwargs):
 
     config = load_config(path_config, DEFAULT_CONFIG)
     anchors = get_anchors(path_anchors)
@@ -78,6 +83,9 @@ def _main(path_dataset, path_anchors, path_weights=None, path_output='.',
                               input_shape=config['image-size'],
                               anchors=anchors,
                               nb_classes=nb_classes,
+                              image_cache=ImageCache(path_image_cache) if path_image_cache else None,
+                              # the batches are reused, Keras queues up to 10 of them by default
+                              nb_buffers=keras_buffers(),
                               **config['generator'])
 
     epochs_head = config['epochs'].get('head', 0)
@@ -116,7 +124,7 @@ def _main(path_dataset, path_anchors, path_weights=None, path_output='.',
         _export_model(model, path_output, '', '_bottleneck')
 
         # train last layers with random augmented data
-        model.compile(optimizer=Adam(lr=1e-3),
+        model.compile(optimizer=create_optimizer(1e-3, accum_iters=config['accumulate-batches'].get('head', 1)),
                       loss={'yolo_loss': _yolo_loss})  # use custom yolo_loss Lambda layer.
         logging.info('Train on %i samples, val on %i samples, with batch size %i.',
                      num_train, num_val, config['batch-size']['head'])
@@ -137,7 +145,7 @@ def _main(path_dataset, path_anchors, path_weights=None, path_output='.',
     if config['epochs'].get('full', 0) > 0:
         for i in range(len(model.layers)):
             model.layers[i].trainable = True
-        model.compile(optimizer=Adam(lr=1e-4),
+        model.compile(optimizer=create_optimizer(1e-4, accum_iters=config['accumulate-batches'].get('full', 1)),
                       loss={'yolo_loss': lambda y_true, y_pred: y_pred})  # recompile to apply the change
         logging.info('Unfreeze all of the layers.')
 
@@ -9,6 +9,29 @@ Retrain the YOLO model for your own dataset.
         --path_output ../model_data \
         --path_config ../model_data/train_tiny-yolo.yaml
 
+Decoding of images can be skipped with cache built by `build_image_cache.py`::
+
+    python training.py <...> --path_image_cache ../model_data/image_cache
+
+The augmentation and target encoding run in the TensorFlow graph
+with `graph-augment: true` in the configuration, together with the image cache
+the data workers just copy the decoded pixels and no image is resized on the CPU.
+
+The first epochs can run at lower resolutions, e.g. 10 epochs at 320 and
+10 at 416 and the rest at the `image-size`, with the configuration::
+
+    resolution-schedule: [[[320, 320], 10], [[416, 416], 10]]
+
+On a many-core CPU several local processes can train in data-parallel,
+each on its shard of the dataset with gradients averaged after every batch::
+
+    python training.py <...> --nb_processes 4
+
+The training state is saved in the output folder after every epoch,
+an interrupted training continues from the last finished epoch with::
+
+    python training.py <...> --resume
+
 """
 
 import os
@@ -20,13 +43,22 @@ from functools import partial
 
 import yaml
 import numpy as np
-from keras.optimizers import Adam
+import keras.backend as K
 from keras.callbacks import TensorBoard, ModelCheckpoint, ReduceLROnPlateau, EarlyStopping
 
 sys.path += [os.path.abspath('.'), os.path.abspath('..')]
 from keras_yolo3.model import create_model, create_model_tiny
+from keras_yolo3.optimizers import create_optimizer, mixed_precision_session
+from keras_yolo3.image_cache import ImageCache
+from keras_yolo3.dataset import load_dataset_index
 from keras_yolo3.utils import (
-    check_params_path, get_anchors, get_dataset_class_names, get_nb_classes, data_generator)
+    check_params_path, get_anchors, get_dataset_class_names, get_nb_classes, nb_workers,
+    augmentation_params)
+from keras_yolo3.shared_pool import SharedBatchPool
+from keras_yolo3.graph_augment import create_model_graph_augment, GRAPH_AUGMENT_PARAMS
+from keras_yolo3.sequence import YoloSequence
+from keras_yolo3.data_parallel import run_workers
+from keras_yolo3.training_state import TrainingState
 from scripts.detection import arg_params_yolo
 
 DEFAULT_CONFIG = {
@@ -36,6 +68,22 @@ DEFAULT_CONFIG = {
     'epochs':
         {'head': 50, 'full': 50},
     'valid-split': 0.1,
+    # number of batches prepared ahead of the training
+    'prefetch-queue': 10,
+    # augment images and encode targets in the graph, the workers just fit images to CNN input
+    'graph-augment': False,
+    # float16 compute with float32 weights, on GPUs supporting it
+    'mixed-precision': False,
+    # number of batches with gradients averaged for a single update, the effective batch size
+    #  is `batch-size * accumulate-batches` while the memory takes just the `batch-size`
+    'accumulate-batches':
+        {'head': 1, 'full': 1},
+    # recompute activations inside the residual blocks in the backward pass, less memory for more compute
+    'recompute-body': False,
+    # image sizes with numbers of the first epochs, the remaining use `image-size`
+    'resolution-schedule': [],
+    # targets as records of boxes, the loss gathers just the cells with boxes
+    'sparse-targets': False,
     'generator': {
         'jitter': 0.3,
         'color_hue': 0.1,
@@ -63,6 +111,12 @@ def parse_params():
                              ' with single training instance per line')
     parser.add_argument('--path_config', type=str, required=False,
                         help='path to the train configuration, using YAML format')
+    parser.add_argument('--path_image_cache', type=str, required=False,
+                        help='path to the cache of decoded images')
+    parser.add_argument('--nb_processes', type=int, required=False, default=1,
+                        help='number of local processes training in data-parallel')
+    parser.add_argument('--resume', action='store_true', required=False,
+                        help='continue from the training state in the output folder')
     arg_params = vars(parser.parse_args())
     arg_params = check_params_path(arg_params)
     logging.debug('PARAMETERS: \n %s', repr(arg_params))
@@ -81,22 +135,71 @@ def load_config(path_config, default_config):
 
 
 def load_training_lines(path_annot, valid_split):
-    with open(path_annot) as f:
-        lines = f.readlines()
+    """split the dataset to training and validation samples, with fixed shuffling
+
+    :param str path_annot: path to the annotation file
+    :param float valid_split: fraction of validation samples
+    :return tuple(list,list,int,int): samples as tuples of image path and boxes,
+        see :class:`keras_yolo3.dataset.DatasetIndex`
+    """
+    index = load_dataset_index(path_annot)
+    order = np.arange(len(index))
 
     np.random.seed(10101)
-    np.random.shuffle(lines)
+    np.random.shuffle(order)
     np.random.seed(None)
-    num_val = max(1, int(len(lines) * valid_split))
-    num_train = len(lines) - num_val
+    num_val = max(1, int(len(index) * valid_split))
+    num_train = len(index) - num_val
 
     assert num_val > 0, 'there has to be at least one validation sample'
     assert num_train > 0, 'there has to be at least one training sample'
-    lines_train = lines[:num_train]
-    lines_valid = lines[num_train:]
+    lines_train = [index[i] for i in order[:num_train]]
+    lines_valid = [index[i] for i in order[num_train:]]
     return lines_train, lines_valid, num_val, num_train
 
 
+def resolution_stages(schedule, image_size, epoch_start, epoch_end):
+    """split epochs of a training phase by the resolution schedule
+
+    :param list schedule: pairs of image size and number of epochs, counted from the first epoch
+    :param tuple(int,int) image_size: size of epochs after the schedule
+    :param int epoch_start: first epoch of the phase
+    :param int epoch_end: epoch where the phase ends
+    :return list(tuple(tuple(int,int),int,int)): image size, first and end epoch of each stage
+
+    >>> schedule = [[[320, 320], 5], [[416, 416], 5]]
+    >>> resolution_stages(schedule, (608, 608), 0, 8)
+    [((320, 320), 0, 5), ((416, 416), 5, 8)]
+    >>> resolution_stages(schedule, (608, 608), 8, 20)
+    [((416, 416), 8, 10), ((608, 608), 10, 20)]
+    >>> resolution_stages([], (608, 608), 8, 20)
+    [((608, 608), 8, 20)]
+    """
+    stages, begin = [], 0
+    for size, nb_epochs in list(schedule) + [(image_size, float('inf'))]:
+        assert all(s % 32 == 0 for s in size), 'image size %r is not multiple of 32' % (size, )
+        end = begin + nb_epochs
+        if begin < epoch_end and epoch_start < end:
+            stages.append((tuple(size), max(begin, epoch_start), min(end, epoch_end)))
+        begin = end
+    return stages
+
+
+class WeightsCheckpoint(ModelCheckpoint):
+    """`ModelCheckpoint` saving weights of the given model instead of the trained one,
+    e.g. of the model inside the graph augmentation wrapper, whose nested weights
+    would not load by name to the plain model
+    """
+
+    def __init__(self, model_weights, filepath, **kwargs):
+        super(WeightsCheckpoint, self).__init__(filepath, save_weights_only=True, **kwargs)
+        self.model_weights = model_weights
+
+    def set_model(self, model):
+        # the monitored values come from the logs, so just the saved model differs
+        super(WeightsCheckpoint, self).set_model(self.model_weights)
+
+
 def _export_classes(class_names, path_output):
     if not class_names or not os.path.isdir(path_output):
         return
@@ -121,93 +224,218 @@ def _export_model(model, path_output, name_prefix, name_sufix):
 
 
 def _main(path_dataset, path_anchors, path_weights=None, path_output='.',
-          path_config=None, path_classes=None, nb_gpu=1, **kwargs):
+          path_config=None, path_classes=None, nb_gpu=1, path_image_cache=None,
+          nb_processes=1, resume=False, data_parallel=None, **kwargs):
+    if nb_processes > 1:
+        # each worker runs this training on its shard, see `keras_yolo3.data_parallel`
+        run_workers(_main, nb_processes, path_dataset=path_dataset, path_anchors=path_anchors,
+                    path_weights=path_weights, path_output=path_output, path_config=path_config,
+                    path_classes=path_classes, nb_gpu=nb_gpu, path_image_cache=path_image_cache,
+                    resume=resume, **kwargs)
+        return
+    # just the first worker writes the outputs
+    is_chief = data_parallel is None or data_parallel.is_chief
 
     config = load_config(path_config, DEFAULT_CONFIG)
     anchors = get_anchors(path_anchors)
 
     nb_classes = get_nb_classes(path_dataset)
     logging.info('Using %i classes', nb_classes)
-    _export_classes(get_dataset_class_names(path_dataset, path_classes), path_output)
+    if is_chief:
+        _export_classes(get_dataset_class_names(path_dataset, path_classes), path_output)
 
     is_tiny_version = len(anchors) == 6  # default setting
     _create_model = create_model_tiny if is_tiny_version else create_model
     name_prefix = 'tiny-' if is_tiny_version else ''
-    model = _create_model(config['image-size'], anchors, nb_classes, freeze_body=2,
-                          weights_path=path_weights, nb_gpu=nb_gpu)
-    # if create blank use image-size, else take loaded from model file
-    config['image-size'] = model._input_layers[0].input_shape[1:3]
+    schedule = config.get('resolution-schedule') or []
+    # with lower resolutions in the schedule the model takes any image size
+    graph_augment = config.get('graph-augment', False)
+    sparse_targets = config.get('sparse-targets', False)
+    assert not (graph_augment and sparse_targets), 'the graph augmentation encodes dense targets'
+    assert not (data_parallel and config['mixed-precision']), 'data-parallel training is not in mixed precision'
+    if config['mixed-precision']:
+        # the graph rewrite affects only sessions created afterwards, so before loading any weights
+        K.set_session(mixed_precision_session())
+    model = _create_model((None, None) if schedule else config['image-size'], anchors, nb_classes,
+                          freeze_body=2, weights_path=path_weights, nb_gpu=nb_gpu,
+                          sparse_targets=sparse_targets,
+                          max_boxes=config['generator'].get('max_boxes', 20),
+                          recompute_body=config['recompute-body'])
+    if not schedule:
+        # if create blank use image-size, else take loaded from model file
+        config['image-size'] = model._input_layers[0].input_shape[1:3]
 
     tb_logging = TensorBoard(log_dir=path_output)
-    checkpoint = ModelCheckpoint(os.path.join(path_output, NAME_CHECKPOINT),
-                                 monitor='val_loss',
-                                 save_weights_only=True,
-                                 save_best_only=True,
-                                 period=3)
+    checkpoint = WeightsCheckpoint(model, os.path.join(path_output, NAME_CHECKPOINT),
+                                   monitor='val_loss',
+                                   save_best_only=True,
+                                   period=3)
     reduce_lr = ReduceLROnPlateau(monitor='val_loss', verbose=1,
                                   **config.get('CB_learning-rate', {}))
     early_stopping = EarlyStopping(monitor='val_loss', verbose=1,
                                    **config.get('CB_stopping', {}))
 
+    callbacks = [tb_logging, checkpoint, reduce_lr, early_stopping]
+    # goes after the callbacks it restores, all workers restore and just the first one saves,
+    #  it also carries their counters over the resolution stages of a phase
+    training_state = TrainingState(path_output, model, callbacks=[checkpoint, reduce_lr, early_stopping],
+                                   save=is_chief)
+    if resume:
+        training_state.load()
+    if data_parallel:
+        data_parallel.broadcast_weights(model)
+
     lines_train, lines_valid, num_val, num_train = \
         load_training_lines(path_dataset, config['valid-split'])
+    if data_parallel:
+        lines_train, lines_valid = data_parallel.shard(lines_train), data_parallel.shard(lines_valid)
+        num_train, num_val = len(lines_train), len(lines_valid)
+        # the logs are averaged before the callbacks, so all workers decide the same
+        callbacks = [data_parallel.callback()] + (callbacks if is_chief else [reduce_lr, early_stopping])
+    callbacks.append(training_state)
 
     # Train with frozen layers first, to get a stable loss.
     # Adjust num epochs to your dataset. This step is enough to obtain a not bad model.
     # See: https://github.com/qqwweee/keras-yolo3/issues/129#issuecomment-408855511
     _yolo_loss = lambda y_true, y_pred: y_pred[0]  # use custom yolo_loss Lambda layer.
-    _data_generator = partial(data_generator,
-                              input_shape=config['image-size'],
-                              anchors=anchors,
-                              nb_classes=nb_classes,
-                              **config['generator'])
+    # single pool of workers for training and validation in all stages
+    params_generator = dict(config['generator'])
+    nb_threads = nb_workers(params_generator.pop('nb_threads', 1))
+    if data_parallel:
+        nb_threads = max(1, nb_threads // data_parallel.nb_workers)
+    image_cache = ImageCache(path_image_cache) if path_image_cache else None
+    params_augment = augmentation_params(image_cache=image_cache, **params_generator)
+    # the model which is trained, the inner model is exported
+    model_train = model
+    if graph_augment:
+        params_graph = {k: params_augment[k] for k in GRAPH_AUGMENT_PARAMS}
+        if image_cache is None or not image_cache.max_side:
+            logging.warning('graph augmentation without image cache decodes and resizes images every epoch')
+        # with the resolution schedule the stages just change the CNN size,
+        #  so a single compiled model keeps the optimizer slots over all of them
+        cnn_size = K.variable(config['image-size'], dtype='int32', name='cnn_size') \
+            if schedule else tuple(config['image-size'])
+        model_train = create_model_graph_augment(
+            model, cnn_size, anchors, nb_classes,
+            max_boxes=params_augment['max_boxes'], **params_graph)
+    # single pool of workers for training and validation at the current resolution
+    pools = {}
+
+    def _get_pool(image_size):
+        if image_size not in pools:
+            for pool in pools.values():
+                pool.close()
+            pools.clear()
+            pools[image_size] = SharedBatchPool(
+                lines_train + lines_valid, image_size, anchors, nb_classes,
+                batch_size=max(config['batch-size'].values()),
+                nb_workers=nb_threads if nb_threads > 1 else 0,
+                profiles={'valid': {'augment': False}},
+                encode_targets=not graph_augment,
+                sparse_targets=sparse_targets,
+                # cached images are copied to the canvas without resizing
+                canvas_size=image_cache.max_side if image_cache is not None else None,
+                **params_augment)
+        return pools[image_size]
+
+    _fit_sequences = partial(fit_sequences,
+                             indices_train=range(num_train),
+                             indices_valid=range(num_train, num_train + num_val),
+                             workers=nb_threads,
+                             max_queue_size=config['prefetch-queue'],
+                             callbacks=callbacks,
+                             seed=training_state.seed + (data_parallel.rank if data_parallel else 0))
+
+    def _fit_phase(lr, batch_size, accum_iters, initial_epoch, epochs):
+        optimizer = create_optimizer(lr, config['mixed-precision'], accum_iters,
+                                     checkpoint_layers=model.checkpoint_layers)
+        if data_parallel:
+            optimizer = data_parallel.wrap_optimizer(optimizer)
+        model_train.compile(optimizer=optimizer, loss={'yolo_loss': _yolo_loss})
+        for image_size, stage_start, stage_end in resolution_stages(
+                schedule, config['image-size'], initial_epoch, epochs):
+            if graph_augment and schedule:
+                K.set_value(cnn_size, image_size)
+            logging.info('Train epochs %i - %i with image size %r.', stage_start, stage_end, image_size)
+            _fit_sequences(model_train, _get_pool(image_size), batch_size=batch_size,
+                           epochs=stage_end, initial_epoch=stage_start)
+            # the callback counters continue in the next stage, see `TrainingState`
+            if model_train.stop_training:
+                logging.info('Early stopping at epoch %i, the remaining stages are skipped.',
+                             training_state.epoch)
+                break
 
     # Save the model architecture
-    with open(os.path.join(path_output, name_prefix + 'yolo_architect.yaml'), 'w') as fp:
-        fp.write(model.to_yaml())
-
-    if config['epochs'].get('head', 0) > 0:
-        model.compile(optimizer=Adam(lr=1e-3),
-                      loss={'yolo_loss': _yolo_loss})
-
+    if is_chief:
+        with open(os.path.join(path_output, name_prefix + 'yolo_architect.yaml'), 'w') as fp:
+            fp.write(model.to_yaml())
+
+    try:
+        # a resumed training skips the finished head phase
+        if config['epochs'].get('head', 0) > 0 and training_state.phase != 'full':
+            training_state.phase = 'head'
+            logging.info('Train on %i samples, val on %i samples, with batch size %i.',
+                         num_train, num_val, config['batch-size']['head'])
+            t_start = time.time()
+            _fit_phase(1e-3,
+                       batch_size=config['batch-size']['head'],
+                       accum_iters=config['accumulate-batches'].get('head', 1),
+                       initial_epoch=training_state.epoch,
+                       epochs=config['epochs']['head'])
+            logging.info('Training took %f minutes', (time.time() - t_start) / 60.)
+            if is_chief:
+                _export_model(model, path_output, name_prefix, '_head')
+
+        # Unfreeze and continue training, to fine-tune.
+        # Train longer if the result is not good.
+        logging.info('Unfreeze all of the layers.')
+        for i, _ in enumerate(model.layers):
+            model.layers[i].trainable = True
+        if training_state.phase != 'full':
+            # the full phase starts from the weights after the head phase
+            training_state.phase, training_state.epoch = 'full', config['epochs'].get('head', 0)
+            training_state.save()
         logging.info('Train on %i samples, val on %i samples, with batch size %i.',
-                     num_train, num_val, config['batch-size']['head'])
+                     num_train, num_val, config['batch-size']['full'])
         t_start = time.time()
-        model.fit_generator(
-            _data_generator(lines_train, batch_size=config['batch-size']['head']),
-            steps_per_epoch=max(1, num_train // config['batch-size']['head']),
-            validation_data=_data_generator(lines_valid, augment=False),
-            validation_steps=max(1, num_val // config['batch-size']['head']),
-            epochs=config['epochs']['head'],
-            use_multiprocessing=False,
-            initial_epoch=0,
-            callbacks=[tb_logging, checkpoint, reduce_lr, early_stopping],
-        )
+        _fit_phase(1e-4,
+                   batch_size=config['batch-size']['full'],
+                   accum_iters=config['accumulate-batches'].get('full', 1),
+                   initial_epoch=max(config['epochs']['head'], training_state.epoch),
+                   epochs=config['epochs']['head'] + config['epochs']['full'])
         logging.info('Training took %f minutes', (time.time() - t_start) / 60.)
-        _export_model(model, path_output, name_prefix, '_head')
-
-    # Unfreeze and continue training, to fine-tune.
-    # Train longer if the result is not good.
-    logging.info('Unfreeze all of the layers.')
-    for i, _ in enumerate(model.layers):
-        model.layers[i].trainable = True
-    model.compile(optimizer=Adam(lr=1e-4),
-                  loss={'yolo_loss': _yolo_loss})
-    logging.info('Train on %i samples, val on %i samples, with batch size %i.',
-                 num_train, num_val, config['batch-size']['full'])
-    t_start = time.time()
+        if is_chief:
+            _export_model(model, path_output, name_prefix, '_full')
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+
+def fit_sequences(model, pool, indices_train, indices_valid, batch_size, epochs, initial_epoch,
+                  callbacks, workers=1, max_queue_size=10, seed=None):
+    """fit the model on training and validation sequences prepared by the shared pool
+
+    The batches are made by worker processes of the pool,
+    so the Keras workers are just threads waiting for them.
+    With the `seed` the training batches of an epoch are the same
+    also when the training continues from this epoch.
+    """
+    seq_train = YoloSequence(pool, indices_train, batch_size=batch_size,
+                             seed=None if seed is None else seed + initial_epoch)
+    seq_valid = YoloSequence(pool, indices_valid, batch_size=batch_size, profile='valid',
+                             shuffle=False)
     model.fit_generator(
-        _data_generator(lines_train, batch_size=config['batch-size']['full']),
-        steps_per_epoch=max(1, num_train // config['batch-size']['full']),
-        validation_data=_data_generator(lines_valid, augment=False),
-        validation_steps=max(1, num_val // config['batch-size']['full']),
-        epochs=config['epochs']['head'] + config['epochs']['full'],
+        seq_train,
+        steps_per_epoch=len(seq_train),
+        validation_data=seq_valid,
+        validation_steps=len(seq_valid),
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        workers=workers,
         use_multiprocessing=False,
-        initial_epoch=config['epochs']['head'],
-        callbacks=[tb_logging, checkpoint, reduce_lr, early_stopping],
+        max_queue_size=max_queue_size,
+        callbacks=callbacks,
     )
-    logging.info('Training took %f minutes', (time.time() - t_start) / 60.)
-    _export_model(model, path_output, name_prefix, '_full')
 
 
 if __name__ == '__main__':